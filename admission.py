@@ -0,0 +1,482 @@
+"""
+上游请求的准入控制与过载卸载
+
+流量突增时，所有请求都直接进入 make_grok_request，线程在上游上堆积，所有请求的延迟一起恶化。
+这里限制同时进行的上游请求数：
+- 全局上限 MAX_IN_FLIGHT：超过后请求进入有界的等待队列，按到达顺序依次放行（释放的名额直接交给队首，新请求不能插队）
+- 单令牌上限 PER_TOKEN：选择令牌时跳过已达上限的令牌，全部达到上限时等待其中一个释放
+等待队列已满时立即拒绝（503），等待超过 QUEUE_TIMEOUT_MS 仍未放行时拒绝（全局名额 503，令牌名额 429），
+都带有 Retry-After：按最近名额的平均占用时间和排在前面的请求数估算。
+等待令牌名额的请求与等待全局名额的请求共用 QUEUE_SIZE 的队列上限；QUEUE_TIMEOUT_MS 从请求到达时算起，
+是两种等待合计的时限（Ticket.deadline），多次被唤醒后仍抢不到令牌的请求也会按时被拒绝。
+
+名额从进入上游请求开始占用，非流式请求在读取完响应后释放，流式请求在流结束或客户端断开时释放；
+重试换令牌时单令牌名额随之转移，全局名额不变；对冲请求用 HedgeTicket 另占一个令牌名额（同样受单令牌上限约束），
+选出胜者后由 Ticket.adopt 接管或释放。上限均为0时不加锁，直接放行。
+同步（线程）与异步（事件循环）各用一个控制器，与 SingleFlight / AsyncSingleFlight 相同。
+"""
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+TOKEN_BUSY = "token_busy"
+# 同步会话池的传输线程已全部占用（session_pool.SessionPool）
+WORKERS_BUSY = "workers_busy"
+
+# 名额占用时间 EWMA 的平滑系数，以及 Retry-After 的上限（秒）
+HOLD_ALPHA = 0.1
+MAX_RETRY_AFTER = 60
+
+
+class Overloaded(Exception):
+    """请求未获准进入上游：status 为返回给客户端的状态码，retry_after 为建议的重试间隔（秒）"""
+
+    def __init__(self, message, status, reason, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """一个请求占用的准入名额：全局名额以及当前所用令牌的名额"""
+    __slots__ = ("controller", "token", "waited", "admitted_at", "deadline", "released", "blocked")
+
+    def __init__(self, controller, waited=0.0):
+        self.controller = controller
+        self.token = None
+        self.waited = waited
+        self.admitted_at = time.monotonic()
+        # 排队等待（全局名额与令牌名额合计）的截止时间，从请求到达时算起
+        self.deadline = self.admitted_at - waited + controller.queue_timeout
+        self.released = False
+        # 选择令牌时因单令牌上限跳过了令牌，记录首次跳过时的令牌释放序号，否则为None
+        self.blocked = None
+
+    def try_hold(self, token):
+        """令牌还有名额时把单令牌名额转移到该令牌并返回True"""
+        return self.controller._try_hold(self, token)
+
+    def move(self, token):
+        """实际使用的令牌与选中的不同时转移名额，不检查上限"""
+        if token != self.token:
+            self.controller._move(self, token)
+
+    def hedge(self):
+        """为对冲请求另占令牌名额的 HedgeTicket，不占全局名额"""
+        return HedgeTicket(self)
+
+    def adopt(self, hedge):
+        """对冲请求胜出：释放当前令牌的名额，改用对冲请求已占的名额"""
+        self.controller._adopt(self, hedge)
+
+    def busy_tokens(self):
+        """有请求在进行中的令牌数，选择令牌时最多跳过这么多个"""
+        return len(self.controller.token_in_flight)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class HedgeTicket:
+    """对冲请求占用的令牌名额：选择令牌时与 Ticket 相同地检查单令牌上限，release 只释放令牌名额"""
+    __slots__ = ("controller", "token", "deadline", "blocked")
+
+    def __init__(self, ticket):
+        self.controller = ticket.controller
+        self.token = None
+        self.deadline = ticket.deadline
+        self.blocked = None
+
+    def try_hold(self, token):
+        return self.controller._try_hold(self, token)
+
+    def busy_tokens(self):
+        return len(self.controller.token_in_flight)
+
+    def release(self):
+        self.controller._release_hedge(self)
+
+
+class _NullTicket:
+    """未启用准入控制时使用，所有操作都是空操作"""
+    __slots__ = ()
+    token = None
+    waited = 0.0
+    blocked = None
+
+    def try_hold(self, token):
+        return True
+
+    def move(self, token):
+        pass
+
+    def hedge(self):
+        return self
+
+    def adopt(self, hedge):
+        pass
+
+    def busy_tokens(self):
+        return 0
+
+    def release(self):
+        pass
+
+
+NULL_TICKET = _NullTicket()
+
+
+class AdmittedStream:
+    """
+    包装流式响应的SSE帧生成器，流结束或被关闭时释放名额。
+    与 metrics._ObservedStream 相同，不用生成器实现：未开始迭代就被关闭的生成器不会执行 finally
+    """
+
+    def __init__(self, frames, ticket):
+        self.frames = frames
+        self.ticket = ticket
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.frames)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self.ticket.release()
+        self.frames.close()
+
+    def __del__(self):
+        # 兜底：调用方丢弃了未关闭的流时也归还名额
+        self.ticket.release()
+
+
+class AsyncAdmittedStream(AdmittedStream):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.frames.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        self.ticket.release()
+        await self.frames.aclose()
+
+
+class _AdmissionBase:
+    def __init__(self, max_in_flight=0, per_token=0, queue_size=100, queue_timeout=5.0):
+        self.max_in_flight = max_in_flight
+        self.per_token = per_token
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.enabled = max_in_flight > 0 or per_token > 0
+        self.in_flight = 0
+        # {令牌: 进行中的请求数}，只记录不为0的令牌
+        self.token_in_flight = {}
+        # 令牌名额的释放次数，等待令牌时据此判断跳过令牌之后是否已有名额释放
+        self.token_releases = 0
+        # 正在等待令牌名额的请求数，与等待全局名额的请求共用 queue_size
+        self.token_waiting = 0
+        self.hold_time = None
+        self.stats = {
+            "admitted": 0,
+            "queued": 0,
+            "token_waits": 0,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+            "rejected_token_busy": 0
+        }
+
+    def _queue_full(self, global_waiting):
+        return global_waiting + self.token_waiting >= self.queue_size
+
+    def _global_full(self):
+        return self.max_in_flight > 0 and self.in_flight >= self.max_in_flight
+
+    def _token_full(self, token):
+        return self.per_token > 0 and self.token_in_flight.get(token, 0) >= self.per_token
+
+    def _take_token(self, ticket, token):
+        self._drop_token(ticket)
+        ticket.token = token
+        if token is not None:
+            self.token_in_flight[token] = self.token_in_flight.get(token, 0) + 1
+
+    def _drop_token(self, ticket):
+        """释放 ticket 当前令牌的名额，返回是否释放了名额"""
+        token = ticket.token
+        if token is None:
+            return False
+        ticket.token = None
+        count = self.token_in_flight.get(token, 0) - 1
+        if count > 0:
+            self.token_in_flight[token] = count
+        else:
+            self.token_in_flight.pop(token, None)
+        self.token_releases += 1
+        return True
+
+    def _record_hold(self, ticket):
+        held = time.monotonic() - ticket.admitted_at
+        self.hold_time = held if self.hold_time is None else self.hold_time + HOLD_ALPHA * (held - self.hold_time)
+
+    def _retry_after(self, ahead, slots):
+        """排在前面的 ahead 个请求以 slots 个名额并行处理，估算再次请求前应等待的秒数"""
+        hold = self.hold_time or 1.0
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(hold * (ahead + 1) / max(1, slots))))
+
+    def _skip_token(self, ticket):
+        if ticket.blocked is None:
+            ticket.blocked = self.token_releases
+
+    def _reject_queue(self, reason, waiting):
+        key = "rejected_queue_full" if reason == QUEUE_FULL else "rejected_timeout"
+        self.stats[key] += 1
+        message = '服务繁忙，等待队列已满' if reason == QUEUE_FULL else '服务繁忙，排队等待超时'
+        return Overloaded(message, 503, reason, self._retry_after(waiting, self.max_in_flight))
+
+    def _reject_token(self):
+        self.stats["rejected_token_busy"] += 1
+        return Overloaded('所有令牌都已达到并发上限，请稍后重试', 429, TOKEN_BUSY, self._retry_after(0, 1))
+
+    def _status(self, waiting):
+        return {
+            "enabled": self.enabled,
+            "max_in_flight": self.max_in_flight,
+            "per_token": self.per_token,
+            "queue_size": self.queue_size,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "waiting": waiting,
+            "token_waiting": self.token_waiting,
+            "busy_tokens": sum(1 for token in self.token_in_flight if self._token_full(token)),
+            "hold_time_ms": round(self.hold_time * 1000, 1) if self.hold_time is not None else None,
+            **self.stats
+        }
+
+
+class AdmissionController(_AdmissionBase):
+    """线程模式的准入控制"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._token_released = threading.Condition(self._lock)
+        # 等待全局名额的请求，元素为 [Event, 是否已获得名额]
+        self._waiters = deque()
+
+    def admit(self):
+        """获取全局名额，必要时排队等待；被拒绝时抛出 Overloaded"""
+        if not self.enabled:
+            return NULL_TICKET
+        with self._lock:
+            if not self._global_full() and not self._waiters:
+                self.in_flight += 1
+                self.stats["admitted"] += 1
+                return Ticket(self)
+            if self._queue_full(len(self._waiters)):
+                raise self._reject_queue(QUEUE_FULL, len(self._waiters))
+            waiter = [threading.Event(), False]
+            self._waiters.append(waiter)
+            self.stats["queued"] += 1
+
+        started = time.monotonic()
+        waiter[0].wait(self.queue_timeout)
+        with self._lock:
+            # 超时与放行可能同时发生，以是否已获得名额为准
+            if not waiter[1]:
+                self._waiters.remove(waiter)
+                raise self._reject_queue(QUEUE_TIMEOUT, len(self._waiters))
+            self.stats["admitted"] += 1
+        return Ticket(self, time.monotonic() - started)
+
+    def wait_token(self, ticket):
+        """
+        选择令牌时所有可用令牌都已达到上限：等待任一令牌释放名额。
+        超过 ticket 的排队截止时间时抛出 Overloaded（429），等待队列已满时同样拒绝（503）
+        """
+        with self._lock:
+            self.stats["token_waits"] += 1
+            # 跳过令牌之后已有名额释放时直接重新选择
+            if self.token_releases == ticket.blocked:
+                remaining = ticket.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._reject_token()
+                if self._queue_full(len(self._waiters)):
+                    raise self._reject_queue(QUEUE_FULL, len(self._waiters) + self.token_waiting)
+                self.token_waiting += 1
+                try:
+                    released = self._token_released.wait(remaining)
+                finally:
+                    self.token_waiting -= 1
+                if not released:
+                    raise self._reject_token()
+        ticket.blocked = None
+
+    def _try_hold(self, ticket, token):
+        with self._lock:
+            if token != ticket.token and self._token_full(token):
+                self._skip_token(ticket)
+                return False
+            if token != ticket.token:
+                self._release_token_locked(ticket)
+                self._take_token(ticket, token)
+            return True
+
+    def _move(self, ticket, token):
+        with self._lock:
+            self._release_token_locked(ticket)
+            self._take_token(ticket, token)
+
+    def _adopt(self, ticket, hedge):
+        with self._lock:
+            self._release_token_locked(ticket)
+            ticket.token, hedge.token = hedge.token, None
+
+    def _release_hedge(self, hedge):
+        with self._lock:
+            self._release_token_locked(hedge)
+
+    def _release_token_locked(self, ticket):
+        if self._drop_token(ticket) and self.per_token > 0:
+            self._token_released.notify_all()
+
+    def _release(self, ticket):
+        with self._lock:
+            self._release_token_locked(ticket)
+            self._record_hold(ticket)
+            if self._waiters:
+                # 名额直接交给队首，进行中的请求数不变
+                waiter = self._waiters.popleft()
+                waiter[1] = True
+                waiter[0].set()
+            else:
+                self.in_flight -= 1
+
+    def get_stats(self):
+        with self._lock:
+            return self._status(len(self._waiters))
+
+
+class AsyncAdmissionController(_AdmissionBase):
+    """事件循环中的准入控制，只在事件循环线程中调用，不需要加锁"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 等待全局名额的请求（Future，获得名额时结果为True）与等待令牌名额的请求
+        self._waiters = deque()
+        self._token_waiters = []
+
+    async def admit(self):
+        if not self.enabled:
+            return NULL_TICKET
+        if not self._global_full() and not self._waiters:
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            return Ticket(self)
+        if self._queue_full(len(self._waiters)):
+            raise self._reject_queue(QUEUE_FULL, len(self._waiters))
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self.stats["queued"] += 1
+
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                waiter.cancel()
+                raise self._reject_queue(QUEUE_TIMEOUT, len(self._waiters))
+        except asyncio.CancelledError:
+            # 客户端在排队时断开：已交给它的名额转交给下一个请求
+            if waiter.done():
+                self._hand_over()
+            else:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            raise
+        self.stats["admitted"] += 1
+        return Ticket(self, time.monotonic() - started)
+
+    async def wait_token(self, ticket):
+        self.stats["token_waits"] += 1
+        if self.token_releases != ticket.blocked:
+            ticket.blocked = None
+            return
+        remaining = ticket.deadline - time.monotonic()
+        if remaining <= 0:
+            raise self._reject_token()
+        if self._queue_full(len(self._waiters)):
+            raise self._reject_queue(QUEUE_FULL, len(self._waiters) + self.token_waiting)
+        waiter = asyncio.get_running_loop().create_future()
+        self._token_waiters.append(waiter)
+        self.token_waiting += 1
+        try:
+            await asyncio.wait_for(waiter, remaining)
+        except asyncio.TimeoutError:
+            raise self._reject_token() from None
+        finally:
+            self.token_waiting -= 1
+            if waiter in self._token_waiters:
+                self._token_waiters.remove(waiter)
+        ticket.blocked = None
+
+    def _try_hold(self, ticket, token):
+        if token != ticket.token and self._token_full(token):
+            self._skip_token(ticket)
+            return False
+        if token != ticket.token:
+            self._release_token(ticket)
+            self._take_token(ticket, token)
+        return True
+
+    def _move(self, ticket, token):
+        self._release_token(ticket)
+        self._take_token(ticket, token)
+
+    def _adopt(self, ticket, hedge):
+        self._release_token(ticket)
+        ticket.token, hedge.token = hedge.token, None
+
+    def _release_hedge(self, hedge):
+        self._release_token(hedge)
+
+    def _release_token(self, ticket):
+        if self._drop_token(ticket) and self._token_waiters:
+            waiters, self._token_waiters = self._token_waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(True)
+
+    def _release(self, ticket):
+        self._release_token(ticket)
+        self._record_hold(ticket)
+        self._hand_over()
+
+    def _hand_over(self):
+        """名额交给队首仍在等待的请求，没有时归还"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight -= 1
+
+    def get_stats(self):
+        return self._status(len(self._waiters))
@@ -0,0 +1,148 @@
+"""
+对话接口的多API Key与按Key的配额
+
+API_KEYS 为 JSON 数组（或内容为该数组的 JSON 文件路径），每项:
+    {"key": "sk-team-a", "name": "team-a", "rpm": 60, "burst": 10, "streams": 4, "models": ["grok-3"]}
+- rpm: 每分钟请求数，用令牌桶限制（容量 burst，默认等于 rpm），0 为不限制
+- streams: 同时进行的流式请求数上限，0 为不限制
+- models: 允许使用的模型，为空时不限制
+name 用于统计和指标，不填时取 key 的前几位。原有的 API_KEY 仍然有效且不受限制（列表中有同一个 key 时以列表为准）；
+/get/tokens 等令牌管理接口只接受 API_KEY。
+
+按 Key 的查找是一次字典查找，令牌桶在取用时按流逝时间补充，不需要后台线程；每个 Key 一把锁，
+不同 Key 的请求互不竞争。配额按进程计算，多进程部署（WORKERS>1）时每个进程各自限制。
+"""
+import json
+import math
+import time
+import threading
+
+RATE_LIMITED = "rate_limited"
+STREAMS = "streams"
+MODEL = "model"
+
+
+class QuotaExceeded(Exception):
+    """请求超出该 Key 的配额：status 为返回给客户端的状态码，retry_after 为建议的重试间隔（秒），不适用时为None"""
+
+    def __init__(self, message, status, reason, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """容量 capacity、每秒补充 rate 个的令牌桶，调用方负责加锁"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """取一个令牌，成功返回0，否则返回还需等待的秒数"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ApiKey:
+    def __init__(self, key, name=None, rpm=0, burst=None, streams=0, models=None):
+        self.key = key
+        self.name = name or f"{key[:6]}..."
+        self.rpm = rpm
+        self.streams = streams
+        # None 表示不限制模型
+        self.models = frozenset(models) if models else None
+        self.bucket = TokenBucket(rpm / 60, burst or rpm) if rpm else None
+        self.active_streams = 0
+        self.stats = {"requests": 0, "rejected_rate_limited": 0, "rejected_streams": 0, "rejected_model": 0}
+        self._lock = threading.Lock()
+
+    def acquire(self, model, stream):
+        """检查模型、请求速率和并发流数，超出时抛出 QuotaExceeded；流式请求获准后占用一个并发名额，需调用 release_stream"""
+        if self.models is not None and model not in self.models:
+            with self._lock:
+                self.stats["rejected_model"] += 1
+            raise QuotaExceeded(f"该API Key不允许使用模型: {model}", 403, MODEL)
+        with self._lock:
+            # 先检查并发流数再扣减令牌桶：因流数上限被拒绝的请求不消耗每分钟请求数
+            if stream and self.streams and self.active_streams >= self.streams:
+                self.stats["rejected_streams"] += 1
+                # 流的长度无法预估，建议稍后重试
+                raise QuotaExceeded('该API Key同时进行的流式请求已达上限', 429, STREAMS, 1)
+            if self.bucket is not None:
+                wait = self.bucket.take(time.monotonic())
+                if wait:
+                    self.stats["rejected_rate_limited"] += 1
+                    raise QuotaExceeded('请求过于频繁，超出该API Key的每分钟请求数', 429, RATE_LIMITED,
+                                        max(1, math.ceil(wait)))
+            if stream:
+                self.active_streams += 1
+            self.stats["requests"] += 1
+
+    def release_stream(self):
+        with self._lock:
+            self.active_streams -= 1
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "name": self.name,
+                "rpm": self.rpm,
+                "burst": self.bucket.capacity if self.bucket is not None else None,
+                "streams": self.streams,
+                "models": sorted(self.models) if self.models is not None else None,
+                "active_streams": self.active_streams,
+                **self.stats
+            }
+
+
+def parse_api_keys(value):
+    """解析 API_KEYS：JSON 数组，或内容为 JSON 数组的文件路径；格式错误时抛出 ValueError"""
+    if not value:
+        return []
+    value = value.strip()
+    if not value.startswith("["):
+        with open(value, encoding="utf-8") as f:
+            value = f.read()
+    entries = json.loads(value)
+    if not isinstance(entries, list):
+        raise ValueError("API_KEYS 应为JSON数组")
+    keys = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("key"):
+            raise ValueError(f"API_KEYS 中的条目缺少 key: {entry}")
+        keys.append(ApiKey(
+            entry["key"], entry.get("name"), int(entry.get("rpm", 0)), int(entry.get("burst", 0)) or None,
+            int(entry.get("streams", 0)), entry.get("models")
+        ))
+    return keys
+
+
+class ApiKeyRegistry:
+    def __init__(self, keys=(), default_key=None):
+        self.keys = {api_key.key: api_key for api_key in keys}
+        if len(self.keys) != len(keys):
+            raise ValueError("API_KEYS 中有重复的 key")
+        if default_key and default_key not in self.keys:
+            self.keys[default_key] = ApiKey(default_key, "default")
+
+    def authenticate(self, authorization):
+        """校验 Authorization 头，返回 (ApiKey, None)，失败时返回 (None, 错误信息)"""
+        auth_token = (authorization or '').replace('Bearer ', '')
+        if not auth_token:
+            return None, 'API_KEY缺失'
+        api_key = self.keys.get(auth_token)
+        if api_key is None:
+            return None, 'Unauthorized'
+        return api_key, None
+
+    def get_stats(self):
+        return [api_key.get_stats() for api_key in self.keys.values()]
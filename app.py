@@ -3,13 +3,19 @@ import time
 import json
 import secrets
 from functools import wraps
-from flask import Flask, request, Response, jsonify, render_template, redirect, session
+from flask import Flask, request, Response, jsonify, render_template, redirect, session, stream_with_context
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from config import config_manager
 from logger import logger
 from token_manager import AuthTokenManager
+from token_shared import prepare_shared_db
 from request_handler import RequestHandler
+from token_validator import TokenValidator
+from message_processor import normalization_cache
+from metrics import METRICS_CONTENT_TYPE
+from admission import Overloaded
+from api_keys import ApiKeyRegistry, QuotaExceeded, parse_api_keys
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app)
@@ -18,6 +24,8 @@ app.json.sort_keys = False
 
 token_manager = AuthTokenManager()
 request_handler = RequestHandler(token_manager)
+token_validator = TokenValidator(request_handler, token_manager)
+api_keys = ApiKeyRegistry(parse_api_keys(config_manager.get("API.API_KEYS")), config_manager.get("API.API_KEY"))
 
 
 def admin_required(f):
@@ -43,11 +51,50 @@ def admin_required(f):
     return decorated_function
 
 
+def verify_api_key(authorization):
+    """校验对话接口的API Key，返回 (ApiKey, None)，失败时返回 (None, 错误信息)（同步与异步服务共用）"""
+    return api_keys.authenticate(authorization)
+
+
+def check_quota(api_key, model, stream):
+    """检查该 Key 的模型白名单、请求速率和并发流数，超出时计入指标后抛出 QuotaExceeded"""
+    try:
+        api_key.acquire(model, stream)
+    except QuotaExceeded as e:
+        request_handler.metrics.api_key_rejections.inc(api_key.name, e.reason)
+        raise
+
+
+def rejection_body(error):
+    """准入控制或 Key 配额拒绝请求时的错误内容"""
+    if isinstance(error, Overloaded):
+        error_type = "overloaded_error"
+    else:
+        error_type = "rate_limit_error" if error.status == 429 else "permission_error"
+    return {
+        "error": {
+            "message": str(error),
+            "type": error_type,
+            "code": error.reason
+        }
+    }
+
+
+def rejection_response(error):
+    result = jsonify(rejection_body(error))
+    if error.retry_after is not None:
+        result.headers['Retry-After'] = str(error.retry_after)
+    return result, error.status
+
+
 def initialization():
+    if config_manager.get("SERVER.WORKERS", 1) > 1:
+        logger.info("工作进程 {} 启动", "Server", os.getpid())
+    token_manager.load_from_disk()
     token_manager.load_from_env()
     
     if config_manager.get("API.PROXY"):
-        logger.info(f"代理已设置: {config_manager.get('API.PROXY')}", "Server")
+        logger.info("代理已设置: {} 个", "Server", len(request_handler.proxy_pool))
 
     logger.info("初始化完成", "Server")
 
@@ -149,6 +196,108 @@ def delete_manager_token():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route('/manager/api/pool', methods=['GET'])
+@admin_required
+def get_pool_stats():
+    """获取上游会话池的复用统计"""
+    return jsonify({
+        "sync": request_handler.session_pool.get_stats(),
+        "async": request_handler.async_session_pool.get_stats()
+    })
+
+
+@app.route('/manager/api/cache', methods=['GET'])
+@admin_required
+def get_cache_stats():
+    """获取历史消息规范化缓存和响应缓存的命中统计"""
+    return jsonify({
+        "messages": normalization_cache.get_stats(),
+        "responses": request_handler.response_cache.get_stats()
+    })
+
+
+@app.route('/manager/api/single-flight', methods=['GET'])
+@admin_required
+def get_single_flight_stats():
+    """获取相同请求合并的统计，followers 即节省的上游请求数"""
+    return jsonify({
+        "sync": request_handler.single_flight.get_stats(),
+        "async": request_handler.async_single_flight.get_stats(),
+        "stream_sync": request_handler.stream_fanout.get_stats(),
+        "stream_async": request_handler.async_stream_fanout.get_stats()
+    })
+
+
+@app.route('/manager/api/hedge', methods=['GET'])
+@admin_required
+def get_hedge_stats():
+    """获取对冲请求的统计：对冲比例、当前对冲延迟、首行延迟分位数以及p99的改善"""
+    return jsonify(request_handler.hedge_policy.get_stats())
+
+
+@app.route('/manager/api/shared', methods=['GET'])
+@admin_required
+def get_shared_stats():
+    """多进程共享令牌存储的状态（活跃进程数、各模型游标、租用次数），以及处理本次请求的工作进程"""
+    stats = token_manager.get_shared_stats()
+    if stats is None:
+        return jsonify({"error": "未启用共享令牌存储（TOKEN_SHARED_DB）"}), 404
+    stats["pid"] = os.getpid()
+    return jsonify(stats)
+
+
+@app.route('/manager/api/retry', methods=['GET'])
+@admin_required
+def get_retry_stats():
+    """获取重试统计（按失败分类的重试次数、放弃原因、重试预算）以及按令牌、按代理的熔断器状态"""
+    return jsonify({
+        "policy": request_handler.retry_policy.get_stats(),
+        "breakers": {
+            "token": request_handler.token_breakers.get_stats(),
+            "proxy": request_handler.proxy_breakers.get_stats()
+        }
+    })
+
+
+@app.route('/manager/api/admission', methods=['GET'])
+@admin_required
+def get_admission_stats():
+    """获取准入控制的状态：进行中的上游请求数、等待队列长度、名额平均占用时间以及按原因的拒绝次数"""
+    return jsonify({
+        "sync": request_handler.admission.get_stats(),
+        "async": request_handler.async_admission.get_stats()
+    })
+
+
+@app.route('/manager/api/keys', methods=['GET'])
+@admin_required
+def get_api_key_stats():
+    """获取各API Key的配额设置、进行中的流式请求数、请求数以及按原因的拒绝次数（不返回 key 本身）"""
+    return jsonify(api_keys.get_stats())
+
+
+@app.route('/manager/api/recordings', methods=['GET'])
+@admin_required
+def get_recording_stats():
+    """获取上游响应录制的状态：录制文件路径、已录制条数和写入字节数、采样跳过和队列满丢弃的次数"""
+    return jsonify(request_handler.recorder.get_stats())
+
+
+@app.route('/manager/api/proxies', methods=['GET'])
+@admin_required
+def get_proxy_stats():
+    """获取各代理的延迟 EWMA、封禁剩余时间、熔断器状态和请求计数"""
+    return jsonify(request_handler.proxy_pool.get_stats())
+
+
+@app.route('/manager/api/proxies/unban', methods=['POST'])
+@admin_required
+def unban_proxies():
+    """解除代理的封禁冷却，不传 proxy 时解除全部"""
+    proxy = (request.json or {}).get('proxy') if request.is_json else None
+    return jsonify({"success": True, "unbanned": request_handler.proxy_pool.unban(proxy)})
+
+
 @app.route('/manager/api/log-level', methods=['GET'])
 @admin_required
 def get_log_level():
@@ -210,20 +359,9 @@ def test_manager_token():
             "stream": False
         }
         
-        # 临时设置token进行测试
-        original_tokens = token_manager.get_all_tokens()
-        token_manager.tokens = [cookie]  # 临时替换为测试cookie
-        token_manager.current_index = 0
-        token_manager.last_round_index = -1
-        
         try:
-            # 发送测试请求
-            response = request_handler.make_grok_request(test_data, "grok-3", False)
-            
-            # 恢复原始tokens
-            token_manager.tokens = original_tokens
-            token_manager.current_index = 0 
-            token_manager.last_round_index = -1
+            # 指定令牌发送测试请求，不影响线上的令牌轮询
+            response = request_handler.make_grok_request(test_data, "grok-3", False, token=cookie)
             
             if response and isinstance(response, dict) and 'choices' in response:
                 return jsonify({"success": True, "message": "Cookie测试成功"})
@@ -231,16 +369,59 @@ def test_manager_token():
                 return jsonify({"success": False, "error": "响应格式异常"})
                 
         except Exception as test_error:
-            # 恢复原始tokens
-            token_manager.tokens = original_tokens
-            token_manager.current_index = 0
-            token_manager.last_round_index = -1
             return jsonify({"success": False, "error": str(test_error)})
             
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route('/manager/api/validate', methods=['POST'])
+@admin_required
+def validate_manager_tokens():
+    """
+    批量检测令牌，以NDJSON逐行返回每个令牌的检测结果，最后一行为汇总。
+    请求体: tokens(可选，字符串列表，默认检测全部令牌), model, concurrency, timeout(单个令牌的检测时限，秒), drop_invalid
+    """
+    try:
+        data = request.json or {}
+        tokens = data.get('tokens')
+        if tokens is not None and (not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens)):
+            return jsonify({"error": "tokens must be a list of strings"}), 400
+        tokens = tokens or token_manager.get_all_tokens()
+        model = data.get('model', 'grok-3')
+        if not config_manager.is_valid_model(model):
+            return jsonify({"error": f"Invalid model: {model}"}), 400
+
+        # 参数在返回200响应头之前检查，validate 是生成器，参数错误到迭代时才会抛出
+        concurrency = data.get('concurrency')
+        timeout = data.get('timeout')
+        try:
+            concurrency = None if concurrency is None else int(concurrency)
+            timeout = None if timeout is None else float(timeout)
+        except (TypeError, ValueError):
+            return jsonify({"error": "concurrency must be an integer and timeout a number"}), 400
+        if concurrency is not None and concurrency < 1:
+            return jsonify({"error": "concurrency must be at least 1"}), 400
+        if timeout is not None and not 0 < timeout <= 300:
+            return jsonify({"error": "timeout must be between 0 and 300 seconds"}), 400
+
+        results = token_validator.validate(
+            tokens,
+            model=model,
+            concurrency=concurrency,
+            timeout=timeout,
+            drop_invalid=bool(data.get('drop_invalid'))
+        )
+
+        def generate():
+            for result in results:
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+        return Response(stream_with_context(generate()), content_type='application/x-ndjson')
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route('/get/tokens', methods=['GET'])
 def get_tokens():
     auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
@@ -259,7 +440,7 @@ def add_token():
         sso = request.json.get('sso')
         token_str = f"sso-rw={sso};sso={sso}"
         token_manager.add_token(token_str)
-        return jsonify(token_manager.get_token_status_map().get(sso, {})), 200
+        return jsonify(token_manager.get_token_status(sso) or {}), 200
     except Exception as error:
         logger.error(str(error), "Server")
         return jsonify({"error": '添加sso令牌失败'}), 500
@@ -281,6 +462,14 @@ def delete_token():
         return jsonify({"error": '删除sso令牌失败'}), 500
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus 抓取接口"""
+    if not config_manager.get("METRICS.ENABLED", True):
+        return jsonify({"error": "Not Found"}), 404
+    return Response(request_handler.metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
 @app.route('/v1/models', methods=['GET'])
 def get_models():
     return jsonify({
@@ -302,12 +491,9 @@ def chat_completions():
     response_status_code = 500
     
     try:
-        auth_token = request.headers.get('Authorization', '').replace('Bearer ', '')
-        if auth_token:
-            if auth_token != config_manager.get("API.API_KEY"):
-                return jsonify({"error": 'Unauthorized'}), 401
-        else:
-            return jsonify({"error": 'API_KEY缺失'}), 401
+        api_key, auth_error = verify_api_key(request.headers.get('Authorization'))
+        if auth_error:
+            return jsonify({"error": auth_error}), 401
 
         data = request.json
         model = data.get("model")
@@ -319,13 +505,28 @@ def chat_completions():
             return jsonify({"error": str(e)}), 400
 
         try:
-            response = request_handler.make_grok_request(data, model, stream)
+            check_quota(api_key, model, stream)
+        except QuotaExceeded as e:
+            return rejection_response(e)
+
+        # 流式请求占用一个并发流名额，返回响应后改为在响应关闭时（流结束或客户端断开）归还
+        holding_stream = bool(stream)
+        try:
+            response, cache_status = request_handler.make_chat_request(data, model, stream, request.headers.get('Cache-Control'))
             
             if stream:
+                response.call_on_close(api_key.release_stream)
+                holding_stream = False
                 return response
             else:
-                return jsonify(response)
-                
+                result = jsonify(response)
+                if cache_status:
+                    result.headers['X-Cache'] = cache_status
+                return result
+
+        except Overloaded as e:
+            return rejection_response(e)
+
         except ValueError as e:
             response_status_code = 400
             logger.error(str(e), "ChatAPI")
@@ -335,6 +536,10 @@ def chat_completions():
                     "type": "invalid_request_error"
                 }
             }), response_status_code
+
+        finally:
+            if holding_stream:
+                api_key.release_stream()
             
     except Exception as error:
         logger.error(str(error), "ChatAPI")
@@ -352,12 +557,84 @@ def catch_all(path):
     return 'api运行正常', 200
 
 
-if __name__ == '__main__':
+def prepare_workers(workers):
+    """多进程启动前的准备：各进程共用同一个会话密钥（否则登录状态只在一个进程内有效）和共享令牌存储"""
+    os.environ.setdefault('FLASK_SECRET_KEY', app.secret_key)
+    path = prepare_shared_db(workers)
+    logger.info("启动 {} 个工作进程，共享令牌存储: {}", "Server", workers, path)
+
+
+def serve_worker(fd):
+    """threaded 模式的工作进程：在父进程传入的监听套接字上运行多线程服务"""
+    from werkzeug.serving import make_server
+
     initialization()
-    
-    app.run(
-        host='0.0.0.0',
-        port=config_manager.get("SERVER.PORT"),
-        debug=False
-    )
+    make_server('0.0.0.0', config_manager.get("SERVER.PORT"), app, threaded=True, fd=fd).serve_forever()
+
+
+def serve_workers(workers):
+    """
+    threaded 模式的多进程服务：父进程监听端口并启动 workers 个子进程共用该套接字，由内核分配连接；
+    子进程意外退出时重新启动，父进程收到 SIGTERM / SIGINT 后结束全部子进程。
+    """
+    import sys
+    import signal
+    import socket
+    import subprocess
+
+    listener = socket.create_server(('0.0.0.0', config_manager.get("SERVER.PORT")), backlog=2048)
+    fd = listener.fileno()
+    env = dict(os.environ, SERVER_WORKER_FD=str(fd))
+
+    def spawn():
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, pass_fds=(fd,))
 
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+
+    children = [spawn() for _ in range(workers)]
+    try:
+        while not stopping:
+            time.sleep(0.5)
+            for index, child in enumerate(children):
+                if child.poll() is not None and not stopping:
+                    logger.error("工作进程 {} 已退出（返回码 {}），重新启动", "Server", child.pid, child.returncode)
+                    children[index] = spawn()
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        listener.close()
+
+
+if __name__ == '__main__':
+    workers = config_manager.get("SERVER.WORKERS", 1)
+    if os.environ.get("SERVER_WORKER_FD"):
+        serve_worker(int(os.environ["SERVER_WORKER_FD"]))
+    elif config_manager.get("SERVER.MODE") == "asgi":
+        # 异步模式下由 asgi_app 在 lifespan 启动阶段完成初始化（多进程时每个进程各自初始化）
+        import uvicorn
+
+        if workers > 1:
+            prepare_workers(workers)
+        uvicorn.run(
+            "asgi_app:app",
+            host='0.0.0.0',
+            port=config_manager.get("SERVER.PORT"),
+            log_level="warning",
+            workers=workers
+        )
+    elif workers > 1:
+        prepare_workers(workers)
+        serve_workers(workers)
+    else:
+        initialization()
+
+        app.run(
+            host='0.0.0.0',
+            port=config_manager.get("SERVER.PORT"),
+            debug=False,
+            threaded=True
+        )
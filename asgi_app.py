@@ -0,0 +1,191 @@
+"""
+ASGI 异步服务入口
+
+/v1/chat/completions 在事件循环中直接处理，上游请求使用 curl_cffi 的 AsyncSession，
+流式响应不再独占工作线程；其余路由（管理后台、令牌接口等）通过 a2wsgi 转交给原有的 Flask 应用。
+
+启动方式:
+    SERVER_MODE=asgi python app.py
+    或 uvicorn asgi_app:app --host 0.0.0.0 --port 5200
+    多进程: SERVER_MODE=asgi WORKERS=8 python app.py（令牌状态见 token_shared.py）
+"""
+import json
+import asyncio
+from a2wsgi import WSGIMiddleware
+
+from config import config_manager
+from logger import logger
+from app import app as flask_app, request_handler, initialization, verify_api_key, check_quota, rejection_body
+from metrics import METRICS_CONTENT_TYPE
+from admission import Overloaded
+from api_keys import QuotaExceeded
+
+
+wsgi_app = WSGIMiddleware(flask_app, workers=config_manager.get("SERVER.WSGI_WORKERS", 10))
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_json(send, payload, status=200, headers=None):
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1')),
+            *(headers or [])
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_rejection(send, error):
+    """准入控制或 Key 配额拒绝请求时的响应，带有 Retry-After"""
+    headers = [(b'retry-after', str(error.retry_after).encode('latin-1'))] if error.retry_after is not None else None
+    await send_json(send, rejection_body(error), error.status, headers)
+
+
+async def send_metrics(send):
+    """在事件循环中直接生成 /metrics，不占用 WSGI 工作线程"""
+    body = request_handler.metrics.render().encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', METRICS_CONTENT_TYPE.encode('latin-1')),
+            (b'content-length', str(len(body)).encode('latin-1'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_event_stream(send, receive, generator):
+    """发送SSE流，客户端断开时立即停止读取上游"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream; charset=utf-8')]
+    })
+
+    async def pump():
+        async for frame in generator:
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+
+    async def wait_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait([pump_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, disconnect_task):
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(pump_task, disconnect_task, return_exceptions=True)
+        # 确保生成器的 finally 得以执行，释放上游连接
+        await generator.aclose()
+
+    if pump_task.done() and not pump_task.cancelled() and pump_task.exception() is None:
+        await send({'type': 'http.response.body', 'body': b''})
+    elif pump_task.done() and not pump_task.cancelled():
+        logger.error("流式响应发送异常: {}", "ChatAPI", pump_task.exception())
+    else:
+        logger.info("客户端已断开，停止流式响应", "ChatAPI")
+
+
+async def chat_completions(scope, receive, send):
+    response_status_code = 500
+
+    try:
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        api_key, auth_error = verify_api_key(headers.get('authorization'))
+        if auth_error:
+            return await send_json(send, {"error": auth_error}, 401)
+
+        data = json.loads(await read_body(receive))
+        model = data.get("model")
+        stream = data.get("stream", False)
+
+        try:
+            request_handler.validate_request(data)
+        except ValueError as e:
+            return await send_json(send, {"error": str(e)}, 400)
+
+        try:
+            check_quota(api_key, model, stream)
+        except QuotaExceeded as e:
+            return await send_rejection(send, e)
+
+        try:
+            response, cache_status = await request_handler.make_chat_request_async(data, model, stream, headers.get('cache-control'))
+
+            if stream and response is not None:
+                return await send_event_stream(send, receive, response)
+            else:
+                extra_headers = [(b'x-cache', cache_status.encode('latin-1'))] if cache_status else None
+                return await send_json(send, response, headers=extra_headers)
+
+        except Overloaded as e:
+            return await send_rejection(send, e)
+
+        except ValueError as e:
+            response_status_code = 400
+            logger.error(str(e), "ChatAPI")
+            return await send_json(send, {
+                "error": {
+                    "message": str(e),
+                    "type": "invalid_request_error"
+                }
+            }, response_status_code)
+
+        finally:
+            # 流式请求占用的并发流名额在流结束或客户端断开后归还
+            if stream:
+                api_key.release_stream()
+
+    except Exception as error:
+        logger.error(str(error), "ChatAPI")
+        return await send_json(send, {
+            "error": {
+                "message": str(error),
+                "type": "server_error"
+            }
+        }, response_status_code)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            initialization()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and scope['path'] == '/v1/chat/completions' and scope['method'] == 'POST':
+        return await chat_completions(scope, receive, send)
+
+    if (scope['type'] == 'http' and scope['path'] == '/metrics' and scope['method'] == 'GET'
+            and config_manager.get("METRICS.ENABLED", True)):
+        return await send_metrics(send)
+
+    return await wsgi_app(scope, receive, send)
@@ -0,0 +1,113 @@
+"""
+准入控制基准：上游替身同时只能处理 --capacity 个回复（超过的排队，延迟随之变长），
+同一令牌并发超过 --token-capacity 时返回429。客户端以固定速率发送请求（开环，不等前一个请求结束），
+速率超过上游容量时，对比关闭准入控制与按上游容量设置全局、单令牌上限时：
+成功请求的延迟分位数、被快速拒绝（503/429 且带 Retry-After）的请求数及其耗时、上游返回的429数。
+
+    python benchmarks/bench_admission.py --rate 100 --duration 10 --capacity 12
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_serving import ROOT, wait_port, percentile
+from bench_retry import upstream_stats
+
+
+async def one_request(port, index, timeout):
+    """返回 (状态码, 是否带有 Retry-After, 耗时)，连接失败或超时时状态码为None"""
+    body = json.dumps({"model": "grok-3", "stream": False, "messages": [{"role": "user", "content": f"load {index}"}]}).encode()
+    request = (
+        f"POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer sk-bench\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+    start = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+        try:
+            writer.write(request)
+            await writer.drain()
+            received = await asyncio.wait_for(reader.read(), timeout - (time.perf_counter() - start))
+        finally:
+            writer.close()
+    except (OSError, asyncio.TimeoutError):
+        return None, False, time.perf_counter() - start
+    head = received.split(b"\r\n\r\n", 1)[0].lower()
+    status = int(head.split(b" ", 2)[1]) if head.startswith(b"http/") else None
+    return status, b"\r\nretry-after:" in head, time.perf_counter() - start
+
+
+async def open_loop(port, rate, duration, timeout):
+    """按固定速率发送请求，不受之前请求是否完成的影响"""
+    tasks = []
+    start = time.perf_counter()
+    for index in range(int(rate * duration)):
+        delay = start + index / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one_request(port, index, timeout)))
+    return await asyncio.gather(*tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="准入控制基准")
+    parser.add_argument("--rate", type=float, default=100, help="每秒发送的请求数")
+    parser.add_argument("--duration", type=float, default=10, help="发送持续的秒数")
+    parser.add_argument("--capacity", type=int, default=12, help="上游同时处理的回复数")
+    parser.add_argument("--token-capacity", type=int, default=2, help="上游每个令牌的并发上限")
+    parser.add_argument("--sso", type=int, default=8, help="令牌数")
+    parser.add_argument("--queue-size", type=int, default=12)
+    parser.add_argument("--queue-timeout-ms", type=int, default=1000)
+    parser.add_argument("--mode", default="threaded")
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    upstream_port, proxy_port = 5300, 5201
+    configs = [
+        ("no admission", {}),
+        ("admission", {
+            "ADMISSION_MAX_IN_FLIGHT": str(args.capacity), "ADMISSION_PER_TOKEN": str(args.token_capacity),
+            "ADMISSION_QUEUE_SIZE": str(args.queue_size), "ADMISSION_QUEUE_TIMEOUT_MS": str(args.queue_timeout_ms)
+        })
+    ]
+    print(f"offered {args.rate:.0f} req/s for {args.duration:.0f}s, upstream capacity {args.capacity} "
+          f"(token {args.token_capacity}), {args.mode}")
+    print(f"{'config':<14}{'ok':>6}{'shed':>6}{'failed':>8}{'ok p50':>9}{'ok p99':>9}{'shed p99':>10}{'upstream 429':>14}")
+    for name, admission_env in configs:
+        # 每个回复20行、间隔10ms，单个回复约0.2秒
+        upstream = subprocess.Popen([
+            sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+            "--tokens", "20", "--interval", "0.01", "--capacity", str(args.capacity),
+            "--token-capacity", str(args.token_capacity)
+        ])
+        env = dict(os.environ, SERVER_MODE=args.mode, PORT=str(proxy_port), API_KEY="sk-bench", TOKEN_DATA_DIR="",
+                   SSO=",".join(f"bench{i}" for i in range(args.sso)), BASE_URL=f"http://127.0.0.1:{upstream_port}",
+                   LOG_LEVEL="ERROR", WSGI_WORKERS="256", RETRY_BUDGET="false", **admission_env)
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_port(upstream_port)
+            wait_port(proxy_port)
+            results = asyncio.run(open_loop(proxy_port, args.rate, args.duration, args.timeout))
+            ok = [elapsed for status, _, elapsed in results if status == 200]
+            # 快速拒绝：准入控制返回的503/429，带有 Retry-After
+            shed = [elapsed for status, retry_after, elapsed in results if status in (429, 503) and retry_after]
+            failed = len(results) - len(ok) - len(shed)
+            rejected = upstream_stats(upstream_port)["token_rejections"]
+            print(f"{name:<14}{len(ok):>6}{len(shed):>6}{failed:>8}{percentile(ok, 50):>8.2f}s{percentile(ok, 99):>8.2f}s"
+                  f"{percentile(shed, 99) if shed else 0:>9.3f}s{rejected:>14}")
+        finally:
+            server.terminate()
+            server.wait()
+            upstream.terminate()
+            upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+API Key 校验与配额检查的开销基准：原先与单个 API_KEY 比较字符串，对比在 --keys 个 Key 的注册表中查找并检查配额
+（不限制的 Key、按每分钟请求数的令牌桶、加上并发流名额的取用和归还），分别在单线程和多线程并发下测量。
+最后模拟一个占满配额的 Key 与其他 Key 同时请求，统计各 Key 的放行与拒绝次数。
+
+    python benchmarks/bench_api_keys.py --keys 1000 --iterations 200000 --threads 8
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_metrics import measure
+from api_keys import ApiKey, ApiKeyRegistry, QuotaExceeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API Key 配额检查开销基准")
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    keys = [ApiKey(f"sk-unlimited-{i}") for i in range(args.keys)]
+    keys += [ApiKey("sk-rpm", "rpm", rpm=10 ** 9), ApiKey("sk-streams", "streams", rpm=10 ** 9, streams=10 ** 6)]
+    registry = ApiKeyRegistry(keys, "sk-default")
+    single_key = "sk-default"
+    header = f"Bearer sk-unlimited-{args.keys // 2}"
+
+    def single_compare():
+        token = header.replace('Bearer ', '')
+        return token != single_key
+
+    def unlimited():
+        api_key, _ = registry.authenticate(header)
+        api_key.acquire("grok-3", False)
+
+    def rpm():
+        api_key, _ = registry.authenticate("Bearer sk-rpm")
+        api_key.acquire("grok-3", False)
+
+    def stream():
+        api_key, _ = registry.authenticate("Bearer sk-streams")
+        api_key.acquire("grok-3", True)
+        api_key.release_stream()
+
+    print(f"{'check':<28}{'1 thread':>12}{f'{args.threads} threads':>14}")
+    for name, func in (("single API_KEY compare", single_compare), ("registry, unlimited key", unlimited),
+                       ("registry, rpm bucket", rpm), ("registry, rpm + stream slot", stream)):
+        print(f"{name:<28}{measure(func, args.iterations, 1):>10.0f}ns"
+              f"{measure(func, args.iterations, args.threads):>12.0f}ns")
+
+    # 一个 Key 以远超配额的速度请求，其余 Key 正常请求，互不影响
+    noisy = ApiKey("sk-noisy", "noisy", rpm=600, burst=10)
+    quiet = [ApiKey(f"sk-quiet-{i}", f"quiet-{i}", rpm=600, burst=10) for i in range(3)]
+    registry = ApiKeyRegistry([noisy] + quiet)
+    counts = {api_key.name: [0, 0] for api_key in [noisy] + quiet}
+
+    def client(api_key, interval, duration):
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            try:
+                registry.authenticate(f"Bearer {api_key.key}")[0].acquire("grok-3", False)
+                counts[api_key.name][0] += 1
+            except QuotaExceeded:
+                counts[api_key.name][1] += 1
+            time.sleep(interval)
+
+    clients = [threading.Thread(target=client, args=(noisy, 0.0005, 2))]
+    clients += [threading.Thread(target=client, args=(api_key, 0.2, 2)) for api_key in quiet]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    print("\n2s at 600 rpm (burst 10) per key: noisy key floods, quiet keys send 5 req/s")
+    for name, (allowed, rejected) in counts.items():
+        print(f"{name:<10} allowed {allowed:>5}  rejected {rejected:>6}")
+
+
+if __name__ == "__main__":
+    main()
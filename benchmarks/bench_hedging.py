@@ -0,0 +1,130 @@
+"""
+对冲请求基准：上游替身让一小部分请求的首行额外变慢（长尾），对比关闭与开启 HEDGE 时
+客户端收到首个SSE帧的延迟分位数、对冲比例，以及实际发往上游和被中断的请求数。
+
+    python benchmarks/bench_hedging.py --requests 600 --concurrency 20 --slow-ratio 0.03 --slow-delay 2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_serving import ROOT, wait_port, percentile
+
+
+def upstream_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.loads(response.read())
+
+
+def hedge_stats(port):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/manager/api/hedge", headers={"X-Admin-Key": "sk-bench"})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+async def one_request(port, model, index, timeout):
+    body = json.dumps({"model": model, "stream": True, "messages": [{"role": "user", "content": f"hedge {index}"}]}).encode()
+    request = (
+        f"POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer sk-bench\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+    start = time.perf_counter()
+    ttfb = None
+    received = b""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port, limit=1 << 20), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        while True:
+            data = await asyncio.wait_for(reader.read(65536), timeout)
+            if not data:
+                break
+            received += data
+            if ttfb is None and b"data: {" in received:
+                ttfb = time.perf_counter() - start
+    finally:
+        writer.close()
+    return b"[DONE]" in received, ttfb
+
+
+async def run_load(port, model, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            return await one_request(port, model, index, args.timeout)
+
+    results = await asyncio.gather(*(limited(i) for i in range(args.requests)), return_exceptions=True)
+    ok = [result for result in results if not isinstance(result, BaseException) and result[0]]
+    return len(ok), len(results) - len(ok), [result[1] for result in ok]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对冲请求基准")
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asgi"])
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument("--first-byte-delay", type=float, default=0.1)
+    parser.add_argument("--slow-ratio", type=float, default=0.03)
+    parser.add_argument("--slow-delay", type=float, default=2.0)
+    parser.add_argument("--delay-ms", type=int, default=0, help="固定对冲延迟，0为学习p95")
+    parser.add_argument("--sso", type=int, default=16, help="可用令牌数")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    upstream_port, proxy_port = 5300, 5201
+    upstream = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+        "--tokens", str(args.tokens), "--interval", str(args.interval), "--first-byte-delay", str(args.first_byte_delay),
+        "--slow-ratio", str(args.slow_ratio), "--slow-delay", str(args.slow_delay), "--seed", str(args.seed)
+    ])
+    try:
+        wait_port(upstream_port)
+        print(f"{'mode':<10}{'hedge':<7}{'ok':>6}{'failed':>8}{'upstream':>10}{'aborted':>9}{'hedged':>8}"
+              f"{'rate':>7}{'delay':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+        for mode in args.modes:
+            for enabled in (False, True):
+                env = dict(os.environ, SERVER_MODE=mode, PORT=str(proxy_port), API_KEY="sk-bench",
+                           ADMIN_KEY="sk-bench", SSO=",".join(f"bench{i}" for i in range(args.sso)),
+                           TOKEN_DATA_DIR="", BASE_URL=f"http://127.0.0.1:{upstream_port}", LOG_LEVEL="ERROR",
+                           HEDGE="true" if enabled else "false", HEDGE_DELAY_MS=str(args.delay_ms),
+                           WSGI_WORKERS=str(args.concurrency * 2))
+                server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    wait_port(proxy_port)
+                    before = upstream_stats(upstream_port)
+                    ok, failed, ttfbs = asyncio.run(run_load(proxy_port, args.model, args))
+                    # 等待被中断的落败请求在上游替身上结束后再统计
+                    time.sleep(args.slow_delay + 0.5)
+                    after = upstream_stats(upstream_port)
+                    stats = hedge_stats(proxy_port)
+                    print(f"{mode:<10}{'on' if enabled else 'off':<7}{ok:>6}{failed:>8}"
+                          f"{after['requests'] - before['requests']:>10}{after['aborted'] - before['aborted']:>9}"
+                          f"{stats['hedged']:>8}{stats['hedge_rate']:>7.1%}{stats['delay_ms']:>7.0f}ms"
+                          f"{percentile(ttfbs, 50):>8.2f}s{percentile(ttfbs, 95):>8.2f}s{percentile(ttfbs, 99):>8.2f}s")
+                    if enabled:
+                        print(f"{'':<17}p99 saved: {stats['p99_saved_ms']:.0f}ms "
+                              f"(unhedged p99 {stats['unhedged_ttfb_p99_ms']:.0f}ms -> {stats['ttfb_p99_ms']:.0f}ms), "
+                              f"hedge wins {stats['hedge_wins']}, skipped {stats['skipped']}")
+                finally:
+                    server.terminate()
+                    server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+端到端压测：启动本地上游替身（fake_grok.py）和指向它的代理服务（BASE_URL），
+对每个模型分别发送流式和非流式请求，统计吞吐、首字节时间（流式为首个SSE帧，非流式为响应的首个字节）
+以及总耗时的 p50/p95/p99。流式请求以收到 [DONE] 且没有错误帧为成功，非流式以200且有回复内容为成功。
+
+    python benchmarks/bench_load.py --requests 200 --concurrency 20
+    python benchmarks/bench_load.py --server-mode asgi --tools --fail-ratio 0.05 --fault 429
+    python benchmarks/bench_load.py --target 5200   # 压测已在运行的服务（其 BASE_URL 需自行指向上游替身）
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_serving import ROOT, wait_port, percentile
+from fake_grok import FAULTS
+
+MODELS = ("grok-3", "grok-4", "grok-4-fast")
+
+
+async def one_request(port, model, stream, index, api_key, timeout):
+    """返回 (是否成功, 首字节时间, 总耗时)"""
+    body = json.dumps({
+        "model": model, "stream": stream, "messages": [{"role": "user", "content": f"load test {index}"}]
+    }).encode()
+    request = (
+        f"POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer {api_key}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+    start = time.perf_counter()
+    ttfb = None
+    chunks = []
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port, limit=1 << 20), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        while True:
+            data = await asyncio.wait_for(reader.read(65536), timeout)
+            if not data:
+                break
+            chunks.append(data)
+            if ttfb is None and (not stream or b"data:" in data):
+                ttfb = time.perf_counter() - start
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    received = b"".join(chunks)
+    head, _, payload = received.partition(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 200") and not head.startswith(b"HTTP/1.0 200"):
+        return False, ttfb, elapsed
+    if stream:
+        return b"[DONE]" in payload and b'"error"' not in payload, ttfb, elapsed
+    return b'"content"' in payload, ttfb, elapsed
+
+
+async def run_load(port, model, stream, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            return await one_request(port, model, stream, index, args.api_key, args.timeout)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited(i) for i in range(args.requests)), return_exceptions=True)
+    wall = time.perf_counter() - start
+    ok = [result for result in results if not isinstance(result, BaseException) and result[0]]
+    return ok, args.requests - len(ok), wall
+
+
+def start_stack(args):
+    """启动上游替身和代理服务，返回 (代理端口, 需要结束的进程)"""
+    upstream_port, proxy_port = 5300, 5201
+    upstream_args = [
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+        "--tokens", str(args.tokens), "--interval", str(args.interval), "--first-byte-delay", str(args.first_byte_delay),
+        "--fail-ratio", str(args.fail_ratio), "--fault", args.fault, "--error-ratio", str(args.error_ratio)
+    ]
+    if args.tools:
+        upstream_args.append("--tools")
+    upstream = subprocess.Popen(upstream_args)
+    env = dict(os.environ, SERVER_MODE=args.server_mode, PORT=str(proxy_port), API_KEY=args.api_key, TOKEN_DATA_DIR="",
+               SSO=",".join(f"bench{i}" for i in range(args.sso)), BASE_URL=f"http://127.0.0.1:{upstream_port}",
+               LOG_LEVEL="ERROR", WSGI_WORKERS=str(max(10, args.concurrency * 2)))
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    processes = [server, upstream]
+    try:
+        wait_port(upstream_port)
+        wait_port(proxy_port, timeout=60)
+    except RuntimeError:
+        stop(processes)
+        raise
+    return proxy_port, processes
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测")
+    parser.add_argument("--requests", type=int, default=200, help="每个模型、每种模式的请求数")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--models", nargs="+", default=list(MODELS))
+    parser.add_argument("--modes", nargs="+", choices=("stream", "non-stream"), default=["stream", "non-stream"])
+    parser.add_argument("--server-mode", default="threaded", help="代理服务的 SERVER_MODE（threaded/asgi）")
+    parser.add_argument("--target", type=int, default=0, help="压测已在运行的服务的端口，不再启动上游替身和服务")
+    parser.add_argument("--api-key", default="sk-bench")
+    parser.add_argument("--sso", type=int, default=16, help="令牌数")
+    parser.add_argument("--timeout", type=float, default=120)
+    # 上游替身的参数，见 fake_grok.py
+    parser.add_argument("--tokens", type=int, default=100, help="每次回复的token行数")
+    parser.add_argument("--interval", type=float, default=0.01, help="相邻token行之间的间隔（秒）")
+    parser.add_argument("--first-byte-delay", type=float, default=0.1, help="首行前的延迟（秒）")
+    parser.add_argument("--fail-ratio", type=float, default=0.0)
+    parser.add_argument("--fault", choices=FAULTS, default="503")
+    parser.add_argument("--error-ratio", type=float, default=0.0)
+    parser.add_argument("--tools", action="store_true")
+    args = parser.parse_args()
+
+    if args.target:
+        port, processes = args.target, []
+    else:
+        port, processes = start_stack(args)
+    try:
+        # 预热：建立上游连接，避免首批请求计入建连耗时
+        asyncio.run(run_load(port, args.models[0], False, argparse.Namespace(**{**vars(args), "requests": args.concurrency})))
+        print(f"{'model':<13}{'mode':<12}{'ok':>6}{'failed':>8}{'req/s':>9}"
+              f"{'ttfb p50':>10}{'p95':>8}{'p99':>8}{'total p50':>11}{'p95':>8}{'p99':>8}")
+        for model in args.models:
+            for mode in args.modes:
+                ok, failed, wall = asyncio.run(run_load(port, model, mode == "stream", args))
+                ttfb = [result[1] for result in ok if result[1] is not None]
+                total = [result[2] for result in ok]
+                print(f"{model:<13}{mode:<12}{len(ok):>6}{failed:>8}{len(ok) / wall:>9.1f}"
+                      f"{percentile(ttfb, 50):>9.3f}s{percentile(ttfb, 95):>7.3f}s{percentile(ttfb, 99):>7.3f}s"
+                      f"{percentile(total, 50):>10.3f}s{percentile(total, 95):>7.3f}s{percentile(total, 99):>7.3f}s")
+    finally:
+        stop(processes)
+
+
+if __name__ == "__main__":
+    main()
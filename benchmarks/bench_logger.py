@@ -0,0 +1,118 @@
+"""
+日志开销基准：原先每次调用都先用 inspect 获取调用位置并拼接 f-string，再由 loguru 按级别丢弃；
+对比在入口处按级别短路、消息参数延迟格式化的 logger.Logger。
+分别测量被级别过滤掉的调用，以及实际输出时同步写出与后台线程写出（LOG_ENQUEUE）的调用方耗时。
+
+    python benchmarks/bench_logger.py --iterations 100000
+"""
+import os
+import sys
+import time
+import inspect
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from loguru import logger as loguru_logger
+from logger import logger, LEVELS, TEXT_FORMAT, QueuedStream
+
+LEGACY_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
+    "<level>{message}</level>"
+)
+
+
+def legacy_caller_info():
+    frame = inspect.currentframe()
+    try:
+        caller_frame = frame.f_back.f_back
+        return {
+            'filename': os.path.basename(caller_frame.f_code.co_filename),
+            'function': caller_frame.f_code.co_name,
+            'lineno': caller_frame.f_lineno
+        }
+    finally:
+        del frame
+
+
+def legacy_info(message, source="API"):
+    caller_info = legacy_caller_info()
+    loguru_logger.bind(**caller_info).info(f"[{source}] {message}")
+
+
+def noop(message, source="API", *args):
+    pass
+
+
+def time_calls(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+class SlowStream:
+    """模拟写出较慢的终端或日志采集管道，每次写入耗时固定"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def write(self, message):
+        end = time.perf_counter() + self.delay
+        while time.perf_counter() < end:
+            pass
+
+    def flush(self):
+        pass
+
+
+def configure(level, stream, legacy=False, enqueue=False):
+    """重新配置 loguru，只测量调用方的开销"""
+    loguru_logger.remove()
+    if legacy:
+        loguru_logger.add(stream, level=level, format=LEGACY_FORMAT, colorize=True, backtrace=True, diagnose=True)
+        return
+    sink = QueuedStream(stream) if enqueue else stream
+    logger.handler_ids = [loguru_logger.add(sink, level=level, format=TEXT_FORMAT, colorize=True, diagnose=False)]
+    logger.level_no = LEVELS[level]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日志开销基准")
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--slow-us", type=int, default=200, help="慢速流每次写入的耗时（微秒）")
+    args = parser.parse_args()
+
+    token = "sso-rw=eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.bench;sso=eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.bench"
+    status_code = 200
+    iterations = args.iterations
+
+    print(f"{'case':<34}{'legacy':>12}{'current':>12}{'speedup':>10}")
+    devnull = open(os.devnull, "w")
+
+    # 参照：调用一个同样签名、什么都不做的函数
+    baseline = time_calls(lambda: noop("当前令牌: {}...", "Server", token[:50]), iterations)
+    print(f"{'no-op call with same arguments':<34}{'':>12}{baseline:>10.0f}ns")
+
+    configure("ERROR", devnull, legacy=True)
+    before = time_calls(lambda: legacy_info(f"当前令牌: {token[:50]}...", "Server"), iterations)
+    configure("ERROR", devnull)
+    after = time_calls(lambda: logger.info("当前令牌: {}...", "Server", token[:50]), iterations)
+    print(f"{'disabled info (LOG_LEVEL=ERROR)':<34}{before:>10.0f}ns{after:>10.0f}ns{before / after:>9.0f}x")
+
+    # 实际输出：/dev/null 代表写出几乎无代价，慢速流代表终端或日志管道存在背压
+    for name, stream in (("/dev/null", devnull), (f"{args.slow_us}us/write stream", SlowStream(args.slow_us / 1e6))):
+        configure("INFO", stream, legacy=True)
+        before = time_calls(lambda: legacy_info(f"请求状态码: {status_code}", "Server"), iterations // 20)
+        for enqueue in (False, True):
+            configure("INFO", stream, enqueue=enqueue)
+            after = time_calls(lambda: logger.info("请求状态码: {}", "Server", status_code), iterations // 20)
+            case = f"enabled, {'queued' if enqueue else 'sync'}, {name}"
+            print(f"{case:<34}{before:>10.0f}ns{after:>10.0f}ns{before / after:>9.1f}x")
+    loguru_logger.remove()
+
+
+if __name__ == "__main__":
+    main()
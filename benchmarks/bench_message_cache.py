@@ -0,0 +1,83 @@
+"""
+历史消息缓存基准：模拟客户端每轮重发完整历史的多轮对话，统计每轮拼接消息的耗时，
+对比关闭与开启规范化缓存，并输出缓存命中率和每条消息的规范化/摘要耗时。两种情况下每轮的拼接结果应一致。
+
+    python benchmarks/bench_message_cache.py --turns 100 --size 4000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import MessageProcessor
+from message_cache import NormalizationCache, content_key
+import message_processor
+
+
+def build_history(turns, size, seed):
+    rng = random.Random(seed)
+    words = ["grok", "token", "stream", "你好", "世界", "latency", "cache", "proxy", "\n"]
+
+    def paragraph():
+        return " ".join(rng.choice(words) for _ in range(size // 6))
+
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for _ in range(turns):
+        messages.append({"role": "user", "content": [{"type": "text", "text": paragraph()}]})
+        messages.append({"role": "assistant", "content": f"<think>{paragraph()}</think>\n{paragraph()}"})
+    return messages
+
+
+def replay(history, turns, cache):
+    """第 n 轮发送前 n 轮的全部消息，返回总耗时、最后一轮耗时和每轮的结果"""
+    message_processor.normalization_cache = cache
+    outputs = []
+    total = last = 0.0
+    for turn in range(1, turns + 1):
+        messages = history[:2 * turn]
+        start = time.perf_counter()
+        outputs.append(MessageProcessor.flatten_messages(messages))
+        last = time.perf_counter() - start
+        total += last
+    return total, last, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="历史消息缓存基准")
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--size", type=int, default=4000, help="每条消息的字符数")
+    parser.add_argument("--max-mb", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    history = build_history(args.turns, args.size, args.seed)
+    uncached_total, uncached_last, expected = replay(history, args.turns, NormalizationCache(0))
+    cache = NormalizationCache(args.max_mb * 1024 * 1024)
+    cached_total, cached_last, outputs = replay(history, args.turns, cache)
+    assert outputs == expected, "开启缓存后拼接结果不一致"
+
+    print(f"{'mode':<10}{'total':>12}{'last turn':>12}")
+    print(f"{'uncached':<10}{uncached_total * 1000:>10.1f}ms{uncached_last * 1000:>10.2f}ms")
+    print(f"{'cached':<10}{cached_total * 1000:>10.1f}ms{cached_last * 1000:>10.2f}ms")
+    print(f"speedup: total {uncached_total / cached_total:.1f}x, last turn {uncached_last / cached_last:.1f}x")
+    print(f"cache: {cache.get_stats()}")
+
+    # 缓存只有在摘要比规范化本身便宜时才有收益
+    count = 2000
+    for name, content in (("user", history[1]["content"]), ("assistant", history[2]["content"])):
+        start = time.perf_counter()
+        for _ in range(count):
+            MessageProcessor.process_content(content)
+        normalize = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(count):
+            content_key(content)
+        digest = time.perf_counter() - start
+        print(f"{name:<10} normalize {normalize / count * 1e6:.1f}us  digest {digest / count * 1e6:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+消息拼接基准：原先 += 合并同角色消息并每次重建整段字符串、两条正则处理思考标签和base64图片，
+对比单次遍历的 MessageProcessor.flatten_messages。两种实现的输出会先做一致性检查。
+
+    python benchmarks/bench_message_flatten.py --turns 200 --image-kb 2048
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import MessageProcessor, normalization_cache
+
+
+def legacy_remove_think_tags(text):
+    if not isinstance(text, str):
+        return text
+    text = re.sub(r'<think>[\s\S]*?<\/think>', '', text).strip()
+    text = re.sub(r'!\[image]\(data:.*?base64,.*?\)', '[图片]', text)
+    return text
+
+
+def legacy_process_content(content):
+    if isinstance(content, list):
+        text_content = ''
+        for item in content:
+            if item["type"] == 'image_url':
+                text_content += ("[图片]" if not text_content else '\n[图片]')
+            elif item["type"] == 'text':
+                processed_text = legacy_remove_think_tags(item["text"])
+                text_content += (processed_text if not text_content else '\n' + processed_text)
+        return text_content
+    elif isinstance(content, dict) and content is not None:
+        if content["type"] == 'image_url':
+            return "[图片]"
+        elif content["type"] == 'text':
+            return legacy_remove_think_tags(content["text"])
+    return legacy_remove_think_tags(content if isinstance(content, str) else None)
+
+
+def legacy_flatten(messages):
+    processed_messages = []
+    last_role = None
+    last_content = ''
+    for current in messages:
+        role = 'assistant' if current["role"] == 'assistant' else 'user'
+        text_content = legacy_process_content(current.get("content", ""))
+        if text_content:
+            if role == last_role and last_content:
+                last_content += '\n' + text_content
+                processed_messages[-1] = f"{role.upper()}: {last_content}"
+            else:
+                processed_messages.append(f"{role.upper()}: {text_content}")
+                last_content = text_content
+                last_role = role
+    return '\n'.join(processed_messages)
+
+
+def paragraph(rng, size):
+    words = ["grok", "token", "stream", "你好", "世界", "latency", "cache", "proxy"]
+    return " ".join(rng.choice(words) for _ in range(size // 6))
+
+
+def build_turns(turns, size, seed):
+    """多轮对话：助手回复带思考内容，连续多条用户消息（同角色合并）"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        if i % 3 == 2:
+            messages.append({"role": "assistant", "content": f"<think>{paragraph(rng, size // 2)}</think>\n{paragraph(rng, size)}"})
+        else:
+            messages.append({"role": "user", "content": [{"type": "text", "text": paragraph(rng, size)}]})
+    return messages
+
+
+def build_same_role(turns, size, seed):
+    """极端情况：全部为同一角色的消息"""
+    rng = random.Random(seed)
+    return [{"role": "user", "content": paragraph(rng, size)} for _ in range(turns)]
+
+
+def build_images(images, image_kb, seed):
+    """历史消息中内嵌大段base64图片（markdown链接和 image_url 两种形式）"""
+    rng = random.Random(seed)
+    blob = "A" * (image_kb * 1024)
+    messages = []
+    for i in range(images):
+        messages.append({"role": "user", "content": [
+            {"type": "text", "text": f"看看这张图 {i}"},
+            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{blob}"}}
+        ]})
+        messages.append({"role": "assistant", "content": f"{paragraph(rng, 200)}\n![image](data:image/png;base64,{blob})\n完成"})
+    return messages
+
+
+def best_time(func, messages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(messages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息拼接基准")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--size", type=int, default=2000, help="每条消息的字符数")
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--image-kb", type=int, default=2048, help="每张base64图片的大小（KB）")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # 只比较拼接本身，关闭历史消息缓存（见 bench_message_cache.py）
+    normalization_cache.max_bytes = 0
+
+    cases = [
+        (f"{args.turns}-turn", build_turns(args.turns, args.size, args.seed)),
+        (f"{args.turns * 5} same-role", build_same_role(args.turns * 5, args.size, args.seed)),
+        (f"{args.images} images", build_images(args.images, args.image_kb, args.seed))
+    ]
+    print(f"{'conversation':<18}{'input':>10}{'legacy':>12}{'current':>12}{'speedup':>10}")
+    for name, messages in cases:
+        size = sum(len(str(message["content"])) for message in messages)
+        before, expected = best_time(legacy_flatten, messages, args.repeat)
+        after, output = best_time(MessageProcessor.flatten_messages, messages, args.repeat)
+        assert output == expected, f"{name} 输出不一致"
+        print(f"{name:<18}{size / 1024 / 1024:>8.1f}MB{before * 1000:>10.1f}ms{after * 1000:>10.1f}ms{before / after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+指标记录开销基准：单次计数器自增、直方图记录，以及一次对话请求在请求路径上的全部指标记录，
+分别在单线程和多线程并发下测量；另外测量 /metrics 在大量令牌标签下生成文本的耗时。
+
+    python benchmarks/bench_metrics.py --iterations 200000 --threads 8 --tokens 10000
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import ServiceMetrics
+
+
+class FakeResponse:
+    status_code = 200
+    connect_time = None
+
+    def __init__(self):
+        self.started_at = time.monotonic() - 0.3
+        self.first_line_at = self.started_at + 0.2
+
+
+def one_request(metrics, token, response):
+    """一次流式对话请求在请求路径上的全部指标记录"""
+    started = metrics.request_started()
+    metrics.record_upstream_response(token, None, response)
+    metrics.first_byte.observe(time.monotonic() - started, "grok-3")
+    metrics.record_upstream_stream("grok-3", response, 200)
+    metrics.request_finished("grok-3", True, started, 200)
+
+
+def measure(func, iterations, threads):
+    """返回每次调用的平均耗时（纳秒），多线程时为总耗时除以总调用次数"""
+    per_thread = iterations // threads
+
+    def run():
+        for _ in range(per_thread):
+            func()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (per_thread * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="指标记录开销基准")
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=10000, help="/metrics 中按令牌区分的序列数")
+    args = parser.parse_args()
+
+    metrics = ServiceMetrics()
+    response = FakeResponse()
+    token = "sso-rw=bench;sso=bench"
+    cases = [
+        ("noop call", lambda: None),
+        ("counter.inc", lambda: metrics.requests.inc("grok-3", "200", "true")),
+        ("histogram.observe", lambda: metrics.first_byte.observe(0.3, "grok-3")),
+        ("upstream response", lambda: metrics.record_upstream_response(token, None, response)),
+        ("per request (all)", lambda: one_request(metrics, token, response))
+    ]
+    print(f"{'operation':<20}{'1 thread':>12}{f'{args.threads} threads':>14}")
+    for name, func in cases:
+        single = measure(func, args.iterations, 1)
+        concurrent = measure(func, args.iterations, args.threads)
+        print(f"{name:<20}{single:>10.0f}ns{concurrent:>12.0f}ns")
+
+    for i in range(args.tokens):
+        metrics.record_upstream_response(f"sso-rw=t{i};sso=t{i}", None, response)
+    start = time.perf_counter()
+    body = metrics.render()
+    elapsed = time.perf_counter() - start
+    print(f"render with {args.tokens} token series: {elapsed * 1000:.1f}ms, {len(body) / 1024:.0f}KB")
+
+
+if __name__ == "__main__":
+    main()
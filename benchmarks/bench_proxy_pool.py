@@ -0,0 +1,73 @@
+"""
+代理池基准：用多个上游替身充当代理（一个始终返回403、其余首行延迟各不相同），
+对比只配置一个代理、代理池按令牌固定（STICKY）以及代理池选择最快健康代理时，
+客户端的成功率、延迟分位数，以及各代理实际承担的请求数。
+
+    python benchmarks/bench_proxy_pool.py --requests 400 --concurrency 20
+"""
+import os
+import sys
+import asyncio
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_serving import ROOT, wait_port, percentile
+from bench_retry import run_load, upstream_stats
+
+# (端口, 首行延迟秒, 是否始终返回403)
+PROXIES = [(5401, 0.0, True), (5402, 0.6, False), (5403, 0.2, False), (5404, 0.05, False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="代理池基准")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mode", default="threaded")
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--sso", type=int, default=16, help="令牌数")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    proxy_port = 5201
+    urls = [f"http://127.0.0.1:{port}" for port, _, _ in PROXIES]
+    configs = [
+        ("single proxy", {"PROXY": urls[0]}),
+        ("pool sticky", {"PROXY": ",".join(urls), "PROXY_STICKY": "true"}),
+        ("pool fastest", {"PROXY": ",".join(urls), "PROXY_STICKY": "false"}),
+    ]
+    print(f"{'config':<14}{'ok':>6}{'failed':>8}{'p50':>9}{'p99':>9}  requests per proxy (403 / 0.6s / 0.2s / 0.05s)")
+    for name, proxy_env in configs:
+        # 充当代理的上游替身直接响应代理请求（请求行为绝对地址，替身不区分路径）
+        proxies = [
+            subprocess.Popen([
+                sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(port),
+                "--tokens", "20", "--interval", "0.002", "--first-byte-delay", str(delay),
+                "--fail-ratio", "1" if banned else "0", "--fault", "403"
+            ])
+            for port, delay, banned in PROXIES
+        ]
+        env = dict(os.environ, SERVER_MODE=args.mode, PORT=str(proxy_port), API_KEY="sk-bench",
+                   SSO=",".join(f"bench{i}" for i in range(args.sso)), TOKEN_DATA_DIR="",
+                   BASE_URL="http://upstream.invalid", LOG_LEVEL="ERROR", WSGI_WORKERS=str(args.concurrency * 2),
+                   **proxy_env)
+        server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for port, _, _ in PROXIES:
+                wait_port(port)
+            wait_port(proxy_port)
+            ok, failed, latencies = asyncio.run(run_load(proxy_port, args.model, args))
+            counts = " / ".join(str(upstream_stats(port)["requests"]) for port, _, _ in PROXIES)
+            print(f"{name:<14}{ok:>6}{failed:>8}{percentile(latencies, 50):>8.2f}s{percentile(latencies, 99):>8.2f}s  {counts}")
+        finally:
+            server.terminate()
+            server.wait()
+            for process in proxies:
+                process.terminate()
+                process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+上游录制回放基准：把 UPSTREAM_RECORD 录制的真实上游响应（见 upstream_recorder.py）送入
+handle_stream_response / handle_non_stream_response（--mode async 时为异步版本），
+统计每条录制的处理耗时、CPU耗时和吞吐，可按原始时间（--speed 1）或以最快速度（--speed 0）回放。
+
+每种处理方式输出客户端可见内容的摘要（流式为拼接后的 delta 文本和错误帧，非流式为 message.content），
+修改解析或过滤逻辑前后对同一份录制运行，摘要不同即输出有变化，--diff 打印有变化的录制的内容。
+
+    UPSTREAM_RECORD=true python app.py   # 录制到 data/recordings
+    python benchmarks/bench_replay.py data/recordings --repeat 5
+    python benchmarks/bench_replay.py data/recordings --mode async --speed 1 --concurrency 20 --coalesce
+    python benchmarks/bench_replay.py data/recordings --save before.json; python benchmarks/bench_replay.py data/recordings --diff before.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_serving import percentile
+from config import config_manager
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+from upstream_recorder import load_recordings, ReplayResponse, AsyncReplayResponse
+
+
+def stream_content(frames):
+    """客户端从SSE帧中拼出的内容；错误帧原样保留，便于发现错误处理的变化"""
+    parts = []
+    for frame in frames:
+        payload = frame[6:].strip()
+        if payload == "[DONE]":
+            continue
+        chunk = json.loads(payload)
+        if "error" in chunk:
+            parts.append(json.dumps(chunk["error"], ensure_ascii=False))
+        else:
+            parts.append(chunk["choices"][0]["delta"].get("content") or "")
+    return "".join(parts)
+
+
+def replay_sync(handler, recording, handler_type, speed, coalesce):
+    response = ReplayResponse(recording, speed)
+    if handler_type == "stream":
+        return stream_content(list(handler.handle_stream_response(response, recording.model, coalesce)))
+    return handler.handle_non_stream_response(response, recording.model)["choices"][0]["message"]["content"]
+
+
+async def replay_async(handler, recording, handler_type, speed, coalesce):
+    response = AsyncReplayResponse(recording, speed)
+    if handler_type == "stream":
+        frames = [frame async for frame in handler.handle_stream_response_async(response, recording.model, coalesce)]
+        return stream_content(frames)
+    result = await handler.handle_non_stream_response_async(response, recording.model)
+    return result["choices"][0]["message"]["content"]
+
+
+def timed_sync(handler, recording, handler_type, args, coalesce):
+    start = time.perf_counter()
+    content = replay_sync(handler, recording, handler_type, args.speed, coalesce)
+    return content, time.perf_counter() - start
+
+
+async def timed_async(handler, recording, handler_type, args, coalesce):
+    start = time.perf_counter()
+    content = await replay_async(handler, recording, handler_type, args.speed, coalesce)
+    return content, time.perf_counter() - start
+
+
+def run(handler, recordings, handler_type, args, coalesce):
+    """回放所有录制 --repeat 次，返回 (每条录制的输出, 每次处理耗时, 总耗时, CPU耗时)"""
+    jobs = [recording for _ in range(args.repeat) for recording in recordings]
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    if args.mode == "sync":
+        if args.concurrency > 1:
+            with ThreadPoolExecutor(args.concurrency) as executor:
+                results = list(executor.map(lambda recording: timed_sync(handler, recording, handler_type, args, coalesce), jobs))
+        else:
+            results = [timed_sync(handler, recording, handler_type, args, coalesce) for recording in jobs]
+    else:
+        async def main():
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def limited(recording):
+                async with semaphore:
+                    return await timed_async(handler, recording, handler_type, args, coalesce)
+
+            return await asyncio.gather(*(limited(recording) for recording in jobs))
+        results = asyncio.run(main())
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    return [content for content, _ in results[:len(recordings)]], [elapsed for _, elapsed in results], wall, cpu
+
+
+def digest(recordings, contents):
+    hasher = hashlib.sha256()
+    for recording, content in zip(recordings, contents):
+        hasher.update(f"{recording.model}\0{content}\0".encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()[:16]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上游录制回放基准")
+    parser.add_argument("paths", nargs="+", help="录制文件或目录")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--handlers", nargs="+", choices=("stream", "non-stream"), default=["stream", "non-stream"])
+    parser.add_argument("--speed", type=float, default=0, help="回放速度倍数，1为原始时间，0为最快速度")
+    parser.add_argument("--repeat", type=int, default=1, help="每条录制回放的次数")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--models", nargs="+", help="只回放这些模型的录制")
+    parser.add_argument("--coalesce", action="store_true", help="流式处理开启SSE分片合并（使用 STREAM_COALESCE_* 配置）")
+    parser.add_argument("--save", help="把每条录制的输出保存为JSON文件，供之后 --diff 比较")
+    parser.add_argument("--diff", help="与 --save 保存的输出比较，打印有变化的录制")
+    args = parser.parse_args()
+
+    recordings = [recording for recording in load_recordings(args.paths)
+                  if recording.status == 200 and (not args.models or recording.model in args.models)]
+    if not recordings:
+        sys.exit("没有可回放的录制")
+    coalesce = (config_manager.get("STREAM.COALESCE_BYTES", 256), config_manager.get("STREAM.COALESCE_MS", 20) / 1000) \
+        if args.coalesce else None
+    lines = sum(len(recording.lines) for recording in recordings) * args.repeat
+    size = sum(recording.size for recording in recordings) * args.repeat
+    models = sorted({recording.model for recording in recordings})
+    print(f"{len(recordings)} recordings ({', '.join(models)}), {lines // args.repeat} lines, "
+          f"{size / args.repeat / 1024:.0f} KiB upstream; mode {args.mode}, speed {args.speed or 'max'}, "
+          f"repeat {args.repeat}, concurrency {args.concurrency}")
+
+    handler = RequestHandler(AuthTokenManager())
+    outputs = {}
+    print(f"{'handler':<12}{'lines/s':>10}{'MiB/s':>8}{'cpu':>9}{'p50':>10}{'p99':>10}{'max':>10}  digest")
+    for handler_type in args.handlers:
+        contents, elapsed, wall, cpu = run(handler, recordings, handler_type, args, coalesce)
+        outputs[handler_type] = contents
+        print(f"{handler_type:<12}{lines / wall:>10.0f}{size / wall / 1024 / 1024:>8.1f}{cpu * 1000:>7.0f}ms"
+              f"{percentile(elapsed, 50) * 1000:>8.2f}ms{percentile(elapsed, 99) * 1000:>8.2f}ms"
+              f"{max(elapsed) * 1000:>8.2f}ms  {digest(recordings, contents)}")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(outputs, f, ensure_ascii=False)
+    if args.diff:
+        with open(args.diff, encoding="utf-8") as f:
+            previous = json.load(f)
+        for handler_type, contents in outputs.items():
+            before = previous.get(handler_type)
+            if before is None or len(before) != len(contents):
+                print(f"{handler_type}: 录制数不一致，无法比较")
+                continue
+            changed = [i for i, (old, new) in enumerate(zip(before, contents)) if old != new]
+            print(f"{handler_type}: {len(changed)}/{len(contents)} 条录制的输出有变化")
+            for i in changed:
+                print(f"  #{i} {recordings[i].model}\n    before: {before[i]!r}\n    after:  {contents[i]!r}")
+
+
+if __name__ == "__main__":
+    main()
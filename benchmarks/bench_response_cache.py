@@ -0,0 +1,62 @@
+"""
+响应缓存微基准：进程内测量非流式请求命中缓存时 make_chat_request 的耗时
+（构造请求体、计算摘要、查表），命中路径不应选取令牌。
+
+    python benchmarks/bench_response_cache.py --entries 10000 --lookups 20000
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+from response_cache import ResponseCache, make_key, HIT
+
+
+class NoTokenManager(AuthTokenManager):
+    def get_next_token_for_model(self, model_id):
+        raise AssertionError("缓存命中时不应选取令牌")
+
+
+def build_request(i, size):
+    prompt = f"Classify the sentiment of review #{i}: " + "great product, fast shipping. " * (size // 32)
+    return {"model": "grok-3", "stream": False, "messages": [
+        {"role": "system", "content": "Answer with positive, negative or neutral."},
+        {"role": "user", "content": prompt}
+    ]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="响应缓存微基准")
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=512, help="提示词的字符数")
+    args = parser.parse_args()
+
+    handler = RequestHandler(NoTokenManager())
+    handler.response_cache = ResponseCache(True, 300, 256 * 1024 * 1024)
+    requests = [build_request(i, args.size) for i in range(args.entries)]
+    for i, data in enumerate(requests):
+        key = make_key(data["model"], handler._build_request_body(data, data["model"]))
+        handler.response_cache.put(key, {"choices": [{"message": {"role": "assistant", "content": f"positive {i}"}}]})
+
+    latencies = []
+    for i in range(args.lookups):
+        data = requests[i % args.entries]
+        start = time.perf_counter()
+        response, status = handler.make_chat_request(data, data["model"], False)
+        latencies.append(time.perf_counter() - start)
+        assert status == HIT and response["choices"][0]["message"]["content"] == f"positive {i % args.entries}"
+
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6
+    print(f"entries={args.entries} prompt={args.size} chars")
+    print(f"hit latency: p50 {pick(0.5):.1f}us  p99 {pick(0.99):.1f}us  max {latencies[-1] * 1e6:.1f}us")
+    print(f"cache: {handler.response_cache.get_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+重试策略基准：上游替身注入故障（部分5xx、连接被重置、部分令牌失效、整体故障），
+对比只有重试、加上重试预算、再加上熔断器三种配置下客户端的成功率、延迟，
+以及实际发往上游的请求数相对客户端请求数的放大倍数。
+
+    python benchmarks/bench_retry.py --requests 400 --concurrency 20
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_serving import ROOT, wait_port, percentile
+
+CONFIGS = [
+    ("retry only", {"RETRY_BUDGET": "false", "RETRY_BREAKER": "false"}),
+    ("+budget", {"RETRY_BUDGET": "true", "RETRY_BREAKER": "false"}),
+    ("+breaker", {"RETRY_BUDGET": "true", "RETRY_BREAKER": "true"}),
+]
+
+# (场景, 故障比例, 故障类型, 失效令牌所占比例)
+SCENARIOS = [
+    ("5xx 20%", 0.2, "503", 0),
+    ("reset 20%", 0.2, "reset", 0),
+    ("bad tokens 25%", 0, "503", 0.25),
+    ("outage", 1.0, "503", 0),
+]
+
+
+def upstream_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.loads(response.read())
+
+
+async def one_request(port, model, index, timeout):
+    body = json.dumps({"model": model, "stream": False, "messages": [{"role": "user", "content": f"retry {index}"}]}).encode()
+    request = (
+        f"POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer sk-bench\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        received = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    return received.startswith(b"HTTP/1.1 200") or received.startswith(b"HTTP/1.0 200"), time.perf_counter() - start
+
+
+async def run_load(port, model, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            return await one_request(port, model, index, args.timeout)
+
+    results = await asyncio.gather(*(limited(i) for i in range(args.requests)), return_exceptions=True)
+    results = [result for result in results if not isinstance(result, BaseException)]
+    ok = sum(1 for success, _ in results if success)
+    return ok, args.requests - ok, [elapsed for _, elapsed in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重试策略基准")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mode", default="threaded")
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--sso", type=int, default=16, help="令牌数")
+    parser.add_argument("--max-attempts", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    upstream_port, proxy_port = 5300, 5201
+    sso = [f"bench{i}" for i in range(args.sso)]
+    print(f"{'scenario':<16}{'config':<12}{'ok':>6}{'failed':>8}{'upstream':>10}{'amplify':>9}{'p50':>9}{'p99':>9}")
+    for scenario, fail_ratio, fault, bad_ratio in SCENARIOS:
+        bad_sso = sso[:int(len(sso) * bad_ratio)]
+        for name, retry_env in CONFIGS:
+            # 每组单独启动上游替身和服务，熔断器和令牌冷却状态互不影响
+            upstream = subprocess.Popen([
+                sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+                "--tokens", "20", "--interval", "0.002", "--fail-ratio", str(fail_ratio), "--fault", fault,
+                "--bad-sso", ",".join(bad_sso), "--seed", str(args.seed)
+            ])
+            env = dict(os.environ, SERVER_MODE=args.mode, PORT=str(proxy_port), API_KEY="sk-bench", SSO=",".join(sso),
+                       TOKEN_DATA_DIR="", BASE_URL=f"http://127.0.0.1:{upstream_port}", LOG_LEVEL="ERROR",
+                       RETRY_MAX_ATTEMPTS=str(args.max_attempts), WSGI_WORKERS=str(args.concurrency * 2), **retry_env)
+            server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_port(upstream_port)
+                wait_port(proxy_port)
+                ok, failed, latencies = asyncio.run(run_load(proxy_port, args.model, args))
+                sent = upstream_stats(upstream_port)["requests"]
+                print(f"{scenario:<16}{name:<12}{ok:>6}{failed:>8}{sent:>10}{sent / args.requests:>8.2f}x"
+                      f"{percentile(latencies, 50):>8.2f}s{percentile(latencies, 99):>8.2f}s")
+            finally:
+                server.terminate()
+                server.wait()
+                upstream.terminate()
+                upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
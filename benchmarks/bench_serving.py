@@ -0,0 +1,119 @@
+"""
+对比 threaded（Flask 多线程）与 asgi（异步）两种服务模式下的并发流式能力。
+
+启动本地上游替身和代理服务，同时打开 N 个 /v1/chat/completions 流式请求，
+统计完成数、失败数、首字节时间与总耗时。
+
+    python benchmarks/bench_serving.py --concurrency 200 1000 2000
+"""
+import os
+import sys
+import time
+import json
+import socket
+import asyncio
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_port(port, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"端口 {port} 启动超时")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def one_stream(port, model, timeout):
+    body = json.dumps({"model": model, "stream": True, "messages": [{"role": "user", "content": "hi"}]}).encode()
+    request = (
+        f"POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer sk-bench\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+    start = time.perf_counter()
+    ttfb = None
+    received = b""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port, limit=1 << 20), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        while True:
+            data = await asyncio.wait_for(reader.read(65536), timeout)
+            if not data:
+                break
+            received += data
+            if ttfb is None and b"data:" in received:
+                ttfb = time.perf_counter() - start
+    finally:
+        writer.close()
+    return b"[DONE]" in received, ttfb, time.perf_counter() - start
+
+
+async def run_load(port, concurrency, model, timeout):
+    results = await asyncio.gather(
+        *(one_stream(port, model, timeout) for _ in range(concurrency)),
+        return_exceptions=True
+    )
+    ok = [r for r in results if not isinstance(r, BaseException) and r[0]]
+    return {
+        "ok": len(ok),
+        "failed": concurrency - len(ok),
+        "ttfb_p50": percentile([r[1] for r in ok if r[1] is not None], 50),
+        "ttfb_p99": percentile([r[1] for r in ok if r[1] is not None], 99),
+        "total_p99": percentile([r[2] for r in ok], 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="threaded 与 asgi 服务模式并发流式对比")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asgi"])
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    upstream_port, proxy_port = 5300, 5201
+    upstream = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+        "--tokens", str(args.tokens), "--interval", str(args.interval)
+    ])
+    try:
+        wait_port(upstream_port)
+        print(f"{'mode':<10}{'streams':>9}{'ok':>7}{'failed':>8}{'ttfb p50':>11}{'ttfb p99':>11}{'total p99':>11}{'wall':>9}")
+        for mode in args.modes:
+            env = dict(os.environ, SERVER_MODE=mode, PORT=str(proxy_port), API_KEY="sk-bench", SSO="bench",
+                       BASE_URL=f"http://127.0.0.1:{upstream_port}", LOG_LEVEL="ERROR")
+            server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                      stderr=subprocess.DEVNULL)
+            try:
+                wait_port(proxy_port)
+                for concurrency in args.concurrency:
+                    start = time.perf_counter()
+                    stats = asyncio.run(run_load(proxy_port, concurrency, args.model, args.timeout))
+                    wall = time.perf_counter() - start
+                    print(f"{mode:<10}{concurrency:>9}{stats['ok']:>7}{stats['failed']:>8}"
+                          f"{stats['ttfb_p50']:>10.3f}s{stats['ttfb_p99']:>10.3f}s{stats['total_p99']:>10.3f}s{wall:>8.2f}s")
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+多进程令牌池基准。
+
+令牌池：N 个进程各自取令牌，对比各进程独立持有令牌池与共享存储（TOKEN_SHARED_DB）下
+取令牌的总吞吐、各令牌被使用次数的最小/最大值，以及运行中途添加的令牌多久后所有进程都能取到。
+
+端到端：用上游替身对比 1 个进程、8 个各自独立的进程（原先的多副本部署，请求轮流发往各副本）和 WORKERS=8 共享令牌状态时
+服务的吞吐、延迟，以及上游收到的请求中该令牌已有请求在进行中的比例（多个进程按相同顺序轮询时会同时打在同一个令牌上）。
+吞吐受本机核数限制。
+
+    python benchmarks/bench_shared_tokens.py --workers 1 8 --tokens 64 --calls 20000
+"""
+import os
+import sys
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_serving import ROOT, wait_port, percentile
+from bench_retry import one_request, upstream_stats
+
+PROBE = "probe-token"
+
+
+def open_manager(shared_db):
+    from config import config_manager
+    from token_manager import AuthTokenManager
+
+    config_manager.set("TOKEN.DATA_DIR", "")
+    manager = AuthTokenManager()
+    if shared_db:
+        manager.attach_shared_store(shared_db)
+    return manager
+
+
+def pool_worker(shared_db, token_count, calls, barrier, added_at, results):
+    manager = open_manager(shared_db)
+    manager.add_tokens_batch([f"bench{i}" for i in range(token_count)])
+    sequence = []
+    seen_at = None
+    barrier.wait()
+    start = time.perf_counter()
+    for i in range(calls):
+        sequence.append(manager.get_next_token_for_model("grok-3"))
+        if seen_at is None and i % 64 == 0 and added_at.value and manager.store.get(PROBE) is not None:
+            seen_at = time.time() - added_at.value
+    elapsed = time.perf_counter() - start
+    # 令牌添加在各进程的调用结束之后时，继续等待它出现
+    while seen_at is None and shared_db:
+        if added_at.value:
+            manager.get_next_token_for_model("grok-3")
+            if manager.store.get(PROBE) is not None:
+                seen_at = max(0.0, time.time() - added_at.value)
+                break
+        time.sleep(0.005)
+    results.put((sequence, elapsed, seen_at))
+
+
+def run_pool(workers, token_count, calls, shared):
+    directory = tempfile.mkdtemp()
+    shared_db = os.path.join(directory, "tokens.db") if shared else ""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers + 1)
+    added_at = context.Value("d", 0.0)
+    results = context.Queue()
+    processes = [
+        context.Process(target=pool_worker, args=(shared_db, token_count, calls, barrier, added_at, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    if shared:
+        # 调用进行中由另一个进程（相当于管理接口）添加令牌
+        admin = open_manager(shared_db)
+        time.sleep(0.05)
+        admin.add_token(PROBE)
+        added_at.value = time.time()
+    collected = [results.get() for _ in processes]
+    wall = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    if shared:
+        admin.shared.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    counts = Counter(token for sequence, _, _ in collected for token in sequence if token and PROBE not in token)
+    delays = [seen_at for _, _, seen_at in collected if seen_at is not None]
+    return {
+        "ops_per_sec": workers * calls / wall,
+        "min": min(counts.values()),
+        "max": max(counts.values()),
+        "propagation": max(delays) if shared and delays else None
+    }
+
+
+async def spread_load(ports, args, requests):
+    """请求按序号轮流发往各个端口"""
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            return await one_request(ports[index % len(ports)], "grok-3", index, args.timeout)
+
+    results = await asyncio.gather(*(limited(i) for i in range(requests)), return_exceptions=True)
+    results = [result for result in results if not isinstance(result, BaseException)]
+    ok = sum(1 for success, _ in results if success)
+    return ok, requests - ok, [elapsed for _, elapsed in results]
+
+
+def run_http(workers, copies, args):
+    """copies 个服务副本（各自 WORKERS=workers）"""
+    upstream_port = 5300
+    ports = [5201 + i for i in range(copies)]
+    upstream = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+        "--tokens", "20", "--interval", "0.002"
+    ])
+    servers = []
+    for port in ports:
+        env = dict(os.environ, SERVER_MODE=args.mode, PORT=str(port), API_KEY="sk-bench", TOKEN_DATA_DIR="",
+                   SSO=",".join(f"bench{i}" for i in range(args.tokens)), BASE_URL=f"http://127.0.0.1:{upstream_port}",
+                   LOG_LEVEL="ERROR", WORKERS=str(workers), WSGI_WORKERS=str(args.concurrency * 2))
+        env.pop("TOKEN_SHARED_DB", None)
+        servers.append(subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    try:
+        wait_port(upstream_port)
+        for port in ports:
+            wait_port(port, timeout=60)
+        # 各进程启动较慢，先预热一轮
+        asyncio.run(spread_load(ports, args, max(workers, copies) * 4))
+        before = upstream_stats(upstream_port)
+        start = time.perf_counter()
+        ok, failed, latencies = asyncio.run(spread_load(ports, args, args.requests))
+        elapsed = time.perf_counter() - start
+        after = upstream_stats(upstream_port)
+        overlap = (after["token_overlaps"] - before["token_overlaps"]) / max(1, after["requests"] - before["requests"])
+        return ok, failed, ok / elapsed, latencies, overlap
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+        upstream.terminate()
+        upstream.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程令牌池基准")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--calls", type=int, default=20000, help="每个进程取令牌的次数")
+    parser.add_argument("--requests", type=int, default=400, help="端到端测试的请求数，置0跳过")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mode", default="threaded")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    print(f"cpu cores: {os.cpu_count()}")
+    print(f"{'workers':>8}  {'pool':<12}{'ops/s':>12}{'min/token':>11}{'max/token':>11}{'add visible':>13}")
+    for workers in args.workers:
+        for shared in (False, True):
+            stats = run_pool(workers, args.tokens, args.calls, shared)
+            propagation = f"{stats['propagation'] * 1000:.0f}ms" if stats["propagation"] is not None else "never"
+            print(f"{workers:>8}  {'shared' if shared else 'independent':<12}{stats['ops_per_sec']:>12.0f}"
+                  f"{stats['min']:>11}{stats['max']:>11}{propagation:>13}")
+
+    if args.requests:
+        print(f"\n{'server':<16}{'ok':>6}{'failed':>8}{'req/s':>9}{'p50':>9}{'p99':>9}{'token busy':>12}   ({args.mode}, non-stream)")
+        for workers in args.workers:
+            configs = [(f"{workers} shared" if workers > 1 else "1", workers, 1)]
+            if workers > 1:
+                configs.insert(0, (f"{workers} independent", 1, workers))
+            for name, worker_count, copies in configs:
+                ok, failed, rate, latencies, overlap = run_http(worker_count, copies, args)
+                print(f"{name:<16}{ok:>6}{failed:>8}{rate:>9.1f}{percentile(latencies, 50):>8.3f}s"
+                      f"{percentile(latencies, 99):>8.3f}s{overlap:>11.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+相同请求合并基准：同时发出大量重复的请求（只有少数几种不同的提示词），
+对比关闭与开启 SINGLE_FLIGHT / SINGLE_FLIGHT_STREAM 时实际发往上游的请求数、成功数和耗时。
+流式场景中一部分客户端在收到首帧后断开，检查其余订阅者不受影响。
+
+    python benchmarks/bench_single_flight.py --requests 200 --distinct 5 --drop 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_serving import ROOT, wait_port, percentile
+
+
+def upstream_requests(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.loads(response.read())["requests"]
+
+
+async def one_request(port, model, prompt, stream, drop, timeout):
+    body = json.dumps({"model": model, "stream": stream, "messages": [{"role": "user", "content": prompt}]}).encode()
+    request = (
+        f"POST /v1/chat/completions HTTP/1.1\r\nHost: 127.0.0.1\r\nAuthorization: Bearer sk-bench\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+    ).encode() + body
+    start = time.perf_counter()
+    received = b""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port, limit=1 << 20), timeout)
+    try:
+        writer.write(request)
+        await writer.drain()
+        while True:
+            data = await asyncio.wait_for(reader.read(65536), timeout)
+            if not data:
+                break
+            received += data
+            if drop and b"data: {" in received:
+                # 模拟客户端中途断开
+                return "dropped", time.perf_counter() - start
+    finally:
+        writer.close()
+    ok = b"[DONE]" in received if stream else b'"chat.completion"' in received and b"done" in received
+    return ("ok" if ok else "failed"), time.perf_counter() - start
+
+
+async def run_load(port, model, args, stream):
+    rng = random.Random(args.seed)
+    prompts = [f"classify item {i % args.distinct}" for i in range(args.requests)]
+    rng.shuffle(prompts)
+    drops = [stream and rng.random() < args.drop for _ in prompts]
+    results = await asyncio.gather(
+        *(one_request(port, model, prompt, stream, drop, args.timeout) for prompt, drop in zip(prompts, drops)),
+        return_exceptions=True
+    )
+    counts = {"ok": 0, "failed": 0, "dropped": 0}
+    latencies = []
+    for result in results:
+        if isinstance(result, BaseException):
+            counts["failed"] += 1
+            continue
+        counts[result[0]] += 1
+        if result[0] == "ok":
+            latencies.append(result[1])
+    return counts, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="相同请求合并基准")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--distinct", type=int, default=5, help="不同提示词的数量")
+    parser.add_argument("--drop", type=float, default=0.2, help="流式请求中途断开的比例")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asgi"])
+    parser.add_argument("--model", default="grok-3")
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--first-byte-delay", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    upstream_port, proxy_port = 5300, 5201
+    upstream = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "fake_grok.py"), "--port", str(upstream_port),
+        "--tokens", str(args.tokens), "--interval", str(args.interval), "--first-byte-delay", str(args.first_byte_delay)
+    ])
+    try:
+        wait_port(upstream_port)
+        print(f"{'mode':<10}{'flight':<8}{'kind':<12}{'requests':>9}{'ok':>6}{'dropped':>9}{'failed':>8}"
+              f"{'upstream':>10}{'saved':>8}{'p50':>9}{'p99':>9}")
+        for mode in args.modes:
+            for enabled in (False, True):
+                flag = "true" if enabled else "false"
+                env = dict(os.environ, SERVER_MODE=mode, PORT=str(proxy_port), API_KEY="sk-bench",
+                           SSO=",".join(f"bench{i}" for i in range(16)), TOKEN_DATA_DIR="",
+                           BASE_URL=f"http://127.0.0.1:{upstream_port}", LOG_LEVEL="ERROR",
+                           SINGLE_FLIGHT=flag, SINGLE_FLIGHT_STREAM=flag, WSGI_WORKERS=str(args.requests))
+                server = subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    wait_port(proxy_port)
+                    for stream in (False, True):
+                        before = upstream_requests(upstream_port)
+                        counts, latencies = asyncio.run(run_load(proxy_port, args.model, args, stream))
+                        # 等待被放弃的上游流结束后再统计
+                        time.sleep(0.2)
+                        calls = upstream_requests(upstream_port) - before
+                        print(f"{mode:<10}{'on' if enabled else 'off':<8}{'stream' if stream else 'non-stream':<12}"
+                              f"{args.requests:>9}{counts['ok']:>6}{counts['dropped']:>9}{counts['failed']:>8}"
+                              f"{calls:>10}{args.requests - calls:>8}"
+                              f"{percentile(latencies, 50):>8.2f}s{percentile(latencies, 99):>8.2f}s")
+                finally:
+                    server.terminate()
+                    server.wait()
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
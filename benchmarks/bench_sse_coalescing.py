@@ -0,0 +1,86 @@
+"""
+SSE分片合并基准：上游逐字符输出时，对比逐分片输出与合并输出的帧数、字节数和CPU耗时，
+并检查两种模式下客户端拼接出的文本完全一致。
+
+    python benchmarks/bench_sse_coalescing.py --chars 4000 --interval 0.001
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+
+
+class ReplayResponse:
+    """按固定间隔回放NDJSON行的上游响应替身"""
+
+    def __init__(self, lines, interval):
+        self.lines = lines
+        self.interval = interval
+
+    def iter_lines(self, idle_timeout=None):
+        for line in self.lines:
+            if self.interval:
+                time.sleep(self.interval)
+            yield line
+
+    def close(self):
+        pass
+
+
+def build_lines(model, chars):
+    text = ("The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。" * (chars // 40 + 1))[:chars]
+    lines = []
+    if model != "grok-3":
+        lines.append({"result": {"response": {"token": "Thinking", "isThinking": True, "messageTag": "header"}}})
+        lines += [{"result": {"response": {"token": c, "isThinking": True, "messageTag": "final"}}} for c in text[:chars // 2]]
+        text = text[chars // 2:]
+    lines += [{"result": {"response": {"token": c, "isThinking": False, "messageTag": "final"}}} for c in text]
+    return [json.dumps(line).encode("utf-8") for line in lines]
+
+
+def run(handler, model, lines, interval, coalesce):
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    frames = list(handler.handle_stream_response(ReplayResponse(lines, interval), model, coalesce))
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    content = "".join(json.loads(frame[6:])["choices"][0]["delta"]["content"] for frame in frames[:-1])
+    return {
+        "frames": len(frames),
+        "bytes": sum(len(frame.encode("utf-8")) for frame in frames),
+        "wall": wall,
+        "cpu": cpu,
+        "content": content
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE分片合并基准")
+    parser.add_argument("--chars", type=int, default=4000, help="回复的字符数（每个字符一个上游分片）")
+    parser.add_argument("--interval", type=float, default=0.001, help="上游分片间隔（秒）")
+    parser.add_argument("--bytes", type=int, default=256)
+    parser.add_argument("--ms", type=int, default=20)
+    args = parser.parse_args()
+
+    handler = RequestHandler(AuthTokenManager())
+    print(f"{'model':<8}{'mode':<10}{'frames':>8}{'bytes':>10}{'frames/s':>10}{'bytes/s':>12}{'cpu':>9}")
+    for model in ("grok-3", "grok-4"):
+        lines = build_lines(model, args.chars)
+        results = {}
+        for mode, coalesce in (("per-chunk", None), ("coalesced", (args.bytes, args.ms / 1000))):
+            stats = results[mode] = run(handler, model, lines, args.interval, coalesce)
+            print(f"{model:<8}{mode:<10}{stats['frames']:>8}{stats['bytes']:>10}"
+                  f"{stats['frames'] / stats['wall']:>10.0f}{stats['bytes'] / stats['wall']:>12.0f}{stats['cpu'] * 1000:>7.0f}ms")
+        assert results["per-chunk"]["content"] == results["coalesced"]["content"]
+        print(f"{'':<8}{'reduction':<10}{results['per-chunk']['frames'] / results['coalesced']['frames']:>7.1f}x"
+              f"{results['per-chunk']['bytes'] / results['coalesced']['bytes']:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+SSE帧编码微基准：原先每个分片构造字典 + uuid4 + json.dumps，对比预先序列化前后缀的 StreamChunkEncoder。
+
+    python benchmarks/bench_sse_encoder.py --chunks 200000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import MessageProcessor, StreamChunkEncoder
+
+
+SAMPLES = {
+    "ascii": ["Hello", " world", ",", " this", " is", " a", " streamed", " reply", "."],
+    "cjk": ["你好", "，", "这是", "一段", "流式", "回复", "。"],
+    "escapes": ['say "hi"', "\n", "tab\there", "back\\slash", "</think>", "emoji 😀"]
+}
+
+
+def legacy_frame(text, model):
+    return f"data: {json.dumps(MessageProcessor.create_chat_response(text, model, True))}\n\n"
+
+
+def check_equivalence(model):
+    """固定id和时间后，新编码器的输出应与原实现逐字节一致"""
+    encoder = StreamChunkEncoder(model)
+    for texts in SAMPLES.values():
+        for text in texts:
+            expected = json.loads(legacy_frame(text, model)[6:])
+            expected["id"], expected["created"] = encoder.completion_id, encoder.created
+            assert encoder.encode(text) == f"data: {json.dumps(expected)}\n\n", text
+
+
+def bench(func, texts, chunks):
+    count = len(texts)
+    start = time.perf_counter()
+    for i in range(chunks):
+        func(texts[i % count])
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE帧编码微基准")
+    parser.add_argument("--chunks", type=int, default=200000)
+    parser.add_argument("--model", default="grok-4")
+    args = parser.parse_args()
+
+    check_equivalence(args.model)
+
+    print(f"{'sample':<10}{'legacy':>12}{'encoder':>12}{'speedup':>10}")
+    for name, texts in SAMPLES.items():
+        legacy = bench(lambda text: legacy_frame(text, args.model), texts, args.chunks)
+        encoder = StreamChunkEncoder(args.model)
+        fast = bench(encoder.encode, texts, args.chunks)
+        print(f"{name:<10}{legacy / args.chunks * 1e9:>10.0f}ns{fast / args.chunks * 1e9:>10.0f}ns{legacy / fast:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+令牌持久化启动耗时：生成快照 + 追加日志后，测量新进程内恢复全部令牌所需时间。
+
+    python benchmarks/bench_token_persistence.py --sizes 100000 1000000
+"""
+import os
+import sys
+import time
+import shutil
+import secrets
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config_manager
+from token_manager import AuthTokenManager
+
+
+def fake_sso():
+    # 与真实sso令牌长度相近的JWT风格字符串
+    return f"eyJhbGciOiJIUzI1NiJ9.{secrets.token_urlsafe(60)}.{secrets.token_urlsafe(32)}"
+
+
+def run(size, log_ops):
+    data_dir = tempfile.mkdtemp(prefix="token-journal-")
+    config_manager.set("TOKEN.DATA_DIR", data_dir)
+    config_manager.set("TOKEN.SNAPSHOT_THRESHOLD", 10 ** 9)
+    try:
+        values = [fake_sso() for _ in range(size)]
+        writer = AuthTokenManager()
+        writer.load_from_disk()
+        writer.add_tokens_batch(values)
+        writer.journal.request_snapshot()
+        writer.journal.close()
+
+        # 快照之后再写入一段日志：429冷却、失败和删除
+        writer = AuthTokenManager()
+        writer.load_from_disk()
+        for i in range(log_ops):
+            token = values[i]
+            if i % 3 == 0:
+                writer.mark_rate_limited(token, "grok-3", 3600)
+            elif i % 3 == 1:
+                writer.mark_failure(token, "grok-4")
+            else:
+                writer.delete_token(token)
+        writer.journal.flush()
+        snapshot_size = os.path.getsize(writer.journal.snapshot_path)
+        log_size = os.path.getsize(writer.journal.log_path)
+
+        reader = AuthTokenManager()
+        start = time.perf_counter()
+        reader.load_from_disk()
+        elapsed = time.perf_counter() - start
+        restored = len(reader.store)
+
+        writer.journal.close()
+        reader.journal.close()
+        return elapsed, restored, snapshot_size, log_size
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="令牌持久化启动耗时")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--log-ops", type=int, default=5000, help="快照之后的日志条数")
+    args = parser.parse_args()
+
+    print(f"{'tokens':>10}{'snapshot':>11}{'log':>10}{'restored':>10}{'load':>9}")
+    for size in args.sizes:
+        elapsed, restored, snapshot_size, log_size = run(size, args.log_ops)
+        print(f"{size:>10}{snapshot_size / 1024 / 1024:>9.1f}MB{log_size / 1024:>8.0f}KB{restored:>10}{elapsed:>8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+令牌轮询并发压测：多线程同时取令牌，同时穿插添加、删除和 429 冷却，
+检查分配是否均匀、是否出现已删除或冷却中的令牌，并统计吞吐量。
+
+    python benchmarks/bench_token_rotation.py --threads 64 128 --tokens 1000
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_manager import AuthTokenManager
+
+
+def run(thread_count, token_count, calls_per_thread, churn):
+    manager = AuthTokenManager()
+    manager.add_tokens_batch([f"stable{i}" for i in range(token_count)])
+    stable = set(manager.get_all_tokens())
+
+    counts = [Counter() for _ in range(thread_count)]
+    errors = []
+    stop = threading.Event()
+    start_barrier = threading.Barrier(thread_count + 1)
+
+    def worker(index):
+        local = counts[index]
+        start_barrier.wait()
+        for i in range(calls_per_thread):
+            model = "grok-3" if i % 2 else "grok-4"
+            token = manager.get_next_token_for_model(model)
+            if token is None:
+                errors.append("None")
+                continue
+            local[token] += 1
+
+    def churner():
+        # 不断添加、删除临时令牌并让它们进入冷却，模拟管理接口和429并发发生
+        i = 0
+        while not stop.is_set():
+            temp = f"sso-rw=temp{i};sso=temp{i}"
+            manager.add_token(temp)
+            manager.mark_rate_limited(temp, "grok-3", 60)
+            manager.delete_token(temp)
+            i += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+    churn_thread = threading.Thread(target=churner) if churn else None
+    for thread in threads:
+        thread.start()
+    if churn_thread:
+        churn_thread.start()
+
+    start = time.perf_counter()
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    if churn_thread:
+        churn_thread.join()
+
+    total = Counter()
+    for local in counts:
+        total.update(local)
+    stable_counts = [total.get(token, 0) for token in stable]
+    temp_hits = sum(count for token, count in total.items() if token not in stable)
+
+    return {
+        "calls": thread_count * calls_per_thread,
+        "ops_per_sec": thread_count * calls_per_thread / elapsed,
+        "min": min(stable_counts),
+        "max": max(stable_counts),
+        "temp_hits": temp_hits,
+        "errors": len(errors)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="令牌轮询并发压测")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 16, 64, 128])
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=20000, help="每个线程的调用次数")
+    parser.add_argument("--no-churn", action="store_true", help="不并发添加/删除令牌")
+    args = parser.parse_args()
+
+    print(f"{'threads':>8}{'calls':>10}{'ops/s':>12}{'min/token':>11}{'max/token':>11}{'temp hits':>11}{'errors':>8}")
+    for thread_count in args.threads:
+        stats = run(thread_count, args.tokens, args.calls, not args.no_churn)
+        print(f"{thread_count:>8}{stats['calls']:>10}{stats['ops_per_sec']:>12.0f}"
+              f"{stats['min']:>11}{stats['max']:>11}{stats['temp_hits']:>11}{stats['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
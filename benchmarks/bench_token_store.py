@@ -0,0 +1,106 @@
+"""
+令牌存储的内存与延迟对比：原先的 cookie 字符串列表 vs 按sso索引的紧凑存储。
+
+    python benchmarks/bench_token_store.py --sizes 100000 1000000
+"""
+import os
+import sys
+import time
+import secrets
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from token_manager import AuthTokenManager
+
+
+class LegacyTokenList:
+    """原实现的数据结构：完整cookie字符串列表，查重和删除都是线性扫描，状态视图每次重新解析"""
+
+    def __init__(self):
+        self.tokens = []
+
+    def add_tokens_batch(self, token_strs):
+        existing = set(self.tokens)
+        for value in token_strs:
+            token = f"sso-rw={value};sso={value}"
+            if token not in existing:
+                self.tokens.append(token)
+                existing.add(token)
+
+    def add_token(self, token):
+        if token not in self.tokens:
+            self.tokens.append(token)
+
+    def delete_token(self, sso):
+        for stored in self.tokens:
+            if stored.split("sso=")[1].split(";")[0] == sso:
+                self.tokens.remove(stored)
+                return True
+        return False
+
+    def get_token_status_map(self):
+        return {token.split("sso=")[1].split(";")[0]: {"isValid": True, "index": i} for i, token in enumerate(self.tokens)}
+
+
+def fake_sso():
+    # 与真实sso令牌长度相近的JWT风格字符串
+    return f"eyJhbGciOiJIUzI1NiJ9.{secrets.token_urlsafe(60)}.{secrets.token_urlsafe(32)}"
+
+
+def timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def measure(factory, values, ops_repeat):
+    # tracemalloc 会显著拖慢分配，内存和加载耗时分两次测量
+    # 输入在追踪范围内复制一份并在加载后释放，存储保留的字符串也计入内存
+    tracemalloc.start()
+    traced = factory()
+    inputs = [value.encode().decode() for value in values]
+    traced.add_tokens_batch(inputs)
+    del inputs
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+
+    store = factory()
+    load_start = time.perf_counter()
+    store.add_tokens_batch(values)
+    load_time = time.perf_counter() - load_start
+
+    extra = [f"sso-rw={value};sso={value}" for value in (fake_sso() for _ in range(ops_repeat))]
+    add_time = timed(lambda: store.add_token(extra.pop()), ops_repeat)
+    victims = values[-ops_repeat:]
+    delete_time = timed(lambda: store.delete_token(victims.pop()), ops_repeat)
+    status_time = timed(store.get_token_status_map, 3)
+    return {
+        "memory_mb": memory / 1024 / 1024,
+        "load_s": load_time,
+        "add_us": add_time * 1e6,
+        "delete_us": delete_time * 1e6,
+        "status_ms": status_time * 1e3
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="令牌存储内存与延迟对比")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--ops", type=int, default=20, help="单次添加/删除的采样次数")
+    args = parser.parse_args()
+
+    print(f"{'store':<10}{'tokens':>10}{'memory':>11}{'load':>9}{'add':>13}{'delete':>13}{'status map':>13}")
+    for size in args.sizes:
+        values = [fake_sso() for _ in range(size)]
+        for name, factory in (("legacy", LegacyTokenList), ("indexed", AuthTokenManager)):
+            stats = measure(factory, list(values), args.ops)
+            print(f"{name:<10}{size:>10}{stats['memory_mb']:>9.1f}MB{stats['load_s']:>8.2f}s"
+                  f"{stats['add_us']:>11.1f}us{stats['delete_us']:>11.1f}us{stats['status_ms']:>11.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+工具输出过滤基准：
+- 吞吐：原先对每个分片执行未预编译的 re.sub/re.findall，对比每个流一个的 ToolOutputFilter
+- 正确性：把带标签的样本在每个位置（以及随机多处）切成分片，过滤结果应与不切分时一致，且没有标签泄漏；
+  同时统计原实现逐分片处理时泄漏标签的切分数
+
+    python benchmarks/bench_tool_filter.py --tokens 200000 --random-splits 2000
+"""
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import ToolOutputFilter
+
+
+SAMPLES = [
+    'Answer <grok:render type="render_inline_citation"><argument name="citation_id">1</argument></grok:render> tail.',
+    '<xai:tool_usage_card><xai:tool_usage_card_id>a1</xai:tool_usage_card_id><xai:tool_name>web_search</xai:tool_name>'
+    '<xai:tool_args><![CDATA[{"query":"grok 4 release"}]]></xai:tool_args></xai:tool_usage_card>',
+    '<xai:tool_usage_card><xai:tool_args><![CDATA[{"query":"a"}]]><![CDATA[{"query":"b"}]]></xai:tool_args></xai:tool_usage_card>',
+    'plain ![CDATA[keep]] and a < b ! c',
+    'x <grok:render>y</grok:render><grok:render a="1">z</grok:render> w'
+]
+
+LEAKS = ("<grok:render", "</grok:render", "xai:tool_usage_card", "xai:tool_args")
+
+WORDS = ["Hello", " world", ",", " 你好", " this", " is", " grok", ".", "\n", "!", " a < b"]
+
+
+def legacy_process(text):
+    """原 process_tool_response 的逐分片实现"""
+    text = re.sub(r'<grok:render[^>]*>.*?</grok:render>', '', text, flags=re.DOTALL)
+    matches = re.findall(r'!\[CDATA\[(.*?)\]\]', text, re.DOTALL)
+    if matches:
+        filtered = [m for m in matches if '"query"' in m]
+        if filtered:
+            return '\n' + '\n'.join(filtered) + '\n'
+    if '<xai:tool_usage_card>' in text:
+        return ''
+    return text
+
+
+def run_filter(pieces):
+    tool_filter = ToolOutputFilter()
+    return "".join(tool_filter.feed(piece) for piece in pieces) + tool_filter.flush()
+
+
+def run_legacy(pieces):
+    return "".join(legacy_process(piece) for piece in pieces)
+
+
+def split_at(text, points):
+    points = [0] + sorted(points) + [len(text)]
+    return [text[a:b] for a, b in zip(points, points[1:])]
+
+
+def check_splits(random_splits, seed):
+    rng = random.Random(seed)
+    total = legacy_leaks = 0
+    for sample in SAMPLES:
+        expected = run_filter([sample])
+        assert expected == legacy_process(sample), sample
+        splits = [[i] for i in range(1, len(sample))]
+        splits += [rng.sample(range(1, len(sample)), rng.randint(2, 8)) for _ in range(random_splits)]
+        for points in splits:
+            pieces = split_at(sample, points)
+            output = run_filter(pieces)
+            assert output == expected, (sample, points, output)
+            assert not any(leak in output for leak in LEAKS), (sample, points, output)
+            total += 1
+            if any(leak in run_legacy(pieces) for leak in LEAKS):
+                legacy_leaks += 1
+    return total, legacy_leaks
+
+
+def build_tokens(count, tool_ratio, seed):
+    """模拟思考阶段的分片：大部分为普通文本，少量为被切开的工具输出"""
+    rng = random.Random(seed)
+    tokens = []
+    while len(tokens) < count:
+        if rng.random() < tool_ratio:
+            sample = rng.choice(SAMPLES)
+            tokens += split_at(sample, rng.sample(range(1, len(sample)), 3))
+        else:
+            tokens.append(rng.choice(WORDS))
+    return tokens[:count]
+
+
+def bench(func, tokens, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(tokens)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="工具输出过滤基准")
+    parser.add_argument("--tokens", type=int, default=200000)
+    parser.add_argument("--random-splits", type=int, default=2000, help="每个样本随机多处切分的次数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    total, legacy_leaks = check_splits(args.random_splits, args.seed)
+    print(f"切分检查: {total} 种切分全部一致且无泄漏（原实现泄漏 {legacy_leaks} 种）")
+
+    print(f"{'tool ratio':<12}{'legacy':>14}{'filter':>14}{'speedup':>10}")
+    for ratio in (0.0, 0.01, 0.1):
+        tokens = build_tokens(args.tokens, ratio, args.seed)
+        legacy = bench(run_legacy, tokens)
+        fast = bench(run_filter, tokens)
+        print(f"{ratio:<12}{len(tokens) / legacy / 1e6:>9.2f}M/s{len(tokens) / fast / 1e6:>9.2f}M/s{legacy / fast:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
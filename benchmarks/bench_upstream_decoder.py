@@ -0,0 +1,167 @@
+"""
+上游NDJSON解码基准：每MB上游数据消耗的CPU时间，对比原先逐行 decode + strip + json.loads + 逐层 .get()
+（非流式用字符串 += 拼接）与共用的 upstream_decoder 事件解码。两种实现的输出会先做一致性检查。
+
+    python benchmarks/bench_upstream_decoder.py --mb 4
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_processor import MessageProcessor
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+
+
+def upstream_line(token, thinking, tag, response_id):
+    # 与真实上游分片的字段一致
+    return json.dumps({"result": {"response": {
+        "token": token, "isThinking": thinking, "isSoftStop": False,
+        "responseId": response_id, "messageTag": tag, "messageStepId": 0
+    }}}).encode("utf-8")
+
+
+def build_stream(model, size):
+    response_id = str(uuid.uuid4())
+    words = ["Hello", " world", ",", " 你好", " this", " is", " grok", ".", "\n"]
+    reasoning = model != "grok-3"
+    lines, total, i = [], 0, 0
+    if reasoning:
+        lines.append(upstream_line("Thinking about your request", True, "header", response_id))
+        lines.append(json.dumps({"result": {"response": {"webSearchResults": {"results": [
+            {"title": "Example", "url": "https://example.com", "preview": "..."}
+        ]}, "isThinking": True, "messageTag": "raw_function_result", "responseId": response_id}}}).encode("utf-8"))
+    while total < size:
+        thinking = reasoning and total < size // 3
+        line = upstream_line(words[i % len(words)], thinking, "final", response_id)
+        lines.append(line)
+        total += len(line) + 1
+        i += 1
+    lines.append(json.dumps({"result": {"response": {"modelResponse": {
+        "responseId": response_id, "message": "done", "thinkingTrace": "trace" if reasoning else ""
+    }}}}).encode("utf-8"))
+    return lines, total
+
+
+class LegacyHandler(RequestHandler):
+    """原实现的逐行处理逻辑，帧编码与新实现共用，只比较解码与分发的开销"""
+
+    def _process_stream_line(self, chunk, model, state):
+        frames = []
+        if not chunk:
+            return frames
+        try:
+            line_json = json.loads(chunk.decode("utf-8").strip())
+            if line_json.get("error"):
+                state["finished"] = True
+                return frames
+            response_data = line_json.get("result", {}).get("response")
+            if not response_data:
+                return frames
+            if model in ["grok-4", "grok-4-fast"]:
+                if response_data.get("isThinking") and not state["thinking_started"]:
+                    state["thinking_started"] = True
+                    self._emit(state, frames, '<think>', boundary=True)
+                if response_data.get("isThinking") and not state["thinking_ended"] and response_data.get("messageTag") != "header":
+                    filtered_content = MessageProcessor.process_tool_response(response_data)
+                    if filtered_content:
+                        self._emit(state, frames, filtered_content)
+                elif not response_data.get("isThinking") and state["thinking_started"] and not state["thinking_ended"] and response_data.get("messageTag") == "final" and response_data.get("token"):
+                    state["thinking_ended"] = True
+                    self._emit(state, frames, '</think>', boundary=True)
+                    filtered_content = MessageProcessor.process_tool_response(response_data)
+                    if filtered_content:
+                        self._emit(state, frames, filtered_content)
+                elif not response_data.get("isThinking") and state["thinking_ended"] and response_data.get("messageTag") == "final":
+                    filtered_content = MessageProcessor.process_tool_response(response_data)
+                    if filtered_content:
+                        self._emit(state, frames, filtered_content)
+            else:
+                result = MessageProcessor.process_model_response(response_data, model)
+                if result["token"]:
+                    self._emit(state, frames, result["token"])
+        except json.JSONDecodeError:
+            pass
+        return frames
+
+    def collect_non_stream(self, lines, model):
+        state = {"full_content": "", "thinking_content": "", "model_response": None}
+        for chunk in lines:
+            if not chunk:
+                continue
+            line_json = json.loads(chunk.decode("utf-8").strip())
+            response_data = line_json.get("result", {}).get("response")
+            if not response_data:
+                continue
+            if model in ["grok-4", "grok-4-fast"]:
+                if response_data.get("isThinking") and response_data.get("token"):
+                    state["thinking_content"] += response_data["token"]
+                elif not response_data.get("isThinking") and response_data.get("messageTag") == "final" and response_data.get("token"):
+                    state["full_content"] += response_data["token"]
+            else:
+                token = response_data.get("token", "")
+                if token:
+                    state["full_content"] += token
+            if response_data.get("modelResponse"):
+                state["model_response"] = response_data["modelResponse"]
+                break
+        return state["thinking_content"] + state["full_content"]
+
+
+def run_stream(handler, lines, model):
+    state = handler._new_stream_state(model)
+    frames = []
+    for line in lines:
+        frames.extend(handler._process_stream_line(line, model, state))
+    return frames
+
+
+def run_non_stream(handler, lines, model):
+    if isinstance(handler, LegacyHandler):
+        return handler.collect_non_stream(lines, model)
+    state = handler._new_non_stream_state()
+    for line in lines:
+        if handler._collect_non_stream_line(line, model, state):
+            break
+    return "".join(state["thinking_parts"]) + "".join(state["content_parts"])
+
+
+def cpu_time(func, *args, repeat=5):
+    """取多次运行中的最小CPU时间"""
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        result = func(*args)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def strip_ids(frames):
+    return [frame[frame.index('"choices"'):] for frame in frames]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="上游NDJSON解码基准")
+    parser.add_argument("--mb", type=float, default=4, help="每种模型的上游数据量（MB）")
+    args = parser.parse_args()
+
+    legacy, current = LegacyHandler(AuthTokenManager()), RequestHandler(AuthTokenManager())
+    print(f"{'model':<8}{'path':<12}{'before':>12}{'after':>12}{'speedup':>10}")
+    for model in ("grok-3", "grok-4"):
+        lines, size = build_stream(model, int(args.mb * 1024 * 1024))
+        mb = size / 1024 / 1024
+        for path, func, compare in (("stream", run_stream, strip_ids), ("non-stream", run_non_stream, lambda x: x)):
+            before, old_output = cpu_time(func, legacy, lines, model)
+            after, new_output = cpu_time(func, current, lines, model)
+            assert compare(old_output) == compare(new_output), f"{model} {path} 输出不一致"
+            print(f"{model:<8}{path:<12}{before / mb * 1000:>8.0f}ms/MB{after / mb * 1000:>8.0f}ms/MB{before / after:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""
+本地 grok 上游替身，在 /rest/app-chat/conversations/new 上按 handle_stream_response 期望的 NDJSON 格式输出流式响应，
+用于压测和基准测试：推理模型先输出思考分片再输出最终分片，最后是 modelResponse；
+开启 --tools 时思考阶段带有工具调用卡片（xai:tool_usage_card）和网页搜索结果，最终回复中带有 grok:render 引用。
+首行延迟、token速率、状态码故障（429/403/5xx等）和流中途的错误行都可以配置。
+
+    python benchmarks/fake_grok.py --port 5300 --tokens 200 --interval 0.02
+    python benchmarks/fake_grok.py --tools --error-ratio 0.05   # 带工具输出，5%的回复中途返回错误行
+    BASE_URL=http://127.0.0.1:5300 SSO=bench python app.py
+    python benchmarks/fake_grok.py --slow-ratio 0.05 --slow-delay 3   # 5%的请求首行慢3秒（长尾）
+    python benchmarks/fake_grok.py --fail-ratio 0.1 --fault 503 --bad-sso bench0   # 故障注入
+    python benchmarks/fake_grok.py --capacity 16 --token-capacity 2   # 上游容量有限，同一令牌并发过多时返回429
+    curl "http://127.0.0.1:5300/fault?ratio=1&kind=reset"   # 运行中调整故障比例和类型
+    curl http://127.0.0.1:5300/stats
+"""
+import json
+import random
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+
+# 可注入的故障：状态码，或 reset（读完请求后直接断开连接，不返回任何响应）
+FAULTS = ("500", "502", "503", "504", "429", "401", "403", "reset")
+
+
+TOOL_CARD = (
+    '<xai:tool_usage_card><xai:tool_usage_card_id>card-0</xai:tool_usage_card_id><xai:tool_name>web_search</xai:tool_name>'
+    '<xai:tool_args>![CDATA[{"query":"grok benchmark","num_results":3}]]</xai:tool_args></xai:tool_usage_card>'
+)
+CITATION = (
+    '<grok:render card_id="card-0" card_type="citation_card" type="render_inline_citation">'
+    '<argument name="citation_id">0</argument></grok:render>'
+)
+WEB_RESULTS = [
+    {"title": f"Result {i}", "url": f"https://example.com/{i}", "preview": "preview text"} for i in range(3)
+]
+# 流中途返回的错误行
+STREAM_ERROR = {"error": {"code": 8, "message": "Too many requests", "details": []}}
+
+
+def _token_line(token, thinking, tag, **extra):
+    return {"result": {"response": {"token": token, "isThinking": thinking, "messageTag": tag, **extra}}}
+
+
+def build_lines(model_name, token_count, tools=False):
+    """构造一次完整回复的NDJSON行；tools 为True时推理模型的回复带有工具调用卡片、网页搜索结果和引用标签"""
+    reasoning = model_name != "grok-3"
+    lines = []
+    if reasoning:
+        lines.append(_token_line("Thinking", True, "header"))
+        if tools:
+            lines.append(_token_line(TOOL_CARD, True, "tool_usage_card"))
+            lines.append(_token_line("", True, "raw_function_result", webSearchResults={"results": WEB_RESULTS}))
+        for i in range(token_count // 2):
+            lines.append(_token_line(f"t{i} ", True, "final"))
+    for i in range(token_count if not reasoning else token_count - token_count // 2):
+        lines.append(_token_line(f"w{i} ", False, "final"))
+    if reasoning and tools:
+        lines.append(_token_line(CITATION, False, "final"))
+    lines.append({"result": {"response": {"modelResponse": {"message": "done", "thinkingTrace": "trace" if reasoning else ""}}}})
+    return [json.dumps(line).encode("utf-8") + b"\n" for line in lines]
+
+
+def cookie_sso(cookie):
+    return cookie.rpartition("sso=")[2].split(";")[0].strip()
+
+
+class FakeGrok:
+    def __init__(self, tokens=200, interval=0.02, first_byte_delay=0.0, slow_ratio=0.0, slow_delay=0.0, seed=None,
+                 fail_ratio=0.0, fault="503", bad_sso=(), limited_sso=(), capacity=0, token_capacity=0, tools=False, error_ratio=0.0):
+        self.tokens = tokens
+        self.interval = interval
+        self.first_byte_delay = first_byte_delay
+        self.slow_ratio = slow_ratio
+        self.slow_delay = slow_delay
+        self.random = random.Random(seed)
+        # 按比例注入的故障，以及始终返回401的sso（模拟失效的令牌）、始终返回429的sso（模拟配额用完的令牌）
+        self.fail_ratio = fail_ratio
+        self.fault = fault
+        self.bad_sso = set(bad_sso)
+        self.limited_sso = set(limited_sso)
+        # 回复中是否带工具输出，以及输出一半后改为返回错误行的回复比例
+        self.tools = tools
+        self.error_ratio = error_ratio
+        self.stream_errors = 0
+        self.not_found = 0
+        # 按模型缓存构造好的回复行
+        self._lines = {}
+        # 同时处理的回复数上限（超过后排队，模拟上游过载时延迟变长），以及每个令牌的并发上限（超过返回429）
+        self.capacity = asyncio.Semaphore(capacity) if capacity else None
+        self.token_capacity = token_capacity
+        self.token_rejections = 0
+        self.requests = 0
+        self.connections = 0
+        # 客户端在回复结束前断开的请求数（例如对冲中落败被中断的一方）
+        self.aborted = 0
+        self.faults = 0
+        self.bad_token_requests = 0
+        # 同一令牌上同时进行的请求数，以及开始时该令牌已有请求在进行中的请求数（多个进程同步轮询到相同令牌）
+        self.token_in_flight = {}
+        self.token_overlaps = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if request_line.startswith(b"GET /stats"):
+                    await self.respond_stats(writer)
+                    continue
+                if request_line.startswith(b"GET /fault"):
+                    await self.respond_fault(writer, request_line)
+                    continue
+                # 作为代理使用时请求行为绝对地址，只检查路径
+                if b"/rest/app-chat/conversations/new" not in request_line:
+                    self.not_found += 1
+                    await self.respond_json(writer, {"error": {"code": 404, "message": "not found"}}, b"404 Not Found")
+                    continue
+                self.requests += 1
+                sso = cookie_sso(headers.get("cookie", ""))
+                fault = self.pick_fault(sso)
+                if fault == "reset":
+                    writer.transport.abort()
+                    return
+                in_flight = self.token_in_flight.get(sso, 0)
+                if in_flight:
+                    self.token_overlaps += 1
+                if self.token_capacity and in_flight >= self.token_capacity and not fault:
+                    self.token_rejections += 1
+                    fault = "429"
+                self.token_in_flight[sso] = in_flight + 1
+                try:
+                    if fault:
+                        await self.respond_error(writer, int(fault))
+                    elif self.capacity is not None:
+                        async with self.capacity:
+                            await self.respond(writer, body)
+                    else:
+                        await self.respond(writer, body)
+                except ConnectionError:
+                    self.aborted += 1
+                    raise
+                finally:
+                    self.token_in_flight[sso] -= 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def pick_fault(self, sso):
+        """决定本次请求注入的故障，返回None表示正常响应"""
+        if self.bad_sso:
+            if sso in self.bad_sso:
+                self.bad_token_requests += 1
+                return "401"
+        if sso in self.limited_sso:
+            return "429"
+        if self.fail_ratio and self.random.random() < self.fail_ratio:
+            self.faults += 1
+            return self.fault
+        return None
+
+    async def respond_json(self, writer, payload, status=b"200 OK", extra_headers=b""):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(b"HTTP/1.1 %s\r\nContent-Type: application/json\r\n%sContent-Length: %d\r\n\r\n%s"
+                     % (status, extra_headers, len(body), body))
+        await writer.drain()
+
+    async def respond_stats(self, writer):
+        """GET /stats 返回已处理的上游请求数，供基准统计实际发往上游的请求"""
+        await self.respond_json(writer, {
+            "requests": self.requests, "connections": self.connections, "aborted": self.aborted,
+            "faults": self.faults, "bad_token_requests": self.bad_token_requests,
+            "token_overlaps": self.token_overlaps, "token_rejections": self.token_rejections,
+            "stream_errors": self.stream_errors, "not_found": self.not_found
+        })
+
+    async def respond_fault(self, writer, request_line):
+        """GET /fault?ratio=0.5&kind=503 调整故障比例和类型，返回当前设置"""
+        query = parse_qs(urlsplit(request_line.split()[1].decode("latin-1")).query)
+        if "ratio" in query:
+            self.fail_ratio = float(query["ratio"][0])
+        if query.get("kind", [self.fault])[0] in FAULTS:
+            self.fault = query.get("kind", [self.fault])[0]
+        await self.respond_json(writer, {"ratio": self.fail_ratio, "kind": self.fault})
+
+    async def respond_error(self, writer, status_code):
+        # 429 带上较短的 Retry-After，避免令牌在基准中长时间冷却
+        extra_headers = b"Retry-After: 1\r\n" if status_code == 429 else b""
+        await self.respond_json(writer, {"error": {"code": status_code, "message": "injected fault"}},
+                                b"%d Injected" % status_code, extra_headers)
+
+    async def respond(self, writer, body):
+        try:
+            model_name = json.loads(body).get("modelName", "grok-3")
+        except ValueError:
+            model_name = "grok-3"
+
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n")
+        delay = self.first_byte_delay
+        if self.slow_ratio and self.random.random() < self.slow_ratio:
+            delay += self.slow_delay
+        if delay:
+            await asyncio.sleep(delay)
+        lines = self._lines.get(model_name)
+        if lines is None:
+            lines = self._lines[model_name] = build_lines(model_name, self.tokens, self.tools)
+        if self.error_ratio and self.random.random() < self.error_ratio:
+            self.stream_errors += 1
+            lines = lines[:len(lines) // 2] + [json.dumps(STREAM_ERROR).encode("utf-8") + b"\n"]
+        for line in lines:
+            writer.write(b"%x\r\n%s\r\n" % (len(line), line))
+            await writer.drain()
+            if self.interval:
+                await asyncio.sleep(self.interval)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 grok 上游替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5300)
+    parser.add_argument("--tokens", type=int, default=200, help="每次回复的token行数")
+    parser.add_argument("--interval", type=float, default=0.02, help="相邻token行之间的间隔（秒）")
+    parser.add_argument("--first-byte-delay", type=float, default=0.0, help="首行前的额外延迟（秒）")
+    parser.add_argument("--slow-ratio", type=float, default=0.0, help="首行额外变慢的请求比例")
+    parser.add_argument("--slow-delay", type=float, default=0.0, help="变慢的请求首行前再增加的延迟（秒）")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--fail-ratio", type=float, default=0.0, help="注入故障的请求比例")
+    parser.add_argument("--fault", choices=FAULTS, default="503", help="注入的故障：状态码或 reset（断开连接）")
+    parser.add_argument("--bad-sso", default="", help="始终返回401的sso，逗号分隔")
+    parser.add_argument("--limited-sso", default="", help="始终返回429的sso，逗号分隔")
+    parser.add_argument("--capacity", type=int, default=0, help="同时处理的回复数上限，超过的排队，0为不限")
+    parser.add_argument("--token-capacity", type=int, default=0, help="每个令牌的并发上限，超过返回429，0为不限")
+    parser.add_argument("--tools", action="store_true", help="推理模型的回复带工具调用卡片、网页搜索结果和引用标签")
+    parser.add_argument("--error-ratio", type=float, default=0.0, help="输出一半后返回错误行的回复比例")
+    args = parser.parse_args()
+
+    fake = FakeGrok(args.tokens, args.interval, args.first_byte_delay, args.slow_ratio, args.slow_delay, args.seed,
+                    args.fail_ratio, args.fault, [sso for sso in args.bad_sso.split(",") if sso],
+                    [sso for sso in args.limited_sso.split(",") if sso], args.capacity, args.token_capacity, args.tools, args.error_ratio)
+    asyncio.run(fake.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
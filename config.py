@@ -15,22 +15,136 @@ class ConfigManager:
             },
             "API": {
                 "IS_TEMP_CONVERSATION": os.environ.get("IS_TEMP_CONVERSATION", "true").lower() == "true",
-                "BASE_URL": "https://grok.com",
+                # 上游地址，压测时可指向本地的上游替身（benchmarks/fake_grok.py），如 http://127.0.0.1:5300
+                "BASE_URL": os.environ.get("BASE_URL", "https://grok.com").rstrip("/"),
                 "API_KEY": os.environ.get("API_KEY", "sk-123456"),
+                # 额外的API Key及各自的配额（JSON数组或JSON文件路径），见 api_keys.py
+                "API_KEYS": os.environ.get("API_KEYS", ""),
                 "SIGNATURE_COOKIE": None,
-                "RETRY_TIME": 1000,
+                # 上游代理，多个代理用逗号或换行分隔，见 proxy_pool.py
                 "PROXY": os.environ.get("PROXY") or None
             },
+            "PROXY_POOL": {
+                # 代理返回403（IP被封）后的冷却时间（秒），期间请求换用其他代理
+                "BAN_COOLDOWN": int(os.environ.get("PROXY_BAN_COOLDOWN", 600)),
+                # 开启后同一令牌固定使用同一代理（该代理不可用时才换），关闭时选择延迟最低的健康代理
+                "STICKY": os.environ.get("PROXY_STICKY", "false").lower() == "true"
+            },
             "ADMIN": {
                 "ADMIN_KEY": os.environ.get("ADMIN_KEY", "admin123")
             },
             "SERVER": {
                 "COOKIE": None,
-                "PORT": int(os.environ.get("PORT", 5200))
+                "PORT": int(os.environ.get("PORT", 5200)),
+                # threaded: Flask多线程服务; asgi: 基于asyncio的异步服务（需要uvicorn）
+                "MODE": os.environ.get("SERVER_MODE", "threaded").lower(),
+                "WSGI_WORKERS": int(os.environ.get("WSGI_WORKERS", 10)),
+                # 工作进程数，大于1时多个进程共用监听端口，令牌状态通过 TOKEN.SHARED_DB 共享
+                "WORKERS": int(os.environ.get("WORKERS", 1))
+            },
+            "TOKEN": {
+                # 429 后令牌在该模型上的冷却时间（秒），上游返回 Retry-After 时以其为准
+                "RATE_LIMIT_COOLDOWN": int(os.environ.get("TOKEN_RATE_LIMIT_COOLDOWN", 3600)),
+                # 连续失败达到阈值后进入冷却，冷却时间按指数增长
+                "FAILURE_THRESHOLD": int(os.environ.get("TOKEN_FAILURE_THRESHOLD", 3)),
+                "FAILURE_COOLDOWN": int(os.environ.get("TOKEN_FAILURE_COOLDOWN", 60)),
+                "MAX_FAILURE_COOLDOWN": int(os.environ.get("TOKEN_MAX_FAILURE_COOLDOWN", 1800)),
+                # 令牌持久化目录，置空则不持久化；日志超过该条数后压缩为快照
+                "DATA_DIR": os.environ.get("TOKEN_DATA_DIR", "data"),
+                "SNAPSHOT_THRESHOLD": int(os.environ.get("TOKEN_SNAPSHOT_THRESHOLD", 10000)),
+                # 多进程共享令牌状态的 SQLite 文件，配置后取代上面的持久化文件；WORKERS>1 且未配置时使用 DATA_DIR/tokens.db
+                "SHARED_DB": os.environ.get("TOKEN_SHARED_DB", ""),
+                # 检查其他进程修改的间隔（毫秒），以及每次从共享游标租用的令牌数上限
+                "SHARED_SYNC_MS": int(os.environ.get("TOKEN_SHARED_SYNC_MS", 50)),
+                "SHARED_LEASE_SIZE": int(os.environ.get("TOKEN_SHARED_LEASE_SIZE", 64)),
+                # 批量检测令牌时的默认并发数和单个令牌超时（秒）
+                "VALIDATE_CONCURRENCY": int(os.environ.get("TOKEN_VALIDATE_CONCURRENCY", 20)),
+                "VALIDATE_TIMEOUT": int(os.environ.get("TOKEN_VALIDATE_TIMEOUT", 15))
+            },
+            "POOL": {
+                # 空闲会话上限（同步模式）/ 会话上限（异步模式）
+                "MAX_IDLE_SESSIONS": int(os.environ.get("POOL_MAX_IDLE_SESSIONS", 256)),
+                "IDLE_TIMEOUT": int(os.environ.get("POOL_IDLE_TIMEOUT", 90)),
+                # 关闭后强制使用 HTTP/1.1；开启时异步模式下同一连接可多路复用
+                "HTTP2": os.environ.get("UPSTREAM_HTTP2", "true").lower() == "true",
+                "MAX_STREAMS_PER_SESSION": int(os.environ.get("POOL_MAX_STREAMS_PER_SESSION", 100)),
+                # 同步模式下执行上游传输的工作线程上限，线程在整个响应（包括流式响应）期间占用；
+                # 全部占用时新的上游请求立即以503拒绝（workers_busy）。开启准入控制时应不小于 ADMISSION_MAX_IN_FLIGHT，
+                # 否则准入放行的请求仍会在这里被拒绝；对冲请求另占一个线程
+                "MAX_WORKERS": int(os.environ.get("POOL_MAX_WORKERS", 512))
+            },
+            "STREAM": {
+                # 合并细碎的上游分片后再输出SSE帧，也可在请求中通过 stream_options.coalesce 单独开关
+                "COALESCE": os.environ.get("STREAM_COALESCE", "false").lower() == "true",
+                "COALESCE_BYTES": int(os.environ.get("STREAM_COALESCE_BYTES", 256)),
+                "COALESCE_MS": int(os.environ.get("STREAM_COALESCE_MS", 20))
+            },
+            "MESSAGE_CACHE": {
+                # 历史消息规范化结果的缓存上限（MB），默认关闭；
+                # 消息拼接已是单次遍历，只有规范化开销明显高于哈希时开启才有收益（见 benchmarks/bench_message_cache.py）
+                "MAX_MB": int(os.environ.get("MESSAGE_CACHE_MAX_MB", 0))
+            },
+            "RESPONSE_CACHE": {
+                # 相同的非流式请求直接返回缓存的补全，默认关闭
+                "ENABLED": os.environ.get("RESPONSE_CACHE", "false").lower() == "true",
+                "TTL": int(os.environ.get("RESPONSE_CACHE_TTL", 300)),
+                "MAX_MB": int(os.environ.get("RESPONSE_CACHE_MAX_MB", 64))
+            },
+            "SINGLE_FLIGHT": {
+                # 同时到达的相同非流式请求只请求一次上游并共享结果；STREAM 开启后相同的流式请求共享同一个上游流
+                "ENABLED": os.environ.get("SINGLE_FLIGHT", "false").lower() == "true",
+                "STREAM": os.environ.get("SINGLE_FLIGHT_STREAM", "false").lower() == "true",
+                # 每个上游请求最多附带的相同请求数，超过后单独请求上游
+                "MAX_FOLLOWERS": int(os.environ.get("SINGLE_FLIGHT_MAX_FOLLOWERS", 64)),
+                "TIMEOUT": int(os.environ.get("SINGLE_FLIGHT_TIMEOUT", 300))
+            },
+            "HEDGE": {
+                # 首行超过对冲延迟仍未到达时，用另一个令牌再发一次请求，先开始输出的一方胜出
+                "ENABLED": os.environ.get("HEDGE", "false").lower() == "true",
+                # 固定的对冲延迟（毫秒），置0时取最近首行延迟的p95并限制在 [MIN_DELAY_MS, MAX_DELAY_MS]
+                "DELAY_MS": int(os.environ.get("HEDGE_DELAY_MS", 0)),
+                "MIN_DELAY_MS": int(os.environ.get("HEDGE_MIN_DELAY_MS", 100)),
+                "MAX_DELAY_MS": int(os.environ.get("HEDGE_MAX_DELAY_MS", 3000)),
+                # 同步模式下等待首行的线程数上限
+                "MAX_WORKERS": int(os.environ.get("HEDGE_MAX_WORKERS", 256))
+            },
+            "METRICS": {
+                # 是否开放 /metrics（Prometheus 文本格式），指标本身始终记录
+                "ENABLED": os.environ.get("METRICS", "true").lower() == "true",
+                # 上游响应计数是否按令牌区分；令牌数量很大时可关闭以控制序列数
+                "TOKEN_LABELS": os.environ.get("METRICS_TOKEN_LABELS", "true").lower() == "true"
             },
             "RETRY": {
-                "RETRYSWITCH": False,
-                "MAX_ATTEMPTS": 2
+                # 单个请求最多尝试的次数（含首次，默认与原来一致为2）；429等令牌相关失败换令牌立即重试，5xx和网络错误按指数退避加抖动重试
+                "MAX_ATTEMPTS": int(os.environ.get("RETRY_MAX_ATTEMPTS", 2)),
+                "BASE_DELAY_MS": int(os.environ.get("RETRY_BASE_DELAY_MS", 200)),
+                "MAX_DELAY_MS": int(os.environ.get("RETRY_MAX_DELAY_MS", 2000)),
+                # 重试预算：最近10秒内的重试次数不超过请求数的 BUDGET_RATIO，另外每秒保底 BUDGET_MIN_PER_SECOND 次
+                "BUDGET": os.environ.get("RETRY_BUDGET", "true").lower() == "true",
+                "BUDGET_RATIO": float(os.environ.get("RETRY_BUDGET_RATIO", 0.2)),
+                "BUDGET_MIN_PER_SECOND": int(os.environ.get("RETRY_BUDGET_MIN_PER_SECOND", 5)),
+                # 按令牌和按代理的熔断器，打开 BREAKER_OPEN_SECONDS 秒后半开探测：令牌连续失败 BREAKER_FAILURES 次后打开；
+                # 代理在10秒内失败不少于 BREAKER_FAILURES 次且失败率不低于 BREAKER_FAILURE_RATE 时打开
+                "BREAKER": os.environ.get("RETRY_BREAKER", "true").lower() == "true",
+                "BREAKER_FAILURES": int(os.environ.get("RETRY_BREAKER_FAILURES", 5)),
+                "BREAKER_FAILURE_RATE": float(os.environ.get("RETRY_BREAKER_FAILURE_RATE", 0.5)),
+                "BREAKER_OPEN_SECONDS": int(os.environ.get("RETRY_BREAKER_OPEN_SECONDS", 30))
+            },
+            "ADMISSION": {
+                # 同时进行的上游请求数上限（全局 / 每个令牌），置0不限制；两者都为0时关闭准入控制
+                "MAX_IN_FLIGHT": int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", 0)),
+                "PER_TOKEN": int(os.environ.get("ADMISSION_PER_TOKEN", 0)),
+                # 超过上限的请求排队等待，队列已满或等待超时后返回503/429并带上 Retry-After
+                "QUEUE_SIZE": int(os.environ.get("ADMISSION_QUEUE_SIZE", 100)),
+                "QUEUE_TIMEOUT_MS": int(os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", 5000))
+            },
+            "RECORD": {
+                # 录制成功的上游响应（原始NDJSON行及到达时间，Cookie脱敏）到 DIR 下的压缩文件，供离线回放，默认关闭；
+                # 按 SAMPLE_RATE 采样，写入量达到 MAX_MB 后停止，见 upstream_recorder.py
+                "ENABLED": os.environ.get("UPSTREAM_RECORD", "false").lower() == "true",
+                "DIR": os.environ.get("UPSTREAM_RECORD_DIR", "data/recordings"),
+                "SAMPLE_RATE": float(os.environ.get("UPSTREAM_RECORD_SAMPLE_RATE", 1.0)),
+                "MAX_MB": int(os.environ.get("UPSTREAM_RECORD_MAX_MB", 256))
             },
             "LOGGING": {
                 "LOG_LEVEL": os.environ.get("LOG_LEVEL", "ERROR").upper(),
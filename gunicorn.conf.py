@@ -0,0 +1,31 @@
+"""
+gunicorn 多进程部署配置（threaded 模式的 Flask 应用）:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+进程数取 WORKERS，每个进程的线程数取 WSGI_WORKERS。各进程启动后各自初始化，
+令牌状态通过 TOKEN_SHARED_DB 指定的 SQLite 文件共享（未配置时使用 TOKEN_DATA_DIR/tokens.db，见 token_shared.py）。
+也可以不依赖 gunicorn，直接 WORKERS=8 python app.py。
+"""
+import os
+import secrets
+
+from config import config_manager
+from token_shared import prepare_shared_db
+
+bind = f"0.0.0.0:{config_manager.get('SERVER.PORT')}"
+workers = config_manager.get("SERVER.WORKERS", 1)
+threads = config_manager.get("SERVER.WSGI_WORKERS", 10)
+worker_class = "gthread"
+# 流式响应可能持续数分钟，gthread 的超时只针对进程心跳，这里放宽避免误杀
+timeout = 300
+
+# 各进程共用同一个会话密钥，否则管理后台的登录状态只在一个进程内有效
+os.environ.setdefault("FLASK_SECRET_KEY", secrets.token_hex(16))
+prepare_shared_db(workers)
+
+
+def post_worker_init(worker):
+    from app import initialization
+
+    initialization()
@@ -0,0 +1,92 @@
+"""
+上游对冲请求（hedged request）的时机与统计
+
+上游首行的延迟有长尾：少数令牌或线路会卡住数秒，其余的几百毫秒就开始输出。开启对冲后，
+请求发出后超过对冲延迟仍未收到首行时，用另一个令牌再发一次，先开始输出的一方胜出，另一方被中断。
+
+对冲延迟可以固定（HEDGE_DELAY_MS），也可以为0，此时取最近首行延迟的p95，限制在
+[MIN_DELAY_MS, MAX_DELAY_MS] 之间；样本不足时使用 MAX_DELAY_MS。
+"""
+import threading
+from collections import deque
+
+# 学习对冲延迟使用的样本数，以及开始使用学习值所需的最少样本数
+SAMPLE_WINDOW = 500
+MIN_SAMPLES = 20
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+class HedgePolicy:
+    def __init__(self, delay_ms, min_delay_ms, max_delay_ms):
+        self.fixed_delay = delay_ms / 1000 if delay_ms > 0 else None
+        self.min_delay = min_delay_ms / 1000
+        self.max_delay = max_delay_ms / 1000
+        self._lock = threading.Lock()
+        # 上游首行延迟（每个请求各自从发出算起），用于学习对冲延迟
+        self._samples = deque(maxlen=SAMPLE_WINDOW)
+        self._learned = None
+        self._since_update = 0
+        # 客户端实际等待的首行延迟，以及首个请求自身的首行延迟（即不对冲时的等待时间）
+        self._delivered = deque(maxlen=SAMPLE_WINDOW)
+        self._primary = deque(maxlen=SAMPLE_WINDOW)
+        self.stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "skipped": 0}
+
+    def delay(self):
+        """当前的对冲延迟（秒）"""
+        if self.fixed_delay is not None:
+            return self.fixed_delay
+        with self._lock:
+            if self._learned is None:
+                return self.max_delay
+            return self._learned
+
+    def record_sample(self, ttfb):
+        with self._lock:
+            self._samples.append(ttfb)
+            self._since_update += 1
+            if len(self._samples) >= MIN_SAMPLES and (self._learned is None or self._since_update >= 50):
+                self._since_update = 0
+                p95 = _percentile(sorted(self._samples), 95)
+                self._learned = min(max(p95, self.min_delay), self.max_delay)
+
+    def record_delivered(self, ttfb, hedged, hedge_won):
+        """记录客户端等到首行的时间（从首个请求发出算起）"""
+        with self._lock:
+            self.stats["requests"] += 1
+            if hedged:
+                self.stats["hedged"] += 1
+            if hedge_won:
+                self.stats["hedge_wins"] += 1
+            self._delivered.append(ttfb)
+
+    def record_unhedged(self, ttfb):
+        """记录首个请求自身的首行延迟，即不对冲时客户端需要等待的时间（落败后仍在其首行到达时记录）"""
+        with self._lock:
+            self._primary.append(ttfb)
+
+    def record_skipped(self):
+        """已超过对冲延迟，但没有其他可用令牌可以对冲"""
+        with self._lock:
+            self.stats["skipped"] += 1
+
+    def get_stats(self):
+        with self._lock:
+            delivered = sorted(self._delivered)
+            primary = sorted(self._primary)
+            requests = self.stats["requests"]
+            stats = {
+                **self.stats,
+                "hedge_rate": round(self.stats["hedged"] / requests, 4) if requests else 0.0,
+                "delay_ms": round((self.fixed_delay or self._learned or self.max_delay) * 1000, 1),
+                "learned": self.fixed_delay is None and self._learned is not None
+            }
+        for pct in (50, 95, 99):
+            stats[f"ttfb_p{pct}_ms"] = round(_percentile(delivered, pct) * 1000, 1)
+        stats["unhedged_ttfb_p99_ms"] = round(_percentile(primary, 99) * 1000, 1)
+        stats["p99_saved_ms"] = round(stats["unhedged_ttfb_p99_ms"] - stats["ttfb_p99_ms"], 1)
+        return stats
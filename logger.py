@@ -1,9 +1,69 @@
 import os
 import sys
-import inspect
+import queue
+import threading
+
+# 与 loguru 一致的级别数值，用于在进入 loguru 之前判断是否需要记录
+LEVELS = {"TRACE": 5, "DEBUG": 10, "INFO": 20, "SUCCESS": 25, "WARNING": 30, "ERROR": 40, "CRITICAL": 50}
+DEBUG, INFO, WARNING, ERROR = LEVELS["DEBUG"], LEVELS["INFO"], LEVELS["WARNING"], LEVELS["ERROR"]
+
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{file.name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> | "
+    "<level>[{extra[source]}] {message}</level>"
+)
+
+
+class QueuedStream:
+    """
+    后台写出的流：loguru 在调用方线程中完成格式化，这里只把结果放入队列，由后台线程写入终端。
+    loguru 自带的 enqueue 会把每条记录序列化后经由进程间队列传递，单条开销反而高于直接写出。
+    队列满时调用方等待，不丢日志；移除handler（包括进程退出时）会先写完队列中的日志。
+    """
+
+    def __init__(self, stream, max_size=10000):
+        self.stream = stream
+        self._queue = queue.Queue(max_size)
+        self._thread = threading.Thread(target=self._run, daemon=True, name="LogWriter")
+        self._thread.start()
+
+    def write(self, message):
+        self._queue.put(message)
+
+    def _run(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+            try:
+                self.stream.write(message)
+                # 队列暂时清空时才刷新，连续的日志合并写出
+                if self._queue.empty():
+                    self.stream.flush()
+            except Exception:
+                pass
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
 
 
 class Logger:
+    """
+    对 loguru 的简单封装，日志格式为 "[来源] 消息"。
+
+    低于当前级别的调用在进入 loguru 之前直接返回，不获取调用位置，也不拼接消息；
+    消息中的 {} 占位符由后续参数填充，只在确实输出时才格式化：
+        logger.info("当前令牌: {}...", "Server", token[:50])
+
+    相关环境变量（直接读取环境变量，避免与 config 循环导入）：
+    - LOG_LEVEL: 日志级别，默认 ERROR
+    - LOG_ENQUEUE: 终端日志是否由后台线程写出，默认 true，请求线程不等待终端或日志采集管道
+    - LOG_FORMAT: text 或 json（每行一个JSON对象）
+    - LOG_FILE: 额外写入的日志文件（带缓冲），按 LOG_ROTATION 轮转（默认 100 MB），保留 LOG_RETENTION（默认 7 days）
+    - LOG_DIAGNOSE: 异常堆栈中是否显示变量值，默认 false（可能包含令牌等敏感信息，且开销较大）
+    """
     _instance = None
 
     def __new__(cls):
@@ -14,6 +74,10 @@ class Logger:
     def __init__(self):
         if not hasattr(self, 'initialized'):
             self.initialized = True
+            self.level_no = LEVELS.get(self._get_log_level_from_env(), LEVELS["ERROR"])
+            self.handler_ids = []
+            # 按来源缓存已绑定 source 的 loguru logger
+            self._bound_loggers = {}
             self._init_logger()
 
     def _init_logger(self):
@@ -28,108 +92,95 @@ class Logger:
         """从环境变量获取日志级别，避免循环导入"""
         return os.environ.get("LOG_LEVEL", "ERROR").upper()
 
+    @staticmethod
+    def _env_flag(name, default):
+        return os.environ.get(name, default).lower() == "true"
+
+    def _add_handlers(self, level):
+        serialize = os.environ.get("LOG_FORMAT", "text").lower() == "json"
+        options = {
+            "level": level,
+            "format": TEXT_FORMAT,
+            "serialize": serialize,
+            "backtrace": True,
+            "diagnose": self._env_flag("LOG_DIAGNOSE", "false")
+        }
+        stream = QueuedStream(sys.stderr) if self._env_flag("LOG_ENQUEUE", "true") else sys.stderr
+        handler_ids = [self.logger.add(stream, colorize=not serialize, **options)]
+
+        log_file = os.environ.get("LOG_FILE")
+        if log_file:
+            handler_ids.append(self.logger.add(
+                log_file,
+                rotation=os.environ.get("LOG_ROTATION", "100 MB"),
+                retention=os.environ.get("LOG_RETENTION", "7 days"),
+                encoding="utf-8",
+                **options
+            ))
+        return handler_ids
+
     def _setup_logger(self):
         # 移除默认handler
         self.logger.remove()
-
-        # 从环境变量获取日志级别
-        level = self._get_log_level_from_env()
-
-        # 设置格式
-        format = (
-            "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
-            "<level>{level: <8}</level> | "
-            "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
-            "<level>{message}</level>"
-        )
-
-        self.handler_id = self.logger.add(
-            sys.stderr,
-            level=level,
-            format=format,
-            colorize=True,
-            backtrace=True,
-            diagnose=True
-        )
+        self.handler_ids = self._add_handlers(self._get_log_level_from_env())
 
     def set_level(self, level):
         """动态设置日志级别"""
-        if self.logger and hasattr(self, 'handler_id'):
-            try:
-                # 移除旧的handler
-                self.logger.remove(self.handler_id)
-
-                # 设置格式
-                format = (
-                    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> | "
-                    "<level>{level: <8}</level> | "
-                    "<cyan>{extra[filename]}</cyan>:<cyan>{extra[function]}</cyan>:<cyan>{extra[lineno]}</cyan> | "
-                    "<level>{message}</level>"
-                )
-
-                # 添加新的handler
-                self.handler_id = self.logger.add(
-                    sys.stderr,
-                    level=level,
-                    format=format,
-                    colorize=True,
-                    backtrace=True,
-                    diagnose=True
-                )
-                return True
-            except Exception as e:
-                print(f"Failed to set log level: {e}")
-                return False
-        return False
-
-    def _get_caller_info(self):
-        frame = inspect.currentframe()
+        level = level.upper()
+        if level not in LEVELS:
+            return False
+        if self.logger is None:
+            self.level_no = LEVELS[level]
+            return True
         try:
-            caller_frame = frame.f_back.f_back
-            full_path = caller_frame.f_code.co_filename
-            function = caller_frame.f_code.co_name
-            lineno = caller_frame.f_lineno
-
-            filename = os.path.basename(full_path)
-
-            return {
-                'filename': filename,
-                'function': function,
-                'lineno': lineno
-            }
-        finally:
-            del frame
-
-    def info(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
-            self.logger.bind(**caller_info).info(f"[{source}] {message}")
-        else:
-            print(f"[INFO] [{source}] {message}")
-
-    def error(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
+            # 移除旧的handler（开启 enqueue 时会先写完队列中的日志）
+            for handler_id in self.handler_ids:
+                self.logger.remove(handler_id)
+            # 添加新的handler
+            self.handler_ids = self._add_handlers(level)
+            self.level_no = LEVELS[level]
+            return True
+        except Exception as e:
+            print(f"Failed to set log level: {e}")
+            return False
+
+    def is_enabled(self, level):
+        """指定级别的日志当前是否会输出，用于跳过只为日志准备的昂贵计算"""
+        return LEVELS[level] >= self.level_no
+
+    def _bound(self, source):
+        bound = self._bound_loggers.get(source)
+        if bound is None:
+            bound = self._bound_loggers[source] = self.logger.bind(source=source)
+        return bound
+
+    def _log(self, method, message, source, args, exception=False):
+        if args:
+            message = message.format(*args)
+        if self.logger is None:
+            print(f"[{method.upper()}] [{source}] {message}")
+            return
+        # depth=2 指向调用 info/error 等方法的位置，由 loguru 获取文件名、函数和行号；
+        # 按级别调用对应方法，loguru 的 log(级别名) 需要额外查找级别，开销明显更高
+        getattr(self._bound(source).opt(depth=2, exception=exception), method)(message)
+
+    def info(self, message, source="API", *args):
+        if self.level_no <= INFO:
+            self._log("info", message, source, args)
+
+    def error(self, message, source="API", *args):
+        if self.level_no <= ERROR:
             if isinstance(message, Exception):
-                self.logger.bind(**caller_info).exception(f"[{source}] {str(message)}")
+                self._log("error", str(message), source, args, exception=True)
             else:
-                self.logger.bind(**caller_info).error(f"[{source}] {message}")
-        else:
-            print(f"[ERROR] [{source}] {message}")
-
-    def warning(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
-            self.logger.bind(**caller_info).warning(f"[{source}] {message}")
-        else:
-            print(f"[WARNING] [{source}] {message}")
-
-    def debug(self, message, source="API"):
-        if self.logger:
-            caller_info = self._get_caller_info()
-            self.logger.bind(**caller_info).debug(f"[{source}] {message}")
-        else:
-            print(f"[DEBUG] [{source}] {message}")
-
-
-logger = Logger()
\ No newline at end of file
+                self._log("error", message, source, args)
+
+    def warning(self, message, source="API", *args):
+        if self.level_no <= WARNING:
+            self._log("warning", message, source, args)
+
+    def debug(self, message, source="API", *args):
+        if self.level_no <= DEBUG:
+            self._log("debug", message, source, args)
+
+logger = Logger()
@@ -0,0 +1,111 @@
+"""
+历史消息规范化缓存
+
+客户端每一轮都会重发完整的对话历史，旧消息的规范化结果不会变化。这里按消息内容的
+blake2b 摘要缓存规范化后的文本，按占用内存做LRU淘汰，新一轮只需要处理新增的消息。
+图片的数据不参与摘要（规范化后都是 [图片]），大段base64不会被重复哈希。
+"""
+import sys
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+
+# 每个条目除文本外的大致开销（摘要、字典节点）
+ENTRY_OVERHEAD = 160
+
+
+def _update_text(digest, tag, text):
+    data = text.encode("utf-8", "surrogatepass")
+    digest.update(tag + len(data).to_bytes(8, "little"))
+    digest.update(data)
+
+
+def content_key(content):
+    """计算消息内容的摘要；无法识别的结构返回None，不缓存"""
+    digest = blake2b(digest_size=16)
+    if isinstance(content, str):
+        _update_text(digest, b"s", content)
+    elif isinstance(content, list):
+        digest.update(b"l")
+        for item in content:
+            if not isinstance(item, dict):
+                return None
+            if item.get("type") == "image_url":
+                digest.update(b"i")
+            elif item.get("type") == "text":
+                if not isinstance(item.get("text"), str):
+                    return None
+                _update_text(digest, b"t", item["text"])
+            else:
+                digest.update(b"o")
+    elif isinstance(content, dict):
+        if content.get("type") == "text" and isinstance(content.get("text"), str):
+            _update_text(digest, b"d", content["text"])
+        else:
+            return None
+    else:
+        return None
+    return digest.digest()
+
+
+class NormalizationCache:
+    """按内存上限淘汰的LRU缓存，max_bytes 为0时不缓存"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "uncacheable": 0}
+
+    def get_or_compute(self, content, normalize):
+        if self.max_bytes <= 0:
+            return normalize(content)
+
+        key = content_key(content)
+        if key is None:
+            with self._lock:
+                self.stats["uncacheable"] += 1
+            return normalize(content)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[0]
+            self.stats["misses"] += 1
+
+        # 规范化在锁外进行，并发的相同消息最多重复计算一次
+        text = normalize(content)
+        size = sys.getsizeof(text) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return text
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (text, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.stats["evictions"] += 1
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+            }
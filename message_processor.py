@@ -2,10 +2,294 @@ import uuid
 import time
 import json
 import re
+from json.encoder import encode_basestring_ascii
 from logger import logger
+from upstream_decoder import WebResultsEvent
+from message_cache import NormalizationCache
 from config import config_manager
 
 
+# 历史消息的规范化结果按内容缓存，多轮对话中只需处理新增的消息（默认关闭）
+normalization_cache = NormalizationCache(config_manager.get("MESSAGE_CACHE.MAX_MB", 0) * 1024 * 1024)
+
+
+class StreamChunkEncoder:
+    """
+    流式响应的SSE帧编码器，每个补全创建一个。
+    除增量文本外，帧的内容在整个补全中都不变，因此前后缀只在创建时序列化一次，
+    每个分片只需转义文本本身；所有分片共用同一个补全id。
+    输出与 json.dumps(create_chat_response(text, model, True)) 的格式一致。
+    """
+    __slots__ = ("completion_id", "created", "prefix")
+
+    SUFFIX = "}}]}\n\n"
+
+    def __init__(self, model, completion_id=None, created=None):
+        self.completion_id = completion_id or f"chatcmpl-{uuid.uuid4()}"
+        self.created = int(time.time()) if created is None else created
+        self.prefix = (
+            f'data: {{"id": {json.dumps(self.completion_id)}, "created": {self.created}, '
+            f'"model": {json.dumps(model)}, "object": "chat.completion.chunk", '
+            f'"choices": [{{"index": 0, "delta": {{"content": '
+        )
+
+    def encode(self, text):
+        return self.prefix + encode_basestring_ascii(text) + self.SUFFIX
+
+
+class ChunkCoalescer:
+    """
+    把上游的细碎分片合并成较大的SSE帧：缓冲的文本达到字节上限，或距第一个缓冲分片超过时间上限时输出一帧。
+    思考标签等边界分片会先输出已缓冲的文本，再立即单独输出。
+    """
+    __slots__ = ("encoder", "max_bytes", "max_delay", "pending", "pending_bytes", "deadline")
+
+    def __init__(self, encoder, max_bytes=256, max_delay=0.02):
+        self.encoder = encoder
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.pending = []
+        self.pending_bytes = 0
+        self.deadline = 0.0
+
+    def write(self, text):
+        now = time.monotonic()
+        if not self.pending:
+            self.deadline = now + self.max_delay
+        self.pending.append(text)
+        self.pending_bytes += len(text.encode("utf-8"))
+        if self.pending_bytes >= self.max_bytes or now >= self.deadline:
+            return self.flush()
+        return []
+
+    def boundary(self, text):
+        return self.flush() + [self.encoder.encode(text)]
+
+    def due(self):
+        return bool(self.pending) and time.monotonic() >= self.deadline
+
+    def flush(self):
+        if not self.pending:
+            return []
+        frame = self.encoder.encode("".join(self.pending))
+        self.pending = []
+        self.pending_bytes = 0
+        return [frame]
+
+
+# 工具输出中需要过滤的标签
+RENDER_OPEN = "<grok:render"
+RENDER_CLOSE = "</grok:render>"
+CARD_OPEN = "<xai:tool_usage_card>"
+CARD_CLOSE = "</xai:tool_usage_card>"
+CDATA_OPEN = "![CDATA["
+CDATA_CLOSE = "]]"
+
+RENDER_PATTERN = re.compile(r'<grok:render[^>]*>.*?</grok:render>', re.DOTALL)
+CDATA_PATTERN = re.compile(r'!\[CDATA\[(.*?)\]\]', re.DOTALL)
+
+
+def _suffix_pattern(*markers):
+    """匹配文本末尾为某个标记被截断的前缀（最长的优先）"""
+    prefixes = sorted({marker[:size] for marker in markers for size in range(1, len(marker))}, key=len, reverse=True)
+    return re.compile("(?:%s)\\Z" % "|".join(map(re.escape, prefixes)))
+
+
+# 各状态下要查找的标记，以及分片末尾需要暂存的不完整标记
+TEXT_SCAN = re.compile(r'<grok:render|<xai:tool_usage_card>|!\[CDATA\[')
+CARD_SCAN = re.compile(r'</xai:tool_usage_card>|!\[CDATA\[')
+TEXT_PARTIAL = _suffix_pattern(RENDER_OPEN, CARD_OPEN, CDATA_OPEN)
+RENDER_PARTIAL = _suffix_pattern(RENDER_CLOSE)
+CARD_PARTIAL = _suffix_pattern(CARD_CLOSE, CDATA_OPEN)
+MARKER_SPAN = max(map(len, (RENDER_OPEN, RENDER_CLOSE, CARD_OPEN, CARD_CLOSE, CDATA_OPEN)))
+
+
+def _partial_suffix(text, pos, pattern):
+    """text[pos:] 末尾可能是被截断的标记时，返回该部分的起始位置，否则返回 len(text)"""
+    match = pattern.search(text, max(pos, len(text) - MARKER_SPAN))
+    return match.start() if match else len(text)
+
+
+class ToolOutputFilter:
+    """
+    流式工具输出过滤器，每个流创建一个，在分片之间保留未闭合标签的状态：
+    - <grok:render ...>...</grok:render> 整段移除
+    - <xai:tool_usage_card>...</xai:tool_usage_card> 整段移除，其中包含 "query" 的CDATA参数保留
+    - 卡片外包含 "query" 的CDATA参数替换为参数内容，其余文本原样输出
+    分片末尾可能是标签的一部分时暂存到下一个分片再判断；不含 "<" 和 "!" 的分片直接输出。
+    """
+    __slots__ = ("mode", "parent", "pending", "cdata", "cdata_size", "query_run")
+
+    TEXT, RENDER, CARD, CDATA = range(4)
+    # 未闭合的CDATA参数最多缓冲的字符数，超过后按普通文本（或卡片内容）处理
+    MAX_CDATA = 65536
+
+    def __init__(self):
+        self.mode = self.TEXT
+        self.parent = self.TEXT
+        self.pending = ""
+        self.cdata = []
+        self.cdata_size = 0
+        # 连续输出的CDATA参数之间只用一个换行分隔
+        self.query_run = False
+
+    def feed(self, text):
+        if self.mode == self.TEXT and not self.pending and "<" not in text and "!" not in text:
+            if text:
+                self.query_run = False
+            return text
+
+        data = self.pending + text
+        self.pending = ""
+        out = []
+        pos = 0
+        size = len(data)
+
+        while pos < size:
+            if self.mode == self.TEXT:
+                match = TEXT_SCAN.search(data, pos)
+                if match is None:
+                    hold = _partial_suffix(data, pos, TEXT_PARTIAL)
+                    self._output(out, data[pos:hold])
+                    self.pending = data[hold:]
+                    break
+                self._output(out, data[pos:match.start()])
+                pos = match.end()
+                marker = match.group()
+                if marker == RENDER_OPEN:
+                    self.mode = self.RENDER
+                elif marker == CARD_OPEN:
+                    self.mode = self.CARD
+                else:
+                    self._enter_cdata(self.TEXT)
+
+            elif self.mode == self.RENDER:
+                index = data.find(RENDER_CLOSE, pos)
+                if index < 0:
+                    self.pending = data[_partial_suffix(data, pos, RENDER_PARTIAL):]
+                    break
+                pos = index + len(RENDER_CLOSE)
+                self.mode = self.TEXT
+
+            elif self.mode == self.CARD:
+                match = CARD_SCAN.search(data, pos)
+                if match is None:
+                    self.pending = data[_partial_suffix(data, pos, CARD_PARTIAL):]
+                    break
+                pos = match.end()
+                if match.group() == CDATA_OPEN:
+                    self._enter_cdata(self.CARD)
+                else:
+                    self.mode = self.TEXT
+
+            else:
+                index = data.find(CDATA_CLOSE, pos)
+                if index < 0:
+                    hold = 1 if data.endswith("]") else 0
+                    self._append_cdata(out, data[pos:size - hold])
+                    self.pending = data[size - hold:]
+                    break
+                self._append_cdata(out, data[pos:index])
+                pos = index + len(CDATA_CLOSE)
+                if self.mode == self.CDATA:
+                    self._close_cdata(out)
+
+        return "".join(out)
+
+    def flush(self):
+        """流结束（或思考阶段结束）时调用，输出暂存的文本；未闭合的标签内容丢弃"""
+        out = []
+        if self.mode == self.TEXT:
+            self._output(out, self.pending)
+        elif self.mode == self.CDATA and self.parent == self.TEXT:
+            self._output(out, CDATA_OPEN + "".join(self.cdata) + self.pending)
+        self.mode = self.TEXT
+        self.pending = ""
+        self.cdata = []
+        self.cdata_size = 0
+        return "".join(out)
+
+    def _output(self, out, text):
+        if text:
+            out.append(text)
+            self.query_run = False
+
+    def _enter_cdata(self, parent):
+        self.parent = parent
+        self.mode = self.CDATA
+        self.cdata = []
+        self.cdata_size = 0
+
+    def _append_cdata(self, out, text):
+        self.cdata.append(text)
+        self.cdata_size += len(text)
+        if self.cdata_size > self.MAX_CDATA:
+            # 异常超长的参数不再等待闭合
+            if self.parent == self.TEXT:
+                self._output(out, CDATA_OPEN + "".join(self.cdata))
+            self.mode = self.parent
+            self.cdata = []
+            self.cdata_size = 0
+
+    def _close_cdata(self, out):
+        content = "".join(self.cdata)
+        self.mode = self.parent
+        self.cdata = []
+        self.cdata_size = 0
+        if '"query"' in content:
+            out.append(content + "\n" if self.query_run else "\n" + content + "\n")
+            self.query_run = True
+        elif self.parent == self.TEXT:
+            self._output(out, CDATA_OPEN + content + CDATA_CLOSE)
+
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+INLINE_IMAGE_PREFIX = "![image](data:"
+INLINE_IMAGE_BASE64 = "base64,"
+
+
+def _remove_think_blocks(text):
+    """移除 <think>...</think>（每个 <think> 匹配其后第一个 </think>），未闭合的 <think> 保留"""
+    parts = []
+    pos = 0
+    while True:
+        start = text.find(THINK_OPEN, pos)
+        if start < 0:
+            break
+        end = text.find(THINK_CLOSE, start + len(THINK_OPEN))
+        if end < 0:
+            break
+        parts.append(text[pos:start])
+        pos = end + len(THINK_CLOSE)
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def _replace_inline_images(text):
+    """把 ![image](data:...base64,...) 替换为 [图片]；与原正则一致，整个链接须在同一行内"""
+    parts = []
+    pos = 0
+    search = 0
+    while True:
+        start = text.find(INLINE_IMAGE_PREFIX, search)
+        if start < 0:
+            break
+        line_end = text.find("\n", start)
+        if line_end < 0:
+            line_end = len(text)
+        marker = text.find(INLINE_IMAGE_BASE64, start + len(INLINE_IMAGE_PREFIX), line_end)
+        end = text.find(")", marker + len(INLINE_IMAGE_BASE64), line_end) if marker >= 0 else -1
+        if end < 0:
+            search = start + 1
+            continue
+        parts.append(text[pos:start])
+        parts.append("[图片]")
+        pos = search = end + 1
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
 class MessageProcessor:
     @staticmethod
     def create_chat_response(message, model, is_stream=False):
@@ -49,13 +333,51 @@ class MessageProcessor:
 
     @staticmethod
     def remove_think_tags(text):
+        """移除历史消息中的思考内容，并把内嵌的base64图片替换为 [图片]；逐段 str.find，不做正则回溯"""
         if not isinstance(text, str):
             return text
-            
-        text = re.sub(r'<think>[\s\S]*?<\/think>', '', text).strip()
-        text = re.sub(r'!\[image]\(data:.*?base64,.*?\)', '[图片]', text)
+
+        if THINK_OPEN in text:
+            text = _remove_think_blocks(text)
+        text = text.strip()
+        if INLINE_IMAGE_PREFIX in text:
+            text = _replace_inline_images(text)
         return text
 
+    @staticmethod
+    def format_web_results(web_results):
+        formatted_results = []
+        for result in web_results:
+            if result.get("title") and result.get("url"):
+                title = result["title"].strip()
+                url = result["url"].strip()
+                if title and url:
+                    formatted_results.append(f"[{title}]({url})")
+
+        if formatted_results:
+            return '\n' + '\n'.join(formatted_results) + '\n'
+        return ''
+
+    @staticmethod
+    def process_tool_event(event, tool_filter=None):
+        """
+        与 process_tool_response 相同的规范化，输入为 upstream_decoder 解码出的分片事件。
+        传入流的 ToolOutputFilter 时，跨分片的标签也能被正确过滤。
+        """
+        # 过滤重复的 xai:tool_usage_card
+        if event.tag == "tool_usage_card" and "xai:tool_usage_card" in event.text:
+            if tool_filter is not None:
+                # 卡片可能在后续分片中才闭合，仍需让过滤器进入卡片状态
+                tool_filter.feed(event.text)
+            return ''
+        if isinstance(event, WebResultsEvent):
+            return MessageProcessor.format_web_results(event.results)
+        if not event.text:
+            return ''
+        if tool_filter is not None:
+            return tool_filter.feed(event.text)
+        return MessageProcessor.process_tool_response(event.text)
+
     @staticmethod
     def process_tool_response(response_data):
         """规范化响应内容"""
@@ -69,19 +391,7 @@ class MessageProcessor:
 
             # 处理web搜索结果
             if response_data.get("webSearchResults"):
-                web_results = response_data["webSearchResults"].get("results", [])
-                if web_results:
-                    formatted_results = []
-                    for result in web_results:
-                        if result.get("title") and result.get("url"):
-                            title = result["title"].strip()
-                            url = result["url"].strip()
-                            if title and url:
-                                formatted_results.append(f"[{title}]({url})")
-
-                    if formatted_results:
-                        return '\n' + '\n'.join(formatted_results) + '\n'
-                return ''
+                return MessageProcessor.format_web_results(response_data["webSearchResults"].get("results", []))
 
             # 如果是字典但没有web搜索结果，提取token字段
             text = response_data.get("token", "")
@@ -90,12 +400,15 @@ class MessageProcessor:
         else:
             return ''
 
+        # 不含任何标签的普通文本直接返回
+        if '<' not in text and '!' not in text:
+            return text
+
         # 移除 grok:render 标签及内容
-        text = re.sub(r'<grok:render[^>]*>.*?</grok:render>', '', text, flags=re.DOTALL)
+        text = RENDER_PATTERN.sub('', text)
 
         # 仅保留CDATA参数
-        cdata_pattern = r'!\[CDATA\[(.*?)\]\]'
-        matches = re.findall(cdata_pattern, text, re.DOTALL)
+        matches = CDATA_PATTERN.findall(text)
 
         if matches:
             # 过滤不含 "query" 的 CDATA
@@ -115,14 +428,16 @@ class MessageProcessor:
     @staticmethod
     def process_content(content):
         if isinstance(content, list):
-            text_content = ''
+            parts = []
             for item in content:
                 if item["type"] == 'image_url':
-                    text_content += ("[图片]" if not text_content else '\n[图片]')
+                    parts.append("[图片]")
                 elif item["type"] == 'text':
                     processed_text = MessageProcessor.remove_think_tags(item["text"])
-                    text_content += (processed_text if not text_content else '\n' + processed_text)
-            return text_content
+                    # 开头的空文本不产生多余的换行
+                    if parts or processed_text:
+                        parts.append(processed_text)
+            return '\n'.join(parts)
         elif isinstance(content, dict) and content is not None:
             if content["type"] == 'image_url':
                 return "[图片]"
@@ -131,26 +446,30 @@ class MessageProcessor:
         return MessageProcessor.remove_think_tags(MessageProcessor.process_message_content(content))
 
     @staticmethod
-    def prepare_chat_messages(messages, model):
+    def flatten_messages(messages):
+        """把消息列表拼接为对话文本，连续同角色的消息合并为一段；按片段收集后一次拼接"""
         processed_messages = []
         last_role = None
-        last_content = ''
-        
+        group = None
+
         for current in messages:
             role = 'assistant' if current["role"] == 'assistant' else 'user'
-            text_content = MessageProcessor.process_content(current.get("content", ""))
-            
+            text_content = normalization_cache.get_or_compute(current.get("content", ""), MessageProcessor.process_content)
+
             if text_content:
-                if role == last_role and last_content:
-                    last_content += '\n' + text_content
-                    processed_messages[-1] = f"{role.upper()}: {last_content}"
+                if role == last_role:
+                    group.append(text_content)
                 else:
-                    processed_messages.append(f"{role.upper()}: {text_content}")
-                    last_content = text_content
+                    group = [f"{role.upper()}: {text_content}"]
+                    processed_messages.append(group)
                     last_role = role
-        
-        conversation = '\n'.join(processed_messages)
-        
+
+        return '\n'.join('\n'.join(group) for group in processed_messages)
+
+    @staticmethod
+    def prepare_chat_messages(messages, model):
+        conversation = MessageProcessor.flatten_messages(messages)
+
         if not conversation.strip():
             raise ValueError('消息内容为空!')
         
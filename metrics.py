@@ -0,0 +1,333 @@
+"""
+Prometheus 文本格式的运行指标
+
+不依赖 prometheus_client：计数器、仪表和直方图各自持有一把锁，记录一次只是一次字典查找加一次自增，
+开销在微秒以下，可以在生产环境常开（见 benchmarks/bench_metrics.py）。/metrics 抓取时才生成文本。
+
+ServiceMetrics 汇总对话接口的指标，由 RequestHandler 记录：
+- 请求数（按模型、状态码、是否流式）、进行中的请求数
+- 各阶段耗时直方图：上游建连、首个上游数据行、首个SSE字节、总耗时，以及每秒token数
+- 按令牌、按代理的上游响应计数（200 / 429 / 403 / 其他）
+- 重试次数（按失败分类）、放弃重试的次数（按原因）
+- 准入控制：排队等待时间直方图、拒绝次数（按原因），以及抓取时读取的进行中上游请求数和等待队列长度
+- 按API Key（名称）的配额拒绝次数
+令牌池大小在抓取时从 AuthTokenManager 读取，熔断器状态在抓取时从各 BreakerRegistry 读取。
+"""
+import time
+import threading
+from bisect import bisect_left
+from functools import lru_cache
+from hashlib import blake2b
+from token_manager import extract_sso
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CONNECT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+QUEUE_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            series = list(self._series.items())
+        return self._header() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}" for labels, value in series
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._series[labels] = value
+
+    def replace(self, values):
+        """整体替换所有序列（用于抓取时才采集的值），values 为 {标签值元组: 值}"""
+        with self._lock:
+            self._series = dict(values)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        # 每个序列为 [各桶计数..., +Inf桶计数, 总和]，桶计数在输出时再累加
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        lines = self._header()
+        bounds = [_format_value(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(bounds, values):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}")
+            label_text = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(values[-1])}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+@lru_cache(maxsize=65536)
+def token_label(token):
+    """令牌在指标中的标识：sso值的短摘要，避免把凭据写进指标；结果缓存，请求路径上只需一次查找"""
+    return blake2b(extract_sso(token).encode("utf-8"), digest_size=4).hexdigest()
+
+
+def proxy_label(proxy):
+    """代理在指标中的标识：去掉认证信息，只保留地址"""
+    if not proxy:
+        return "direct"
+    scheme, _, rest = proxy.rpartition("://")
+    host = rest.rpartition("@")[2]
+    return f"{scheme}://{host}" if scheme else host
+
+
+class _ObservedStream:
+    """
+    不用生成器实现：未开始迭代的生成器被关闭时不会执行 finally，
+    客户端在首帧前断开时内层的上游流将无法关闭，进行中的请求数也不会减少
+    """
+
+    def __init__(self, metrics, frames, model, started):
+        self.metrics = metrics
+        self.frames = frames
+        self.model = model
+        self.started = started
+        self.first = True
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            frame = next(self.frames)
+        except BaseException:
+            self.close()
+            raise
+        if self.first:
+            self.first = False
+            self.metrics.first_byte.observe(time.monotonic() - self.started, self.model)
+        return frame
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # 先记录再关闭内层：关闭上游流可能要等剩余数据排空，总耗时只计到客户端收完或断开为止
+        self.metrics.request_finished(self.model, True, self.started, 200)
+        self.frames.close()
+
+
+class _AsyncObservedStream(_ObservedStream):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            frame = await self.frames.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+        if self.first:
+            self.first = False
+            self.metrics.first_byte.observe(time.monotonic() - self.started, self.model)
+        return frame
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.metrics.request_finished(self.model, True, self.started, 200)
+        await self.frames.aclose()
+
+
+class ServiceMetrics:
+    def __init__(self, token_manager=None, token_labels=True, breakers=None, admission=None):
+        self.token_manager = token_manager
+        # {类型: BreakerRegistry}，如 {"token": ..., "proxy": ...}
+        self.breaker_registries = breakers or {}
+        # {模式: 准入控制器}，如 {"sync": ..., "async": ...}
+        self.admission_controllers = admission or {}
+        # 令牌很多时可以关闭按令牌的标签，只保留按代理的计数
+        self.token_labels = token_labels
+        self.requests = Counter("grok_requests_total", "对话请求数", ("model", "status", "stream"))
+        self.in_flight = Gauge("grok_requests_in_flight", "进行中的对话请求数")
+        self.in_flight.set(0)
+        self.connect = Histogram(
+            "grok_upstream_connect_seconds", "新建上游连接的耗时（TCP、TLS及代理握手），复用连接不计入",
+            ("proxy",), CONNECT_BUCKETS
+        )
+        self.first_line = Histogram(
+            "grok_upstream_first_line_seconds", "从发出上游请求到收到首个数据行的耗时", ("model",)
+        )
+        self.first_byte = Histogram(
+            "grok_first_sse_byte_seconds", "从收到对话请求到发出首个SSE帧的耗时（仅流式）", ("model",)
+        )
+        self.duration = Histogram(
+            "grok_request_duration_seconds", "对话请求的总耗时，流式请求到流结束为止", ("model", "stream"),
+            DURATION_BUCKETS
+        )
+        self.tokens_per_second = Histogram(
+            "grok_upstream_tokens_per_second", "上游输出速度：token行数除以首行之后的传输时间", ("model",),
+            TOKENS_PER_SECOND_BUCKETS
+        )
+        self.upstream = Counter(
+            "grok_upstream_responses_total", "上游响应数，按令牌摘要、代理和状态（200/429/403/other）",
+            ("token", "proxy", "status")
+        )
+        self.retries = Counter("grok_upstream_retries_total", "上游请求的重试次数，按失败分类（rotate/backoff）", ("reason",))
+        self.retry_giveups = Counter(
+            "grok_upstream_retry_giveups_total", "失败后不再重试的次数，按原因（fatal/attempts/budget）", ("reason",)
+        )
+        self.breakers = Gauge("grok_circuit_breakers", "未关闭的熔断器数量，按类型（token/proxy）和状态", ("kind", "state"))
+        self.token_pool = Gauge("grok_token_pool_size", "令牌池大小，按模型和状态（available/cooling）", ("model", "state"))
+        self.token_total = Gauge("grok_tokens_total", "令牌总数")
+        self.admission_wait = Histogram(
+            "grok_admission_queue_wait_seconds", "上游请求获得准入名额前的排队等待时间", (), QUEUE_WAIT_BUCKETS
+        )
+        self.admission_rejections = Counter(
+            "grok_admission_rejections_total", "被准入控制拒绝的请求数，按原因（queue_full/queue_timeout/token_busy）",
+            ("reason",)
+        )
+        self.api_key_rejections = Counter(
+            "grok_api_key_rejections_total", "超出API Key配额被拒绝的请求数，按Key名称和原因（rate_limited/streams/model）",
+            ("key", "reason")
+        )
+        self.admission_in_flight = Gauge("grok_admission_in_flight", "占用准入名额的上游请求数，按服务模式", ("mode",))
+        self.admission_queue = Gauge("grok_admission_queue_depth", "等待准入名额的请求数，按服务模式", ("mode",))
+
+    def request_started(self):
+        self.in_flight.inc()
+        return time.monotonic()
+
+    def request_finished(self, model, stream, started, status):
+        self.in_flight.dec()
+        stream_label = "true" if stream else "false"
+        self.requests.inc(model, str(status), stream_label)
+        self.duration.observe(time.monotonic() - started, model, stream_label)
+
+    def record_upstream_response(self, token, proxy, response):
+        """记录一次上游响应的状态码，新建连接时记录建连耗时；response 可带有 connect_time"""
+        status_code = response.status_code
+        status = str(status_code) if status_code in (200, 429, 403) else "other"
+        proxy = proxy_label(proxy)
+        self.upstream.inc(token_label(token) if self.token_labels else "", proxy, status)
+        connect_time = getattr(response, "connect_time", None)
+        if connect_time is not None:
+            self.connect.observe(connect_time, proxy)
+
+    def record_upstream_stream(self, model, response, tokens):
+        """上游响应读取结束后记录首行延迟和输出速度；response 需带有 started_at / first_line_at"""
+        first_line_at = getattr(response, "first_line_at", None)
+        if first_line_at is None:
+            return
+        self.first_line.observe(first_line_at - response.started_at, model)
+        elapsed = time.monotonic() - first_line_at
+        if tokens and elapsed > 0:
+            self.tokens_per_second.observe(tokens / elapsed, model)
+
+    def observe_stream(self, frames, model, started):
+        """包装同步的SSE帧生成器，记录首个SSE字节和流结束时的总耗时"""
+        return _ObservedStream(self, frames, model, started)
+
+    def observe_stream_async(self, frames, model, started):
+        return _AsyncObservedStream(self, frames, model, started)
+
+    def _collect_token_pool(self):
+        if self.token_manager is None:
+            return
+        pool = self.token_manager.get_pool_stats()
+        self.token_total.set(pool["total"])
+        values = {}
+        for model, counts in pool["models"].items():
+            for state, count in counts.items():
+                values[(model, state)] = count
+        self.token_pool.replace(values)
+
+    def _collect_breakers(self):
+        values = {}
+        for kind, registry in self.breaker_registries.items():
+            for state, count in registry.count_states().items():
+                values[(kind, state)] = count
+        self.breakers.replace(values)
+
+    def _collect_admission(self):
+        in_flight, queue = {}, {}
+        for mode, controller in self.admission_controllers.items():
+            if controller.enabled:
+                stats = controller.get_stats()
+                in_flight[(mode,)] = stats["in_flight"]
+                queue[(mode,)] = stats["waiting"]
+        self.admission_in_flight.replace(in_flight)
+        self.admission_queue.replace(queue)
+
+    def render(self):
+        self._collect_token_pool()
+        self._collect_breakers()
+        self._collect_admission()
+        lines = []
+        for metric in (self.requests, self.in_flight, self.duration, self.first_byte, self.first_line, self.connect,
+                       self.tokens_per_second, self.upstream, self.retries, self.retry_giveups, self.breakers,
+                       self.token_total, self.token_pool, self.admission_in_flight, self.admission_queue,
+                       self.admission_wait, self.admission_rejections, self.api_key_rejections):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
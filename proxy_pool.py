@@ -0,0 +1,174 @@
+"""
+上游代理池
+
+PROXY 可以配置多个代理（socks5:// 或 http(s)://，逗号或换行分隔），启动时解析一次，
+之后每次请求只需选出一个代理并取用预先构造好的请求参数。未配置时池中只有一个直连线路。
+
+每个代理维护：
+- 首个响应的延迟 EWMA：请求优先选择延迟最低的健康代理，尚无样本的代理优先试用，
+  另有少量请求随机分配，避免一次偶然的慢响应让某个代理再也得不到流量
+- 封禁冷却：收到403（IP被封）后该代理在 BAN_COOLDOWN 秒内不再使用，请求换到其他代理重试（只有一条线路时不封禁）
+- 熔断器状态：由 RequestHandler 的代理熔断器维护，打开期间同样跳过
+
+开启 STICKY 后同一个令牌固定使用同一个代理（对健康代理做最高随机权重哈希），
+某个代理被封禁或熔断时只有原先落在它上面的令牌会换到其他代理。
+"""
+import time
+import random
+import threading
+from hashlib import blake2b
+from metrics import proxy_label
+
+# 延迟 EWMA 的平滑系数，以及随机分配给非最快代理的请求比例
+EWMA_ALPHA = 0.2
+EXPLORE_RATIO = 0.05
+
+
+def parse_proxy_list(value):
+    """解析逗号、空白或换行分隔的代理列表，去掉重复项"""
+    if not value:
+        return []
+    proxies = []
+    for item in value.replace(",", " ").split():
+        if item not in proxies:
+            proxies.append(item)
+    return proxies
+
+
+def build_proxy_options(proxy):
+    """把代理地址转换为 curl_cffi 的请求参数"""
+    if not proxy:
+        return {}
+    if proxy.startswith("socks5://"):
+        options = {"proxy": proxy}
+        if '@' in proxy:
+            auth_part = proxy.split('@')[0].split('://')[1]
+            if ':' in auth_part:
+                username, password = auth_part.split(':', 1)
+                options["proxy_auth"] = (username, password)
+        return options
+    return {"proxies": {"https": proxy, "http": proxy}}
+
+
+class ProxyEntry:
+    def __init__(self, url):
+        # 直连线路的 url 为空字符串，与会话池和熔断器使用的键一致
+        self.url = url
+        self.label = proxy_label(url)
+        self.options = build_proxy_options(url)
+        self.latency = None
+        self.banned_until = 0.0
+        self.stats = {"requests": 0, "errors": 0, "bans": 0}
+
+    def is_banned(self, now):
+        return self.banned_until > now
+
+
+class ProxyPool:
+    def __init__(self, proxies, ban_cooldown=600, sticky=False, breakers=None):
+        self.entries = [ProxyEntry(url) for url in proxies] or [ProxyEntry('')]
+        self.ban_cooldown = ban_cooldown
+        self.sticky = sticky
+        # 代理熔断器（BreakerRegistry），选择代理时跳过打开状态的
+        self.breakers = breakers
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _healthy(self, now, exclude):
+        return [entry for entry in self.entries if not entry.is_banned(now) and entry not in exclude]
+
+    def _allowed(self, entry):
+        return self.breakers is None or self.breakers.allow(entry.url)
+
+    @staticmethod
+    def _sticky_weight(token, entry):
+        return blake2b(f"{token}|{entry.url}".encode("utf-8"), digest_size=8).digest()
+
+    def choose(self, token=None, exclude=()):
+        """
+        为一次请求选择代理：跳过封禁中、熔断中以及 exclude 中的代理，没有可用代理时返回None。
+        单个代理时不做任何排序，直接检查其状态。
+        """
+        now = time.monotonic()
+        if len(self.entries) == 1:
+            entry = self.entries[0]
+            if entry.is_banned(now) or entry in exclude or not self._allowed(entry):
+                return None
+            return entry
+
+        candidates = self._healthy(now, exclude)
+        if not candidates:
+            return None
+        if self.sticky and token:
+            candidates.sort(key=lambda entry: self._sticky_weight(token, entry), reverse=True)
+        else:
+            self._random.shuffle(candidates)
+            if self._random.random() >= EXPLORE_RATIO:
+                # 没有延迟样本的代理排在最前（之间顺序随机），其余按延迟 EWMA 升序
+                candidates.sort(key=lambda entry: -1.0 if entry.latency is None else entry.latency)
+        for entry in candidates:
+            if self._allowed(entry):
+                return entry
+        return None
+
+    def available(self, exclude=()):
+        """是否还有未封禁的代理（不检查熔断器，避免占用半开探测）"""
+        return bool(self._healthy(time.monotonic(), exclude))
+
+    def all_banned(self):
+        now = time.monotonic()
+        return all(entry.is_banned(now) for entry in self.entries)
+
+    def record_latency(self, entry, latency):
+        """记录一次请求从发出到上游开始响应的耗时（包括对冲中落败的一方），更新延迟 EWMA"""
+        with self._lock:
+            entry.latency = latency if entry.latency is None else entry.latency + EWMA_ALPHA * (latency - entry.latency)
+
+    def record_status(self, entry, status_code):
+        """
+        记录一次上游响应的状态码，403 使该代理进入封禁冷却。
+        只有一条线路时不封禁：没有可换的代理，交给代理熔断器按失败率快速失败并定期探测恢复。
+        """
+        with self._lock:
+            entry.stats["requests"] += 1
+            if status_code == 403:
+                entry.stats["bans"] += 1
+                if len(self.entries) > 1:
+                    entry.banned_until = time.monotonic() + self.ban_cooldown
+
+    def record_error(self, entry):
+        with self._lock:
+            entry.stats["requests"] += 1
+            entry.stats["errors"] += 1
+
+    def unban(self, proxy=None):
+        """解除封禁，proxy 可以是代理地址或统计中显示的标识，不指定时解除全部；返回解除的代理数"""
+        count = 0
+        with self._lock:
+            for entry in self.entries:
+                if (proxy is None or proxy in (entry.url, entry.label)) and entry.banned_until:
+                    entry.banned_until = 0.0
+                    count += 1
+        return count
+
+    def get_stats(self):
+        now = time.monotonic()
+        proxies = []
+        with self._lock:
+            for entry in self.entries:
+                proxies.append({
+                    "proxy": entry.label,
+                    "latency_ms": round(entry.latency * 1000, 1) if entry.latency is not None else None,
+                    "banned_remaining": round(max(0.0, entry.banned_until - now), 1),
+                    "breaker": self.breakers.state(entry.url) if self.breakers is not None else None,
+                    **entry.stats
+                })
+        return {
+            "sticky": self.sticky,
+            "ban_cooldown": self.ban_cooldown,
+            "available": sum(1 for proxy in proxies if not proxy["banned_remaining"]),
+            "proxies": proxies
+        }
@@ -1,16 +1,92 @@
 import json
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 from flask import stream_with_context, Response, jsonify
-from curl_cffi import requests as curl_requests
 from logger import logger
 from config import config_manager
 from token_manager import AuthTokenManager
-from message_processor import MessageProcessor
+from message_processor import MessageProcessor, StreamChunkEncoder, ChunkCoalescer, ToolOutputFilter
+from session_pool import SessionPool, AsyncSessionPool
+from upstream_decoder import decode_line, TokenEvent, ModelResponseEvent, ErrorEvent
+from response_cache import ResponseCache, make_key, parse_cache_control, HIT, MISS, BYPASS
+from single_flight import SingleFlight, AsyncSingleFlight, StreamFanout, AsyncStreamFanout
+from hedging import HedgePolicy
+from metrics import ServiceMetrics, token_label, proxy_label
+from retry import RetryPolicy, RetryBudget, BreakerRegistry, classify_status, classify_error, ROTATE, BACKOFF, FATAL
+from proxy_pool import ProxyPool, parse_proxy_list
+from admission import (
+    AdmissionController, AsyncAdmissionController, AdmittedStream, AsyncAdmittedStream, Overloaded, NULL_TICKET
+)
+from upstream_recorder import UpstreamRecorder
 
 
 class RequestHandler:
     def __init__(self, token_manager: AuthTokenManager):
         self.token_manager = token_manager
+        self.session_pool = SessionPool()
+        self.async_session_pool = AsyncSessionPool()
+        self.response_cache = ResponseCache(
+            config_manager.get("RESPONSE_CACHE.ENABLED", False),
+            config_manager.get("RESPONSE_CACHE.TTL", 300),
+            config_manager.get("RESPONSE_CACHE.MAX_MB", 64) * 1024 * 1024
+        )
+        max_followers = config_manager.get("SINGLE_FLIGHT.MAX_FOLLOWERS", 64)
+        flight_timeout = config_manager.get("SINGLE_FLIGHT.TIMEOUT", 300)
+        self.single_flight = SingleFlight(max_followers, flight_timeout)
+        self.async_single_flight = AsyncSingleFlight(max_followers, flight_timeout)
+        self.stream_fanout = StreamFanout(max_followers, flight_timeout)
+        self.async_stream_fanout = AsyncStreamFanout(max_followers, flight_timeout)
+        self.hedge_policy = HedgePolicy(
+            config_manager.get("HEDGE.DELAY_MS", 0),
+            config_manager.get("HEDGE.MIN_DELAY_MS", 100),
+            config_manager.get("HEDGE.MAX_DELAY_MS", 3000)
+        )
+        # 同步模式下对冲需要在后台线程中等待首行，线程只在请求到达首行前占用
+        self._hedge_executor = ThreadPoolExecutor(
+            max_workers=config_manager.get("HEDGE.MAX_WORKERS", 256), thread_name_prefix="Hedge"
+        )
+        budget = RetryBudget(
+            config_manager.get("RETRY.BUDGET_RATIO", 0.2),
+            config_manager.get("RETRY.BUDGET_MIN_PER_SECOND", 5)
+        ) if config_manager.get("RETRY.BUDGET", True) else None
+        self.retry_policy = RetryPolicy(
+            config_manager.get("RETRY.MAX_ATTEMPTS", 2),
+            config_manager.get("RETRY.BASE_DELAY_MS", 200),
+            config_manager.get("RETRY.MAX_DELAY_MS", 2000),
+            budget
+        )
+        breaker_failures = config_manager.get("RETRY.BREAKER_FAILURES", 5)
+        breaker_open_seconds = config_manager.get("RETRY.BREAKER_OPEN_SECONDS", 30)
+        self.token_breakers = BreakerRegistry(breaker_failures, breaker_open_seconds, token_label)
+        self.proxy_breakers = BreakerRegistry(
+            breaker_failures, breaker_open_seconds, proxy_label, config_manager.get("RETRY.BREAKER_FAILURE_RATE", 0.5)
+        )
+        self.proxy_pool = ProxyPool(
+            parse_proxy_list(config_manager.get("API.PROXY")),
+            config_manager.get("PROXY_POOL.BAN_COOLDOWN", 600),
+            config_manager.get("PROXY_POOL.STICKY", False),
+            self.proxy_breakers if config_manager.get("RETRY.BREAKER", True) else None
+        )
+        admission_limits = (
+            config_manager.get("ADMISSION.MAX_IN_FLIGHT", 0),
+            config_manager.get("ADMISSION.PER_TOKEN", 0),
+            config_manager.get("ADMISSION.QUEUE_SIZE", 100),
+            config_manager.get("ADMISSION.QUEUE_TIMEOUT_MS", 5000) / 1000
+        )
+        self.admission = AdmissionController(*admission_limits)
+        self.async_admission = AsyncAdmissionController(*admission_limits)
+        self.recorder = UpstreamRecorder(
+            config_manager.get("RECORD.ENABLED", False),
+            config_manager.get("RECORD.DIR", "data/recordings"),
+            config_manager.get("RECORD.SAMPLE_RATE", 1.0),
+            config_manager.get("RECORD.MAX_MB", 256) * 1024 * 1024
+        )
+        self.metrics = ServiceMetrics(
+            token_manager, config_manager.get("METRICS.TOKEN_LABELS", True),
+            {"token": self.token_breakers, "proxy": self.proxy_breakers},
+            {"sync": self.admission, "async": self.async_admission}
+        )
         
         self.default_headers = {
             'Accept': '*/*',
@@ -31,280 +107,997 @@ class RequestHandler:
             'x-statsig-id': 'ZTpUeXBlRXJyb3I6IENhbm5vdCByZWFkIHByb3BlcnRpZXMgb2YgdW5kZWZpbmVkIChyZWFkaW5nICdjaGlsZE5vZGVzJyk='
         }
     
-    def get_proxy_options(self):
-        proxy = config_manager.get("API.PROXY")
-        proxy_options = {}
+    @staticmethod
+    def _new_non_stream_state():
+        # 文本分片先收集到列表中，最后一次性拼接
+        return {"content_parts": [], "thinking_parts": [], "model_response": None, "tokens": 0}
 
-        if proxy:
-            logger.info(f"使用代理: {proxy}", "Server")
-            
-            if proxy.startswith("socks5://"):
-                proxy_options["proxy"] = proxy
-                
-                if '@' in proxy:
-                    auth_part = proxy.split('@')[0].split('://')[1]
-                    if ':' in auth_part:
-                        username, password = auth_part.split(':')
-                        proxy_options["proxy_auth"] = (username, password)
+    def _collect_non_stream_line(self, chunk, model, state):
+        """解析单行上游数据并累积非流式内容，返回True表示已收到最终响应"""
+        event = decode_line(chunk)
+        if event is None:
+            return False
+
+        if isinstance(event, TokenEvent):
+            if not event.text:
+                return False
+            state["tokens"] += 1
+            # 处理 grok-4 和 grok-4-fast 的思考内容
+            if config_manager.is_reasoning_model(model):
+                # 收集思考内容 (isThinking: true)
+                if event.thinking:
+                    state["thinking_parts"].append(event.text)
+                # 收集最终内容 (isThinking: false, messageTag: "final")
+                elif event.tag == "final":
+                    state["content_parts"].append(event.text)
+            # 处理 grok-3 和其他非推理模型
             else:
-                proxy_options["proxies"] = {"https": proxy, "http": proxy}     
-        return proxy_options
+                state["content_parts"].append(event.text)
+            return False
 
-    def handle_non_stream_response(self, response, model):
-        try:
-            logger.info("开始处理非流式响应（拼接流式内容）", "Server")
-            
-            # 解析流式响应的所有行，拼接完整内容和思考内容
-            stream = response.iter_lines()
-            full_content = ""
-            thinking_content = ""
-            model_response = None
-            
-            for chunk in stream:
-                if not chunk:
-                    continue
-                try:
-                    line_json = json.loads(chunk.decode("utf-8").strip())
-                    
-                    if line_json.get("error"):
-                        logger.error(json.dumps(line_json, indent=2), "Server")
-                        raise ValueError("RateLimitError")
-                        
-                    response_data = line_json.get("result", {}).get("response")
-                    if not response_data:
-                        continue
-                    
-                    # 处理 grok-4 和 grok-4-fast 的思考内容
-                    if model in ["grok-4", "grok-4-fast"]:
-                        # 收集思考内容 (isThinking: true)
-                        if response_data.get("isThinking") and response_data.get("token"):
-                            thinking_content += response_data["token"]
-
-                        # 收集最终内容 (isThinking: false, messageTag: "final")
-                        elif not response_data.get("isThinking") and response_data.get("messageTag") == "final" and response_data.get("token"):
-                            full_content += response_data["token"]
-
-                    # 处理 grok-3 和其他非推理模型
-                    else:
-                        # 获取token并拼接内容
-                        token = response_data.get("token", "")
-                        if token:
-                            full_content += token
-                    
-                    # 检查是否有最终响应（modelResponse）
-                    if response_data.get("modelResponse"):
-                        model_response = response_data["modelResponse"]
-                        break
-                        
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    logger.error(f"处理非流式响应行时出错: {str(e)}", "Server")
-                    continue
-            
-            # 如果有 modelResponse，优先使用它的内容
-            if model_response:
-                if model in ["grok-4", "grok-4-fast"] and model_response.get("thinkingTrace"):
-                    # 对于推理模型，将思考内容包装在 think 标签中
-                    thinking_trace = model_response["thinkingTrace"]
-                    final_message = f"<think>{thinking_trace}</think>{model_response.get('message', '')}"
-                else:
-                    final_message = model_response.get('message', '')
+        # 检查是否有最终响应（modelResponse）
+        if isinstance(event, ModelResponseEvent):
+            state["model_response"] = event
+            return True
+
+        if isinstance(event, ErrorEvent):
+            # 与流式处理不同，这里只记录错误，返回已收集到的内容
+            logger.error(json.dumps(event.payload, indent=2), "Server")
+        return False
+
+    def _build_non_stream_response(self, model, state):
+        full_content = "".join(state["content_parts"])
+        thinking_content = "".join(state["thinking_parts"])
+        model_response = state["model_response"]
+
+        # 如果有 modelResponse，优先使用它的内容
+        if model_response:
+            if config_manager.is_reasoning_model(model) and model_response.thinking_trace:
+                # 对于推理模型，将思考内容包装在 think 标签中
+                final_message = f"<think>{model_response.thinking_trace}</think>{model_response.message}"
             else:
-                # 如果没有 modelResponse，手动拼接内容
-                if model in ["grok-4", "grok-4-fast"] and thinking_content:
-                    final_message = f"<think>{thinking_content}</think>{full_content}"
-                else:
-                    final_message = full_content
-            
-            if not final_message:
-                logger.warning("未找到响应内容", "Server")
-                final_message = ""
-            
-            # 构建标准OpenAI兼容格式响应
-            openai_response = {
-                "id": f"chatcmpl-{int(time.time())}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": final_message
-                        },
-                        "finish_reason": "stop"
-                    }
-                ],
-                "usage": {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0
+                final_message = model_response.message
+        else:
+            # 如果没有 modelResponse，手动拼接内容
+            if config_manager.is_reasoning_model(model) and thinking_content:
+                final_message = f"<think>{thinking_content}</think>{full_content}"
+            else:
+                final_message = full_content
+
+        if not final_message:
+            logger.warning("未找到响应内容", "Server")
+            final_message = ""
+
+        # 构建标准OpenAI兼容格式响应
+        openai_response = {
+            "id": f"chatcmpl-{int(time.time())}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": final_message
+                    },
+                    "finish_reason": "stop"
                 }
+            ],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_tokens": 0
             }
+        }
+
+        logger.info("成功构建OpenAI响应，内容长度: {}", "Server", len(final_message))
+        return openai_response
+
+    def handle_non_stream_response(self, response, model):
+        # 解析流式响应的所有行，拼接完整内容和思考内容
+        state = self._new_non_stream_state()
+        try:
+            logger.info("开始处理非流式响应（拼接流式内容）", "Server")
             
-            logger.info(f"成功构建OpenAI响应，内容长度: {len(final_message)}", "Server")
-            return openai_response
+            for chunk in response.iter_lines():
+                if self._collect_non_stream_line(chunk, model, state):
+                    break
+
+            return self._build_non_stream_response(model, state)
             
         except Exception as error:
-            logger.error(f"处理非流式响应时出错: {str(error)}", "Server")
+            logger.error("处理非流式响应时出错: {}", "Server", error)
+            raise
+        finally:
+            response.close()
+            self.metrics.record_upstream_stream(model, response, state["tokens"])
+
+    async def handle_non_stream_response_async(self, response, model):
+        """异步版本的非流式响应处理，逻辑与同步版本一致"""
+        state = self._new_non_stream_state()
+        try:
+            logger.info("开始处理非流式响应（拼接流式内容）", "Server")
+
+            async for chunk in response.aiter_lines():
+                if self._collect_non_stream_line(chunk, model, state):
+                    break
+
+            return self._build_non_stream_response(model, state)
+
+        except Exception as error:
+            logger.error("处理非流式响应时出错: {}", "Server", error)
             raise
+        finally:
+            self.metrics.record_upstream_stream(model, response, state["tokens"])
+
+    @staticmethod
+    def _get_coalesce_options(data):
+        """返回分片合并的 (字节上限, 时间上限秒)，未开启时返回None；请求中的 stream_options.coalesce 优先于全局配置"""
+        stream_options = data.get("stream_options")
+        if not isinstance(stream_options, dict):
+            stream_options = {}
+        if not stream_options.get("coalesce", config_manager.get("STREAM.COALESCE", False)):
+            return None
+        return config_manager.get("STREAM.COALESCE_BYTES", 256), config_manager.get("STREAM.COALESCE_MS", 20) / 1000
+
+    @staticmethod
+    def _new_stream_state(model, coalesce=None):
+        # 同一补全的所有分片共用一个编码器（以及同一个补全id）
+        encoder = StreamChunkEncoder(model)
+        reasoning = config_manager.is_reasoning_model(model)
+        return {
+            "reasoning": reasoning,
+            "thinking_started": False,
+            "thinking_ended": False,
+            "finished": False,
+            "encoder": encoder,
+            "coalescer": ChunkCoalescer(encoder, *coalesce) if coalesce else None,
+            # 上游token行数，用于统计输出速度
+            "tokens": 0,
+            # 工具输出标签可能跨分片，整个流共用一个过滤器
+            "tool_filter": ToolOutputFilter() if reasoning else None
+        }
+
+    @staticmethod
+    def _emit(state, frames, text, boundary=False):
+        """输出一段增量文本；开启合并时先缓冲，思考标签等边界分片立即输出"""
+        if boundary and state["tool_filter"] is not None:
+            # 边界之前过滤器暂存的文本先输出
+            held = state["tool_filter"].flush()
+            if held:
+                RequestHandler._emit(state, frames, held)
+        coalescer = state["coalescer"]
+        if coalescer is None:
+            frames.append(state["encoder"].encode(text))
+        elif boundary:
+            frames.extend(coalescer.boundary(text))
+        else:
+            frames.extend(coalescer.write(text))
+
+    @staticmethod
+    def _flush_pending(state):
+        frames = []
+        if state["tool_filter"] is not None:
+            held = state["tool_filter"].flush()
+            if held:
+                RequestHandler._emit(state, frames, held)
+        if state["coalescer"] is not None:
+            frames.extend(state["coalescer"].flush())
+        return frames
+
+    def _process_stream_line(self, chunk, model, state):
+        """解析单行上游数据，返回需要发送的SSE帧列表；遇到上游错误时标记流结束"""
+        frames = []
+        event = decode_line(chunk)
+        if event is None:
+            return frames
+        try:
+            if isinstance(event, ErrorEvent):
+                logger.error(json.dumps(event.payload, indent=2), "Server")
+                frames.extend(self._flush_pending(state))
+                frames.append(f"data: {json.dumps({'error': {'message': 'RateLimitError', 'type': 'rate_limit_error'}})}\n\n")
+                state["finished"] = True
+                return frames
+
+            if not isinstance(event, TokenEvent):
+                return frames
+            if event.text:
+                state["tokens"] += 1
+
+            # 处理 grok-4 和 grok-4-fast 的特殊流式响应
+            if state["reasoning"]:
+                # 处理思考内容的开始
+                if event.thinking and not state["thinking_started"]:
+                    state["thinking_started"] = True
+                    # 发送开始思考标签
+                    self._emit(state, frames, '<think>', boundary=True)
+
+                # 处理思考过程中的内容（显示给用户，仅在思考阶段，过滤header内容和工具使用标签）
+                if event.thinking and not state["thinking_ended"] and event.tag != "header":
+                    # 处理工具响应内容，包括web搜索结果
+                    filtered_content = MessageProcessor.process_tool_event(event, state["tool_filter"])
+                    if filtered_content:  # 只输出非空内容
+                        self._emit(state, frames, filtered_content)
+
+                # 处理思考结束，准备最终内容（只有当有实际的最终内容时才结束思考）
+                elif not event.thinking and state["thinking_started"] and not state["thinking_ended"] and event.tag == "final" and event.text:
+                    state["thinking_ended"] = True
+                    # 发送结束思考标签
+                    self._emit(state, frames, '</think>', boundary=True)
+                    # 处理工具响应内容，发送最终内容
+                    filtered_content = MessageProcessor.process_tool_event(event, state["tool_filter"])
+                    if filtered_content:
+                        self._emit(state, frames, filtered_content)
+
+                # 处理最终内容的后续部分（思考结束后的纯回复）
+                elif not event.thinking and state["thinking_ended"] and event.tag == "final":
+                    filtered_content = MessageProcessor.process_tool_event(event, state["tool_filter"])
+                    if filtered_content:
+                        self._emit(state, frames, filtered_content)
+
+            # 处理 grok-3 和其他非推理模型
+            elif event.text:
+                self._emit(state, frames, event.text)
+
+        except Exception as e:
+            logger.error("处理流式响应行时出错: {}", "Server", e)
+        return frames
 
-    def handle_stream_response(self, response, model):
+    def handle_stream_response(self, response, model, coalesce=None):
         def generate():
             logger.info("开始处理流式响应", "Server")
+            state = self._new_stream_state(model, coalesce)
+            coalescer = state["coalescer"]
 
             try:
-                stream = response.iter_lines()
-                thinking_started = False
-                thinking_ended = False
-
-                for chunk in stream:
-                    if not chunk:
-                        continue
-                    try:
-                        line_json = json.loads(chunk.decode("utf-8").strip())
-
-                        if line_json.get("error"):
-                            logger.error(json.dumps(line_json, indent=2), "Server")
-                            yield f"data: {json.dumps({'error': {'message': 'RateLimitError', 'type': 'rate_limit_error'}})}\n\n"
-                            return
-
-                        response_data = line_json.get("result", {}).get("response")
-                        if not response_data:
-                            continue
-
-                        # 处理 grok-4 和 grok-4-fast 的特殊流式响应
-                        if model in ["grok-4", "grok-4-fast"]:
-                            # 处理思考内容的开始
-                            if response_data.get("isThinking") and not thinking_started:
-                                thinking_started = True
-                                # 发送开始思考标签
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response('<think>', model, True))}\n\n"
-
-                            # 处理思考过程中的内容（显示给用户，仅在思考阶段，过滤header内容和工具使用标签）
-                            if response_data.get("isThinking") and not thinking_ended and response_data.get("messageTag") != "header":
-                                # 处理工具响应内容，包括web搜索结果
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:  # 只输出非空内容
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                            # 处理思考结束，准备最终内容（只有当有实际的最终内容时才结束思考）
-                            elif not response_data.get("isThinking") and thinking_started and not thinking_ended and response_data.get("messageTag") == "final" and response_data.get("token"):
-                                thinking_ended = True
-                                # 发送结束思考标签
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response('</think>', model, True))}\n\n"
-                                # 处理工具响应内容，发送最终内容
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                            # 处理最终内容的后续部分（思考结束后的纯回复）
-                            elif not response_data.get("isThinking") and thinking_ended and response_data.get("messageTag") == "final":
-                                filtered_content = MessageProcessor.process_tool_response(response_data)
-                                if filtered_content:
-                                    yield f"data: {json.dumps(MessageProcessor.create_chat_response(filtered_content, model, True))}\n\n"
-
-                        # 处理 grok-3 和其他非推理模型
-                        else:
-                            result = MessageProcessor.process_model_response(response_data, model)
-                            if result["token"]:
-                                yield f"data: {json.dumps(MessageProcessor.create_chat_response(result['token'], model, True))}\n\n"
-
-                    except json.JSONDecodeError:
-                        continue
-                    except Exception as e:
-                        logger.error(f"处理流式响应行时出错: {str(e)}", "Server")
-                        continue
+                # 开启合并时，上游空闲超过时间上限也要把已缓冲的文本发出去
+                for chunk in response.iter_lines(coalescer.max_delay if coalescer else None):
+                    yield from self._process_stream_line(chunk, model, state)
+                    if state["finished"]:
+                        return
+                    if coalescer is not None and coalescer.due():
+                        yield from coalescer.flush()
 
+                yield from self._flush_pending(state)
                 yield "data: [DONE]\n\n"
 
             except Exception as e:
-                logger.error(f"流式响应处理异常: {str(e)}", "Server")
+                logger.error("流式响应处理异常: {}", "Server", e)
+                yield from self._flush_pending(state)
                 # 发送错误响应
                 yield f"data: {json.dumps({'error': {'message': f'Stream processing error: {str(e)}', 'type': 'stream_error'}})}\n\n"
                 yield "data: [DONE]\n\n"
+            finally:
+                response.close()
+                self.metrics.record_upstream_stream(model, response, state["tokens"])
 
         return generate()
 
-    def make_grok_request(self, data, model, stream=False):
-        response_status_code = 500
-        
+    def handle_stream_response_async(self, response, model, coalesce=None):
+        """异步版本的流式响应处理，结束时关闭上游响应并归还会话"""
+        async def generate():
+            logger.info("开始处理流式响应", "Server")
+            state = self._new_stream_state(model, coalesce)
+            coalescer = state["coalescer"]
+            disconnected = False
+
+            try:
+                async for chunk in response.aiter_lines(coalescer.max_delay if coalescer else None):
+                    for frame in self._process_stream_line(chunk, model, state):
+                        yield frame
+                    if state["finished"]:
+                        return
+                    if coalescer is not None and coalescer.due():
+                        for frame in coalescer.flush():
+                            yield frame
+
+                for frame in self._flush_pending(state):
+                    yield frame
+                yield "data: [DONE]\n\n"
+
+            except (GeneratorExit, asyncio.CancelledError):
+                disconnected = True
+                raise
+            except Exception as e:
+                logger.error("流式响应处理异常: {}", "Server", e)
+                for frame in self._flush_pending(state):
+                    yield frame
+                yield f"data: {json.dumps({'error': {'message': f'Stream processing error: {str(e)}', 'type': 'stream_error'}})}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                # 客户端已断开时立即中断上游传输；aclose 会一直等到上游输出完毕
+                await (response.abort() if disconnected else response.aclose())
+                self.metrics.record_upstream_stream(model, response, state["tokens"])
+
+        return generate()
+
+    @staticmethod
+    def _build_request_body(data, model):
+        return json.dumps(MessageProcessor.prepare_chat_messages(data.get("messages", []), model))
+
+    def _build_request_options(self, token, request_body, proxy):
+        """构造发往上游的请求参数，同步与异步会话共用；request_body 为已序列化的请求体，proxy 为 ProxyEntry"""
+        return {
+            "url": f"{config_manager.get('API.BASE_URL')}/rest/app-chat/conversations/new",
+            "headers": {
+                **self.default_headers,
+                "Cookie": token
+            },
+            "data": request_body,
+            "impersonate": "chrome133a",
+            "stream": True,
+            "timeout": 10,
+            **proxy.options
+        }
+
+    @staticmethod
+    def _parse_retry_after(headers):
         try:
-            retry_count = 0
-            
-            while retry_count < config_manager.get("RETRY.MAX_ATTEMPTS", 2):
-                retry_count += 1
-                
-                token = self.token_manager.get_next_token_for_model(model)
+            value = headers.get("Retry-After") if headers else None
+            return int(value) if value else None
+        except (TypeError, ValueError):
+            return None
+
+    def _record_token_result(self, token, model, response, proxy):
+        """
+        把上游状态码反馈给令牌调度器、代理池和熔断器并计入指标。
+        403（IP封禁）和 5xx 等暂时性失败归因于线路（代理或上游整体），不计入令牌的失败，
+        避免上游短暂故障让所有令牌进入冷却；429 由令牌调度器按模型冷却，其余4xx（如401令牌失效）计入令牌。
+        """
+        self.metrics.record_upstream_response(token, proxy.url, response)
+        status_code = response.status_code
+        self.proxy_pool.record_status(proxy, status_code)
+        line_failure = status_code == 403 or (status_code != 200 and classify_status(status_code) == BACKOFF)
+        if status_code == 200:
+            self.token_manager.mark_success(token, model)
+        elif status_code == 429:
+            self.token_manager.mark_rate_limited(token, model, self._parse_retry_after(response.headers))
+        elif not line_failure:
+            self.token_manager.mark_failure(token, model)
+
+        if not config_manager.get("RETRY.BREAKER", True):
+            return
+        if line_failure:
+            self.proxy_breakers.record_failure(proxy.url)
+            return
+        self.proxy_breakers.record_success(proxy.url)
+        if status_code == 200:
+            self.token_breakers.record_success(token)
+        elif status_code != 429:
+            self.token_breakers.record_failure(token)
+
+    def _record_upstream_error(self, error, proxy):
+        """请求上游时抛出异常，返回失败分类；网络层的异常计入代理熔断"""
+        kind = classify_error(error)
+        if kind == BACKOFF:
+            self.proxy_pool.record_error(proxy)
+            if config_manager.get("RETRY.BREAKER", True):
+                self.proxy_breakers.record_failure(proxy.url)
+        return kind
+
+    def _next_token(self, model, ticket=NULL_TICKET):
+        """
+        按轮询顺序取下一个令牌，跳过熔断中的令牌，以及 ticket 的准入控制中已达到单令牌并发上限的令牌（选中后名额转移到该令牌）；
+        最多跳过有失败记录的令牌数加上有请求在进行中的令牌数，避免全部不可用时空转
+        """
+        token = self.token_manager.get_next_token_for_model(model)
+        breaker = config_manager.get("RETRY.BREAKER", True)
+        if not breaker and ticket is NULL_TICKET:
+            return token
+        for _ in range((len(self.token_breakers) if breaker else 0) + ticket.busy_tokens()):
+            if not token or self._token_usable(token, breaker, ticket):
+                return token
+            token = self.token_manager.get_next_token_for_model(model)
+        return token if token and self._token_usable(token, breaker, ticket) else None
+
+    def _token_usable(self, token, breaker, ticket):
+        # 先检查熔断器，熔断中的令牌不占用准入名额；半开探测放行后令牌名额已满时归还探测机会，
+        # 否则要等到下一个冷却周期才能再次探测
+        if breaker and not self.token_breakers.allow(token):
+            return False
+        if ticket.try_hold(token):
+            return True
+        if breaker:
+            self.token_breakers.release_probe(token)
+        return False
+
+    def _admit(self):
+        """获取上游请求的准入名额，被拒绝时计入指标后抛出 Overloaded"""
+        try:
+            ticket = self.admission.admit()
+        except Overloaded as e:
+            self.metrics.admission_rejections.inc(e.reason)
+            raise
+        if self.admission.enabled:
+            self.metrics.admission_wait.observe(ticket.waited)
+        return ticket
+
+    async def _admit_async(self):
+        try:
+            ticket = await self.async_admission.admit()
+        except Overloaded as e:
+            self.metrics.admission_rejections.inc(e.reason)
+            raise
+        if self.async_admission.enabled:
+            self.metrics.admission_wait.observe(ticket.waited)
+        return ticket
+
+    def _acquire_token(self, model, ticket):
+        """选择令牌；所有可用令牌都达到单令牌并发上限时等待其中一个释放，超时抛出 Overloaded"""
+        token = self._next_token(model, ticket)
+        try:
+            while token is None and ticket.blocked is not None:
+                self.admission.wait_token(ticket)
+                token = self._next_token(model, ticket)
+        except Overloaded as e:
+            self.metrics.admission_rejections.inc(e.reason)
+            raise
+        return token
+
+    async def _acquire_token_async(self, model, ticket):
+        token = self._next_token(model, ticket)
+        try:
+            while token is None and ticket.blocked is not None:
+                await self.async_admission.wait_token(ticket)
+                token = self._next_token(model, ticket)
+        except Overloaded as e:
+            self.metrics.admission_rejections.inc(e.reason)
+            raise
+        return token
+
+    def _choose_proxy(self, token, avoid=()):
+        """
+        为本次尝试选择代理，优先避开本请求中已出现网络错误的代理（avoid），没有其他代理时仍可复用。
+        全部代理封禁或熔断时快速失败，不再占用连接等待超时。
+        """
+        proxy = self.proxy_pool.choose(token, avoid) if avoid else None
+        proxy = proxy or self.proxy_pool.choose(token)
+        if proxy is None:
+            if self.proxy_pool.all_banned():
+                raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
+            raise ValueError('上游连接持续失败，已暂停请求，请稍后重试')
+        return proxy
+
+    def _classify_status(self, status_code, proxy):
+        """403 时该代理已进入封禁冷却，还有其他可用代理时换代理立即重试"""
+        if status_code == 403 and self.proxy_pool.available((proxy,)):
+            logger.warning("代理 {} 被封禁，换用其他代理重试", "Server", proxy.label)
+            return ROTATE
+        return classify_status(status_code)
+
+    @staticmethod
+    def _log_upstream_status(token, status_code):
+        if status_code == 403:
+            logger.error("IP暂时被封禁，请稍后重试或者更换IP", "Server")
+        elif status_code == 429:
+            logger.warning("令牌配额已用完: {}...", "Server", token[:20])
+        else:
+            logger.warning("令牌返回异常状态码 {}: {}...", "Server", status_code, token[:20])
+
+    def _retry_delay(self, attempt, kind):
+        """第 attempt 次尝试失败后决定是否重试，返回重试前的等待秒数，不再重试时返回None"""
+        delay, reason = self.retry_policy.next_delay(kind, attempt)
+        if delay is None:
+            self.metrics.retry_giveups.inc(reason)
+            if reason != FATAL:
+                logger.warning("第 {} 次尝试失败，不再重试（{}）", "Server", attempt, reason)
+            return None
+        self.metrics.retries.inc(kind)
+        logger.info("第 {} 次尝试失败（{}），{:.0f}ms 后重试", "Server", attempt, kind, delay * 1000)
+        return delay
+
+    @staticmethod
+    def _upstream_failure(status_code):
+        """放弃重试时返回给客户端的错误，按最后一次尝试的结果区分"""
+        if status_code == 403:
+            return ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
+        if status_code == 429:
+            return ValueError('令牌配额已用完，请稍后重试')
+        return ValueError('请求失败，请检查网络连接或稍后重试')
+
+    def probe_token(self, token, model, timeout, session_pool=None):
+        """用指定令牌发送一次最小请求，只读取状态码并反馈给令牌调度器，返回上游状态码"""
+        request_body = self._build_request_body({"messages": [{"role": "user", "content": "hi"}]}, model)
+        proxy = self._choose_proxy(token)
+        options = self._build_request_options(token, request_body, proxy)
+        options["timeout"] = timeout
+        # 会话池默认在 curl 自身超时之外留有余量，检测时以 timeout 作为等待响应的总时限
+        response = (session_pool or self.session_pool).request(token, proxy.url, header_timeout=timeout, **options)
+        try:
+            self._record_token_result(token, model, response, proxy)
+            return response.status_code
+        finally:
+            # 不需要响应内容，关闭后由会话池在后台排空或中断传输
+            response.close()
+
+    def _lookup_response_cache(self, key, cache_control):
+        """查询响应缓存，返回 (命中的响应, 缓存状态, 是否写入缓存)；未启用时缓存状态为None"""
+        if not self.response_cache.enabled:
+            return None, None, False
+        skip_lookup, store = parse_cache_control(cache_control)
+        if skip_lookup:
+            self.response_cache.record_bypass()
+            return None, BYPASS, store
+        return self.response_cache.get(key), MISS, store
+
+    def _store_response_cache(self, key, response, store):
+        # 只缓存有内容的完整响应，上游出错时的空回复不缓存
+        if store and isinstance(response, dict) and response["choices"][0]["message"]["content"]:
+            self.response_cache.put(key, response)
+
+    def _stream_flight_key(self, data, key):
+        # 合并选项不同的流输出的帧不同，不能共享
+        return key, self._get_coalesce_options(data)
+
+    def make_chat_request(self, data, model, stream=False, cache_control=None):
+        """
+        对话请求入口：非流式请求依次经过响应缓存和相同请求合并，流式请求可选地共享相同请求的上游流。
+        返回 (响应, 缓存状态)，未启用响应缓存或流式请求时缓存状态为None
+        """
+        started = self.metrics.request_started()
+        try:
+            response, status = self._make_chat_request(data, model, stream, cache_control)
+        except Exception as e:
+            self.metrics.request_finished(model, stream, started, self._error_status(e))
+            raise
+        if stream:
+            frames = self.metrics.observe_stream(response, model, started)
+            return Response(stream_with_context(frames), content_type='text/event-stream'), None
+        self.metrics.request_finished(model, stream, started, 200)
+        return response, status
+
+    @staticmethod
+    def _error_status(error):
+        """与对话接口的错误响应一致：准入控制拒绝时为其状态码，ValueError 返回400，其余返回500"""
+        if isinstance(error, Overloaded):
+            return error.status
+        return 400 if isinstance(error, ValueError) else 500
+
+    def _make_chat_request(self, data, model, stream, cache_control):
+        """流式请求返回SSE帧生成器，由调用方包装为响应"""
+        request_body = self._build_request_body(data, model)
+        key = make_key(model, request_body)
+
+        if stream:
+            if not config_manager.get("SINGLE_FLIGHT.STREAM", False):
+                return self.make_grok_request(data, model, True, request_body=request_body, raw_stream=True), None
+            frames = self.stream_fanout.subscribe(
+                self._stream_flight_key(data, key),
+                lambda: self.make_grok_request(data, model, True, request_body=request_body, raw_stream=True)
+            )
+            return frames, None
+
+        cached, status, store = self._lookup_response_cache(key, cache_control)
+        if cached is not None:
+            return cached, HIT
+        if config_manager.get("SINGLE_FLIGHT.ENABLED", False):
+            response = self.single_flight.do(key, lambda: self.make_grok_request(data, model, False, request_body=request_body))
+        else:
+            response = self.make_grok_request(data, model, False, request_body=request_body)
+        self._store_response_cache(key, response, store)
+        return response, status
+
+    async def make_chat_request_async(self, data, model, stream=False, cache_control=None):
+        """异步版本的 make_chat_request，流式时响应为SSE帧的异步生成器"""
+        started = self.metrics.request_started()
+        try:
+            response, status = await self._make_chat_request_async(data, model, stream, cache_control)
+        except BaseException as e:
+            # 客户端在上游响应前断开时记为499
+            status = 499 if isinstance(e, asyncio.CancelledError) else self._error_status(e)
+            self.metrics.request_finished(model, stream, started, status)
+            raise
+        if stream and response is not None:
+            return self.metrics.observe_stream_async(response, model, started), None
+        self.metrics.request_finished(model, stream, started, 200)
+        return response, status
+
+    async def _make_chat_request_async(self, data, model, stream, cache_control):
+        request_body = self._build_request_body(data, model)
+        key = make_key(model, request_body)
+
+        if stream:
+            if not config_manager.get("SINGLE_FLIGHT.STREAM", False):
+                return await self.make_grok_request_async(data, model, True, request_body=request_body), None
+            frames = await self.async_stream_fanout.subscribe(
+                self._stream_flight_key(data, key),
+                lambda: self.make_grok_request_async(data, model, True, request_body=request_body)
+            )
+            return frames, None
+
+        cached, status, store = self._lookup_response_cache(key, cache_control)
+        if cached is not None:
+            return cached, HIT
+        if config_manager.get("SINGLE_FLIGHT.ENABLED", False):
+            response = await self.async_single_flight.do(key, lambda: self.make_grok_request_async(data, model, False, request_body=request_body))
+        else:
+            response = await self.make_grok_request_async(data, model, False, request_body=request_body)
+        self._store_response_cache(key, response, store)
+        return response, status
+
+    def _request_upstream(self, token, proxy, request_body):
+        """同步会话池在收到首个数据块后才返回，返回时上游已开始输出；耗时计入该代理的延迟"""
+        started = time.monotonic()
+        response = self.session_pool.request(token, proxy.url, **self._build_request_options(token, request_body, proxy))
+        self.proxy_pool.record_latency(proxy, time.monotonic() - started)
+        return response
+
+    def _on_hedge_settled(self, future, started, winner):
+        """对冲中的一方结束后记录其首行延迟；已选出胜者时，落败的成功响应立即中断"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        response = future.result()
+        if response.status_code == 200:
+            self.hedge_policy.record_sample(time.monotonic() - started)
+            if winner() not in (None, future):
+                response.abort()
+
+    def _hedge_proxy(self, token, proxy):
+        """对冲请求尽量换一个代理，避开首个请求所在线路的拥塞；没有其他可用代理时沿用原代理"""
+        return self.proxy_pool.choose(token, (proxy,)) or proxy
+
+    def _open_upstream(self, model, token, proxy, request_body, ticket=NULL_TICKET):
+        """
+        发起上游请求，返回 (响应, 实际使用的令牌, 实际使用的代理)。
+        开启对冲时，超过对冲延迟仍未收到首行则用另一个令牌（尽量经由另一个代理）再发一次，
+        先开始输出的一方胜出，另一方被中断。对冲的令牌与 ticket 一样受单令牌并发上限约束：
+        对冲期间另占该令牌的名额，对冲胜出时 ticket 改用这个名额，否则释放。
+        """
+        if not config_manager.get("HEDGE.ENABLED", False):
+            return self._request_upstream(token, proxy, request_body), token, proxy
+
+        policy = self.hedge_policy
+        delay = policy.delay()
+        start = time.monotonic()
+        chosen = []
+        winner = lambda: chosen[0] if chosen else None
+        primary = self._hedge_executor.submit(self._request_upstream, token, proxy, request_body)
+        primary.add_done_callback(lambda future: self._on_hedge_settled(future, start, winner))
+        primary.add_done_callback(lambda future: policy.record_unhedged(time.monotonic() - start))
+
+        try:
+            response = primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        else:
+            chosen.append(primary)
+            policy.record_delivered(time.monotonic() - start, False, False)
+            return response, token, proxy
+
+        hedge_ticket = ticket.hedge()
+        hedge_token = self._next_token(model, hedge_ticket)
+        if not hedge_token or hedge_token == token:
+            hedge_ticket.release()
+            policy.record_skipped()
+            response = primary.result()
+            chosen.append(primary)
+            policy.record_delivered(time.monotonic() - start, False, False)
+            return response, token, proxy
+
+        try:
+            hedge_proxy = self._hedge_proxy(hedge_token, proxy)
+            logger.info("首行超过 {:.0f}ms 未到达，使用另一个令牌对冲: {}... 代理: {}", "Server",
+                        delay * 1000, hedge_token[:20], hedge_proxy.label)
+            hedge_start = time.monotonic()
+            secondary = self._hedge_executor.submit(self._request_upstream, hedge_token, hedge_proxy, request_body)
+            secondary.add_done_callback(lambda future: self._on_hedge_settled(future, hedge_start, winner))
+            # 各方使用的 (令牌, 代理)
+            tokens = {primary: (token, proxy), secondary: (hedge_token, hedge_proxy)}
+
+            pending = {primary, secondary}
+            fallback = None
+            error = None
+            while pending and not chosen:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        response = future.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if response.status_code == 200 and not chosen:
+                        chosen.append(future)
+                    elif fallback is None:
+                        fallback = future
+                    else:
+                        self._record_token_result(tokens[future][0], model, response, tokens[future][1])
+                        response.close()
+
+            if fallback is not None and not chosen:
+                chosen.append(fallback)
+            # 先选出胜者再检查另一方：此前已完成的由这里中断，此后完成的由回调中断
+            for future in tokens:
+                if future not in chosen and future.done() and not future.cancelled() and future.exception() is None:
+                    if future is fallback:
+                        self._record_token_result(tokens[future][0], model, future.result(), tokens[future][1])
+                        future.result().close()
+                    else:
+                        future.result().abort()
+
+            policy.record_delivered(time.monotonic() - start, True, bool(chosen) and chosen[0] is secondary)
+            if not chosen:
+                raise error
+            return (chosen[0].result(), *tokens[chosen[0]])
+        finally:
+            # 对冲胜出时改用对冲请求所占的令牌名额，否则释放
+            if chosen and chosen[0] is not primary:
+                ticket.adopt(hedge_ticket)
+            else:
+                hedge_ticket.release()
+
+    async def _request_upstream_async(self, token, proxy, request_body, prefetch=False):
+        """异步会话池在收到响应头后返回；prefetch 时再等待首行到达。耗时计入该代理的延迟"""
+        started = time.monotonic()
+        response = await self.async_session_pool.request(
+            token, proxy.url, **self._build_request_options(token, request_body, proxy)
+        )
+        if prefetch and response.status_code == 200:
+            try:
+                await response.prefetch_line()
+            except BaseException:
+                asyncio.ensure_future(response.abort())
+                raise
+        self.proxy_pool.record_latency(proxy, time.monotonic() - started)
+        return response
+
+    def _on_hedge_settled_async(self, task, started, winner):
+        if task.cancelled() or task.exception() is not None:
+            return
+        response = task.result()
+        if response.status_code == 200:
+            self.hedge_policy.record_sample(time.monotonic() - started)
+            if winner() not in (None, task):
+                asyncio.ensure_future(response.abort())
+
+    async def _open_upstream_async(self, model, token, proxy, request_body, ticket=NULL_TICKET):
+        """异步版本的 _open_upstream"""
+        if not config_manager.get("HEDGE.ENABLED", False):
+            return await self._request_upstream_async(token, proxy, request_body), token, proxy
+
+        policy = self.hedge_policy
+        delay = policy.delay()
+        start = time.monotonic()
+        chosen = []
+        winner = lambda: chosen[0] if chosen else None
+        primary = asyncio.ensure_future(self._request_upstream_async(token, proxy, request_body, True))
+        primary.add_done_callback(lambda task: self._on_hedge_settled_async(task, start, winner))
+        primary.add_done_callback(lambda task: policy.record_unhedged(time.monotonic() - start))
+        # 各方使用的 (令牌, 代理)
+        tasks = {primary: (token, proxy)}
+        hedge_ticket = ticket.hedge()
+
+        try:
+            done, _ = await asyncio.wait((primary,), timeout=delay)
+            if done:
+                chosen.append(primary)
+                policy.record_delivered(time.monotonic() - start, False, False)
+                return primary.result(), token, proxy
+
+            hedge_token = self._next_token(model, hedge_ticket)
+            if not hedge_token or hedge_token == token:
+                hedge_ticket.release()
+                policy.record_skipped()
+                response = await asyncio.shield(primary)
+                chosen.append(primary)
+                policy.record_delivered(time.monotonic() - start, False, False)
+                return response, token, proxy
+
+            hedge_proxy = self._hedge_proxy(hedge_token, proxy)
+            logger.info("首行超过 {:.0f}ms 未到达，使用另一个令牌对冲: {}... 代理: {}", "Server",
+                        delay * 1000, hedge_token[:20], hedge_proxy.label)
+            hedge_start = time.monotonic()
+            secondary = asyncio.ensure_future(self._request_upstream_async(hedge_token, hedge_proxy, request_body, True))
+            secondary.add_done_callback(lambda task: self._on_hedge_settled_async(task, hedge_start, winner))
+            tasks[secondary] = (hedge_token, hedge_proxy)
+
+            pending = set(tasks)
+            fallback = None
+            error = None
+            while pending and not chosen:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    response = task.result()
+                    if response.status_code == 200 and not chosen:
+                        chosen.append(task)
+                    elif fallback is None:
+                        fallback = task
+                    else:
+                        self._record_token_result(tasks[task][0], model, response, tasks[task][1])
+                        await response.aclose()
+
+            if fallback is not None and not chosen:
+                chosen.append(fallback)
+            for task in tasks:
+                if task not in chosen and task.done() and not task.cancelled() and task.exception() is None:
+                    if task is fallback:
+                        self._record_token_result(tasks[task][0], model, task.result(), tasks[task][1])
+                        await task.result().aclose()
+                    else:
+                        asyncio.ensure_future(task.result().abort())
+
+            policy.record_delivered(time.monotonic() - start, True, bool(chosen) and chosen[0] is secondary)
+            if not chosen:
+                raise error
+            return (chosen[0].result(), *tasks[chosen[0]])
+        except asyncio.CancelledError:
+            # 客户端已断开，尚未完成的上游请求一并取消，已完成的在回调中中断
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            # 对冲胜出时改用对冲请求所占的令牌名额，否则释放
+            if chosen and chosen[0] is not primary:
+                ticket.adopt(hedge_ticket)
+            else:
+                hedge_ticket.release()
+
+    def make_grok_request(self, data, model, stream=False, token=None, request_body=None, raw_stream=False):
+        """
+        向上游发起对话请求；指定token时只用该令牌请求一次，不参与轮询和重试（用于单个Cookie测试）。
+        request_body 为已构造好的上游请求体，未传入时根据 data 构造；
+        raw_stream 为True时流式请求直接返回SSE帧生成器，供合并相同的流式请求使用。
+        失败时按 RetryPolicy 的分类、退避和重试预算决定是否重试，见 retry.py。
+        请求上游前先经过准入控制（admission.py），名额在响应读取完或流结束时释放。
+        开启录制时成功的上游响应由 UpstreamRecorder 包装，读取的行写入录制文件（upstream_recorder.py）。
+        """
+        pinned_token = token
+        coalesce = self._get_coalesce_options(data) if stream else None
+        ticket = NULL_TICKET
+
+        try:
+            # 请求体与令牌无关，只构造一次，重试时复用
+            if request_body is None:
+                request_body = self._build_request_body(data, model)
+            if not pinned_token:
+                self.retry_policy.record_request()
+                ticket = self._admit()
+
+            attempt = 0
+            # 本请求中出现网络错误的代理，重试时优先避开
+            failed_proxies = []
+            while True:
+                attempt += 1
+                token = pinned_token or self._acquire_token(model, ticket)
                 if not token:
                     raise ValueError('无可用令牌')
-                
-                config_manager.set("API.SIGNATURE_COOKIE", token)
-                logger.info(f"当前令牌: {token[:50]}...", "Server")
-                
+                proxy = self._choose_proxy(token, failed_proxies)
+
+                logger.info("当前令牌: {}... 代理: {}", "Server", token[:50], proxy.label)
+                status_code = None
+
                 try:
-                    request_payload = MessageProcessor.prepare_chat_messages(data.get("messages", []), model)
-                    
-                    proxy_options = self.get_proxy_options()
-                    response = curl_requests.post(
-                        f"{config_manager.get('API.BASE_URL')}/rest/app-chat/conversations/new",
-                        headers={
-                            **self.default_headers,
-                            "Cookie": token
-                        },
-                        data=json.dumps(request_payload),
-                        impersonate="chrome133a",
-                        stream=True,
-                        timeout=10,
-                        **proxy_options
-                    )
-                    
-                    logger.info(f"请求状态码: {response.status_code}", "Server")
-                    
-                    if response.status_code == 200:
-                        response_status_code = 200
+                    if pinned_token:
+                        response = self._request_upstream(token, proxy, request_body)
+                    else:
+                        response, token, proxy = self._open_upstream(model, token, proxy, request_body, ticket)
+                    status_code = response.status_code
+
+                    logger.info("请求状态码: {}", "Server", status_code)
+
+                    self._record_token_result(token, model, response, proxy)
+
+                    if status_code == 200:
                         logger.info("请求成功", "Server")
-                        
+                        response = self.recorder.wrap(response, model, stream, token)
+
                         if stream:
-                            return Response(
-                                stream_with_context(self.handle_stream_response(response, model)),
-                                content_type='text/event-stream'
-                            )
-                        else:
-                                return self.handle_non_stream_response(response, model)
-                            
-                    elif response.status_code == 403:
-                        response_status_code = 403
-                        logger.error("IP暂时被封禁，请稍后重试或者更换IP", "Server")
-                        raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
-                        
-                    elif response.status_code == 429:
-                        response_status_code = 429
-                        logger.warning(f"令牌配额已用完，继续轮询其他令牌: {token[:20]}...", "Server")
-                    else:
-                        logger.warning(f"令牌返回异常状态码 {response.status_code}，继续轮询: {token[:20]}...", "Server")
-                        
+                            # 名额交给流，在流结束或客户端断开时释放
+                            frames = AdmittedStream(self.handle_stream_response(response, model, coalesce), ticket)
+                            ticket = NULL_TICKET
+                            if raw_stream:
+                                return frames
+                            return Response(stream_with_context(frames), content_type='text/event-stream')
+                        # 读取响应内容时的网络异常同样可以重试
+                        return self.handle_non_stream_response(response, model)
+
+                    self._log_upstream_status(token, status_code)
+                    kind = self._classify_status(status_code, proxy)
+
+                except Overloaded:
+                    # 会话池的传输线程已全部占用，不是上游的失败，直接拒绝而不重试
+                    raise
                 except Exception as e:
-                    logger.error(f"请求处理异常: {str(e)}", "Server")
-                    # 检查是否是超时或网络异常，这些通常可以重试
-                    if "timeout" in str(e).lower() or "connection" in str(e).lower():
-                        logger.warning(f"网络异常，继续重试: {str(e)[:100]}", "Server")
-                        continue
+                    logger.error("请求处理异常: {}", "Server", e)
+                    kind = self._record_upstream_error(e, proxy)
+                    if kind == BACKOFF:
+                        failed_proxies.append(proxy)
+
+                delay = None if pinned_token else self._retry_delay(attempt, kind)
+                if delay is None:
+                    raise self._upstream_failure(status_code)
+                if delay:
+                    time.sleep(delay)
+
+        except Overloaded:
+            # 过载时的拒绝不记录错误日志，避免日志本身加重负载
+            raise
+        except Exception as error:
+            logger.error(str(error), "ChatAPI")
+            raise
+        finally:
+            ticket.release()
+
+    async def make_grok_request_async(self, data, model, stream=False, token=None, request_body=None):
+        """异步版本的上游请求，供ASGI服务模式使用；流式时返回SSE帧的异步生成器"""
+        pinned_token = token
+        coalesce = self._get_coalesce_options(data) if stream else None
+        ticket = NULL_TICKET
+
+        try:
+            # 请求体与令牌无关，只构造一次，重试时复用
+            if request_body is None:
+                request_body = self._build_request_body(data, model)
+            if not pinned_token:
+                self.retry_policy.record_request()
+                ticket = await self._admit_async()
+
+            attempt = 0
+            # 本请求中出现网络错误的代理，重试时优先避开
+            failed_proxies = []
+            while True:
+                attempt += 1
+                token = pinned_token or await self._acquire_token_async(model, ticket)
+                if not token:
+                    raise ValueError('无可用令牌')
+                proxy = self._choose_proxy(token, failed_proxies)
+
+                logger.info("当前令牌: {}... 代理: {}", "Server", token[:50], proxy.label)
+                status_code = None
+
+                try:
+                    if pinned_token:
+                        response = await self._request_upstream_async(token, proxy, request_body)
                     else:
-                        # 其他异常直接跳出重试循环
-                        break
-            
-            if response_status_code == 403:
-                raise ValueError('IP暂时被封无法破盾，请稍后重试或者更换ip')
-            elif response_status_code == 500:
-                raise ValueError('请求失败，请检查网络连接或稍后重试')    
-                
+                        response, token, proxy = await self._open_upstream_async(model, token, proxy, request_body, ticket)
+                    status_code = response.status_code
+
+                    logger.info("请求状态码: {}", "Server", status_code)
+
+                    self._record_token_result(token, model, response, proxy)
+
+                    if status_code == 200:
+                        logger.info("请求成功", "Server")
+                        response = self.recorder.wrap_async(response, model, stream, token)
+
+                        if stream:
+                            # 上游响应的关闭和名额的释放交给流式生成器负责
+                            frames = AsyncAdmittedStream(self.handle_stream_response_async(response, model, coalesce), ticket)
+                            ticket = NULL_TICKET
+                            return frames
+                        try:
+                            return await self.handle_non_stream_response_async(response, model)
+                        finally:
+                            await response.aclose()
+
+                    await response.aclose()
+                    self._log_upstream_status(token, status_code)
+                    kind = self._classify_status(status_code, proxy)
+
+                except Exception as e:
+                    logger.error("请求处理异常: {}", "Server", e)
+                    kind = self._record_upstream_error(e, proxy)
+                    if kind == BACKOFF:
+                        failed_proxies.append(proxy)
+
+                delay = None if pinned_token else self._retry_delay(attempt, kind)
+                if delay is None:
+                    raise self._upstream_failure(status_code)
+                if delay:
+                    await asyncio.sleep(delay)
+
+        except Overloaded:
+            # 过载时的拒绝不记录错误日志，避免日志本身加重负载
+            raise
         except Exception as error:
             logger.error(str(error), "ChatAPI")
             raise
-            
+        finally:
+            ticket.release()
+
     def validate_request(self, request_data):
         model = request_data.get("model")
         if not model:
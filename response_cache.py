@@ -0,0 +1,103 @@
+"""
+非流式补全的响应缓存
+
+批量任务经常发送完全相同的非流式请求。开启后，以模型和规范化后的上游请求体为键缓存完整的补全响应，
+命中时直接返回，不选取令牌也不请求上游。条目在TTL后过期，超过内存上限时按LRU淘汰。
+
+请求头 Cache-Control: no-cache 跳过缓存查询（结果仍会更新缓存），no-store 既不查询也不写入；
+响应头 X-Cache 返回 HIT / MISS / BYPASS。
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+from hashlib import blake2b
+
+# 每个条目除响应内容外的大致开销
+ENTRY_OVERHEAD = 256
+
+HIT = "HIT"
+MISS = "MISS"
+BYPASS = "BYPASS"
+
+
+def parse_cache_control(value):
+    """解析请求的 Cache-Control，返回 (是否跳过查询, 是否写入缓存)"""
+    directives = {item.strip().lower() for item in (value or "").split(",")}
+    if "no-store" in directives:
+        return True, False
+    return "no-cache" in directives, True
+
+
+def make_key(model, request_body):
+    digest = blake2b(digest_size=16)
+    digest.update(model.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(request_body.encode("utf-8"))
+    return digest.digest()
+
+
+class ResponseCache:
+    def __init__(self, enabled, ttl, max_bytes):
+        self.enabled = enabled and ttl > 0 and max_bytes > 0
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0, "stored": 0, "expired": 0, "evictions": 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, size, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return response
+                del self._entries[key]
+                self._size -= size
+                self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, response):
+        size = len(json.dumps(response, ensure_ascii=False)) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (response, size, expires_at)
+            self._size += size
+            self.stats["stored"] += 1
+            while self._size > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.stats["evictions"] += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self.stats["bypassed"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else 0.0
+            }
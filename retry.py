@@ -0,0 +1,312 @@
+"""
+上游请求的重试策略：失败分类、指数退避、全局重试预算与熔断器
+
+失败按类型和状态码分为三类：
+- rotate: 与令牌相关的失败（429 配额用完、401/402 令牌失效），换一个令牌立即重试
+- backoff: 上游或网络的暂时性失败（5xx、408、超时、连接错误），按指数退避加随机抖动后重试
+- fatal: 重试无意义的失败（403 IP封禁、其他4xx、证书和配置错误）
+
+重试预算限制最近一段时间内的重试次数不超过请求数的一定比例（另有每秒的保底次数），
+上游整体故障时重试不会把流量放大数倍，而是很快退化为每个请求只发一次。
+
+熔断器按令牌和按代理各自维护：连续失败达到阈值后打开，打开期间直接跳过该令牌、或对该代理快速失败；
+冷却结束后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。
+网络错误、5xx 和 403 归因于线路（代理，未配置代理时为直连），401 等令牌相关的4xx归因于令牌。
+令牌在某个模型上的配额冷却仍由 AuthTokenManager 负责，这里的令牌熔断不区分模型。
+"""
+import time
+import random
+import asyncio
+import threading
+from curl_cffi.curl import CurlError
+from curl_cffi.requests.exceptions import (
+    CertificateVerifyError, InvalidURL, InvalidSchema, MissingSchema, InvalidHeader, ImpersonateError
+)
+
+ROTATE = "rotate"
+BACKOFF = "backoff"
+FATAL = "fatal"
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 换令牌即可恢复的状态码；5xx 之外可退避重试的状态码；其余4xx（含403 IP封禁）不重试
+ROTATE_STATUS = frozenset((401, 402, 429))
+BACKOFF_STATUS = frozenset((408, 425))
+# 本地配置或证书问题，重试只会得到同样的结果
+FATAL_ERRORS = (CertificateVerifyError, InvalidURL, InvalidSchema, MissingSchema, InvalidHeader, ImpersonateError)
+
+
+def classify_status(status_code):
+    """非200状态码的失败分类"""
+    if status_code in ROTATE_STATUS:
+        return ROTATE
+    if status_code >= 500 or status_code in BACKOFF_STATUS:
+        return BACKOFF
+    return FATAL
+
+
+def classify_error(error):
+    """请求上游或读取响应时抛出异常的失败分类：网络层的异常可以重试，其余视为程序或配置错误"""
+    if isinstance(error, FATAL_ERRORS):
+        return FATAL
+    if isinstance(error, (CurlError, OSError, asyncio.TimeoutError)):
+        return BACKOFF
+    return FATAL
+
+
+class RetryBudget:
+    """
+    最近 window 秒内的重试次数不超过 请求数 * ratio + min_per_second * window。
+    按秒分桶计数，记录一次请求只更新当前秒的桶。
+    """
+
+    def __init__(self, ratio, min_per_second, window=10):
+        self.ratio = ratio
+        self.min_retries = min_per_second * window
+        self.window = window
+        # 每个桶为 [所属秒, 请求数, 重试数]
+        self._buckets = [[0, 0, 0] for _ in range(window)]
+        self._lock = threading.Lock()
+
+    def _bucket(self, second):
+        bucket = self._buckets[second % self.window]
+        if bucket[0] != second:
+            bucket[0], bucket[1], bucket[2] = second, 0, 0
+        return bucket
+
+    def record_request(self):
+        second = int(time.monotonic())
+        with self._lock:
+            self._bucket(second)[1] += 1
+
+    def try_acquire(self):
+        """预算内返回True并计入一次重试"""
+        second = int(time.monotonic())
+        with self._lock:
+            requests = retries = 0
+            for bucket in self._buckets:
+                if second - bucket[0] < self.window:
+                    requests += bucket[1]
+                    retries += bucket[2]
+            if retries >= requests * self.ratio + self.min_retries:
+                return False
+            self._bucket(second)[2] += 1
+            return True
+
+    def get_stats(self):
+        second = int(time.monotonic())
+        with self._lock:
+            live = [bucket for bucket in self._buckets if second - bucket[0] < self.window]
+            requests = sum(bucket[1] for bucket in live)
+            retries = sum(bucket[2] for bucket in live)
+        return {
+            "window": self.window,
+            "requests": requests,
+            "retries": retries,
+            "limit": int(requests * self.ratio + self.min_retries)
+        }
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts, base_delay_ms, max_delay_ms, budget=None):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay_ms / 1000
+        self.max_delay = max_delay_ms / 1000
+        self.budget = budget
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "retries": {ROTATE: 0, BACKOFF: 0},
+            # 放弃重试的原因：不可重试、次数用完、超出重试预算
+            "gave_up": {FATAL: 0, "attempts": 0, "budget": 0}
+        }
+
+    def _count(self, group, key):
+        with self._lock:
+            self.stats[group][key] += 1
+
+    def record_request(self):
+        with self._lock:
+            self.stats["requests"] += 1
+        if self.budget is not None:
+            self.budget.record_request()
+
+    def backoff_delay(self, attempt):
+        """第 attempt 次尝试失败后的等待时间：上限按指数增长，在 [0, 上限] 内均匀取值（full jitter）"""
+        cap = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+    def next_delay(self, kind, attempt):
+        """
+        第 attempt 次尝试以 kind 类失败结束后，返回重试前的等待秒数；不再重试时返回 (None, 放弃原因)。
+        """
+        if kind == FATAL:
+            self._count("gave_up", FATAL)
+            return None, FATAL
+        if attempt >= self.max_attempts:
+            self._count("gave_up", "attempts")
+            return None, "attempts"
+        if self.budget is not None and not self.budget.try_acquire():
+            self._count("gave_up", "budget")
+            return None, "budget"
+        self._count("retries", kind)
+        return (0.0 if kind == ROTATE else self.backoff_delay(attempt)), None
+
+    def get_stats(self):
+        with self._lock:
+            stats = {
+                "requests": self.stats["requests"],
+                "retries": dict(self.stats["retries"]),
+                "gave_up": dict(self.stats["gave_up"])
+            }
+        stats["max_attempts"] = self.max_attempts
+        stats["base_delay_ms"] = self.base_delay * 1000
+        stats["max_delay_ms"] = self.max_delay * 1000
+        if self.budget is not None:
+            stats["budget"] = self.budget.get_stats()
+        return stats
+
+
+class _Breaker:
+    __slots__ = ("state", "failures", "successes", "window_start", "opened_at", "probe_at")
+
+    def __init__(self, now):
+        self.state = CLOSED
+        self.failures = 0
+        self.successes = 0
+        self.window_start = now
+        self.opened_at = 0.0
+        # 半开状态下探测请求放行的时间，探测结果迟迟未回报时允许再放行一个
+        self.probe_at = 0.0
+
+
+class BreakerRegistry:
+    """
+    按键（令牌或代理）维护的熔断器。只为出现过失败的键保存状态，恢复后即删除，
+    正常情况下 allow / record_success 只是一次字典查找。
+
+    未指定 failure_rate 时按连续失败计数，任一成功即清零（适合令牌：单个令牌的请求稀疏）；
+    指定时在 window 秒的窗口内，失败数达到阈值且失败率不低于 failure_rate 才打开
+    （适合代理：所有请求共用一条线路，零星失败不应让全部请求快速失败）。
+    """
+
+    def __init__(self, failure_threshold, open_seconds, label=str, failure_rate=None, window=10):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.failure_rate = failure_rate
+        self.window = window
+        # 统计中展示键的方式，避免把令牌等凭据原样输出
+        self.label = label
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "closed": 0, "rejected": 0, "probes": 0}
+
+    def allow(self, key):
+        """是否放行对该键的请求；冷却结束后放行的第一个请求作为半开探测"""
+        breaker = self._breakers.get(key)
+        if breaker is None or breaker.state == CLOSED:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if breaker.state == CLOSED:
+                return True
+            if breaker.state == OPEN and now - breaker.opened_at >= self.open_seconds:
+                breaker.state = HALF_OPEN
+            if breaker.state == HALF_OPEN and now - breaker.probe_at >= self.open_seconds:
+                breaker.probe_at = now
+                self.stats["probes"] += 1
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def release_probe(self, key):
+        """allow 放行的半开探测最终没有发出（如令牌名额已满），归还探测机会，下一个请求可以立即探测"""
+        breaker = self._breakers.get(key)
+        if breaker is None or breaker.state != HALF_OPEN:
+            return
+        with self._lock:
+            if breaker.state == HALF_OPEN and breaker.probe_at:
+                breaker.probe_at = 0.0
+                self.stats["probes"] -= 1
+
+    def record_success(self, key):
+        if key not in self._breakers:
+            return
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                return
+            if breaker.state != CLOSED:
+                # 半开探测成功（或打开前发出的请求成功），线路已恢复
+                self.stats["closed"] += 1
+            elif self.failure_rate is not None and now - breaker.window_start < self.window:
+                breaker.successes += 1
+                return
+            del self._breakers[key]
+
+    def record_failure(self, key):
+        now = time.monotonic()
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = _Breaker(now)
+            elif breaker.state == CLOSED and self.failure_rate is not None and now - breaker.window_start >= self.window:
+                breaker.failures = breaker.successes = 0
+                breaker.window_start = now
+            breaker.failures += 1
+            if breaker.state == HALF_OPEN or (breaker.state == CLOSED and self._should_open(breaker)):
+                breaker.state = OPEN
+                breaker.opened_at = now
+                breaker.probe_at = 0.0
+                self.stats["opened"] += 1
+
+    def _should_open(self, breaker):
+        if breaker.failures < self.failure_threshold:
+            return False
+        if self.failure_rate is None:
+            return True
+        return breaker.failures >= self.failure_rate * (breaker.failures + breaker.successes)
+
+    def __len__(self):
+        """有失败记录的键数（含尚未打开的）"""
+        return len(self._breakers)
+
+    def state(self, key):
+        breaker = self._breakers.get(key)
+        return breaker.state if breaker is not None else CLOSED
+
+    def count_states(self):
+        """各状态（open / half_open）的熔断器数量；冷却已结束但尚未探测的计为半开"""
+        now = time.monotonic()
+        counts = {OPEN: 0, HALF_OPEN: 0}
+        with self._lock:
+            for breaker in self._breakers.values():
+                if breaker.state == OPEN:
+                    counts[OPEN if now - breaker.opened_at < self.open_seconds else HALF_OPEN] += 1
+                elif breaker.state == HALF_OPEN:
+                    counts[HALF_OPEN] += 1
+        return counts
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            breakers = [
+                {
+                    "key": self.label(key),
+                    "state": breaker.state,
+                    "failures": breaker.failures,
+                    "open_remaining": round(max(0.0, self.open_seconds - (now - breaker.opened_at)), 1)
+                    if breaker.state == OPEN else 0
+                }
+                for key, breaker in self._breakers.items() if breaker.state != CLOSED
+            ]
+            stats = dict(self.stats)
+        stats.update(self.count_states())
+        stats["failure_threshold"] = self.failure_threshold
+        stats["failure_rate"] = self.failure_rate
+        stats["open_seconds"] = self.open_seconds
+        stats["breakers"] = breakers
+        return stats
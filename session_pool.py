@@ -0,0 +1,480 @@
+"""
+上游会话池
+
+按 (令牌, 代理) 复用 curl_cffi 会话，使 keep-alive 连接在多次请求和重试之间复用，
+避免每次请求都重新进行 TCP/TLS 握手和代理 CONNECT。
+
+- SessionPool: 同步模式，会话独占借出，用完归还；空闲会话数量有上限并按空闲时间淘汰；
+  传输在复用的工作线程中执行，不为每个请求新建线程，线程全部占用时新请求立即被拒绝（Overloaded）
+- AsyncSessionPool: 异步模式，每个 key 共享一个 AsyncSession，底层 curl multi 句柄自带连接缓存，
+  开启 HTTP/2 时同一连接上的多个流可以多路复用
+"""
+import math
+import time
+import queue
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from curl_cffi import requests as curl_requests
+from curl_cffi.const import CurlInfo, CurlOpt, CurlHttpVersion
+from curl_cffi.curl import CURL_WRITEFUNC_ERROR
+from curl_cffi.requests.exceptions import Timeout
+from config import config_manager
+from logger import logger
+from admission import Overloaded, WORKERS_BUSY
+
+
+_STREAM_END = object()
+
+# 调用方提前关闭流后，继续排空剩余数据以保留连接的最长时间（秒）
+DRAIN_GRACE = 2.0
+# 等待响应头的兜底余量（秒）：curl 的连接超时和低速超时都已过去仍未返回时放弃，不让调用方无限等待
+HEADER_WAIT_MARGIN = 5.0
+
+
+def _new_stats():
+    return {
+        "sessions_created": 0,
+        "sessions_reused": 0,
+        "sessions_evicted": 0,
+        "connections_new": 0,
+        "connections_reused": 0
+    }
+
+
+def _connect_time(curl):
+    """新建连接的耗时（含TLS及代理握手），复用连接时返回None"""
+    if curl.getinfo(CurlInfo.NUM_CONNECTS) == 0:
+        return None
+    return curl.getinfo(CurlInfo.APPCONNECT_TIME) or curl.getinfo(CurlInfo.CONNECT_TIME)
+
+
+def _apply_http_version(options):
+    if not config_manager.get("POOL.HTTP2", True):
+        options["http_version"] = CurlHttpVersion.V1_1
+    return options
+
+
+class PooledStreamResponse:
+    """
+    在池化会话自身的curl句柄上执行的流式响应。
+
+    curl_cffi 的 stream=True 会为每个请求复制一个新句柄，连接无法被复用，
+    因此这里在池的工作线程中以 content_callback 的方式执行请求，并通过队列把数据交给调用方。
+    header_timeout 秒内未收到响应（含等待空闲工作线程的时间）则中断传输并抛出 Timeout。
+    """
+
+    def __init__(self, pool, key, session, options, header_timeout):
+        self.pool = pool
+        self.key = key
+        self.session = session
+        self.status_code = None
+        self.headers = {}
+        self.new_connection = None
+        # 供指标使用：发出请求、收到首个数据块的时间，以及新建连接的耗时
+        self.started_at = time.monotonic()
+        self.first_line_at = None
+        self.connect_time = None
+        self._queue = queue.SimpleQueue()
+        self._header_event = threading.Event()
+        self._done_event = threading.Event()
+        self._closed_at = None
+        self._aborted = False
+        self._error = None
+
+        deadline = self.started_at + header_timeout
+        try:
+            pool._workers.submit(self._perform, options)
+        except Exception:
+            # 工作线程无法启动（如线程数达到系统上限），会话未被使用，直接丢弃
+            pool._release_worker()
+            pool._release(key, session, None, False)
+            raise
+
+        if not self._header_event.wait(header_timeout):
+            # 工作线程之后收到的数据一律丢弃并中断传输，会话在传输结束后照常归还
+            self.abort()
+            raise Timeout(f"{header_timeout:g}秒内未收到上游响应")
+        if self.status_code is None:
+            raise self._error
+        if self.status_code != 200:
+            # 错误响应体很小，等待请求结束以便读取响应头（如 Retry-After）
+            if not self._done_event.wait(max(0.0, deadline - time.monotonic())):
+                self.abort()
+
+    def _on_data(self, chunk):
+        if not self._header_event.is_set():
+            curl = self.session.curl
+            self.status_code = curl.getinfo(CurlInfo.RESPONSE_CODE)
+            self.connect_time = _connect_time(curl)
+            self.new_connection = self.connect_time is not None
+            self.first_line_at = time.monotonic()
+            self._header_event.set()
+
+        if self._closed_at is not None:
+            # 调用方已不再读取，排空剩余数据以便连接可以归还复用，超时则中断传输
+            if self._aborted or time.monotonic() - self._closed_at > DRAIN_GRACE:
+                return CURL_WRITEFUNC_ERROR
+            return len(chunk)
+
+        self._queue.put(chunk)
+        return len(chunk)
+
+    def _perform(self, options):
+        reusable = True
+        try:
+            if self._aborted:
+                # 排队等待工作线程期间调用方已超时放弃
+                return
+            response = self.session.request("POST", content_callback=self._on_data, **options)
+            self.headers = response.headers
+            if self.status_code is None:
+                self.status_code = response.status_code
+        except Exception as e:
+            self._error = e
+            # 主动中断的传输不影响会话本身，其余异常则丢弃该会话
+            reusable = self._closed_at is not None
+        finally:
+            self._header_event.set()
+            self._done_event.set()
+            self._queue.put(_STREAM_END)
+            self.pool._release(self.key, self.session, self.new_connection, reusable)
+            self.pool._release_worker()
+
+    def iter_lines(self, idle_timeout=None):
+        """按行读取响应；指定 idle_timeout 时，超过该时间没有数据则产出一个空行，便于调用方处理定时任务"""
+        pending = b''
+        while True:
+            try:
+                chunk = self._queue.get(timeout=idle_timeout)
+            except queue.Empty:
+                yield b''
+                continue
+            if chunk is _STREAM_END:
+                break
+            pending += chunk
+            if b'\n' not in chunk:
+                continue
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip(b'\r')
+
+        if pending:
+            yield pending
+        if self._error is not None and self._closed_at is None:
+            raise self._error
+
+    def close(self):
+        if self._closed_at is None and not self._done_event.is_set():
+            self._closed_at = time.monotonic()
+
+    def abort(self):
+        """立即中断传输，不排空剩余数据（用于对冲请求中落败的一方）"""
+        self._aborted = True
+        self.close()
+
+
+class SessionPool:
+    def __init__(self):
+        self._idle = OrderedDict()  # key -> [(session, last_used), ...]
+        self._idle_count = 0
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.stats = _new_stats()
+        self.stats["rejected_workers_busy"] = 0
+        # 工作线程在整个传输期间占用，busy_workers 达到上限时不再提交，避免请求在线程池队列中等到超时
+        self.max_workers = config_manager.get("POOL.MAX_WORKERS", 512)
+        self.busy_workers = 0
+        self._workers = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="SessionPool")
+
+    def _create_session(self):
+        return curl_requests.Session(use_thread_local_curl=False)
+
+    def _acquire(self, key):
+        with self._lock:
+            self._sweep_locked()
+            sessions = self._idle.get(key)
+            if sessions:
+                session, _ = sessions.pop()
+                if not sessions:
+                    del self._idle[key]
+                self._idle_count -= 1
+                self.stats["sessions_reused"] += 1
+                return session
+            self.stats["sessions_created"] += 1
+        return self._create_session()
+
+    def _release(self, key, session, new_connection, reusable):
+        evicted = []
+        with self._lock:
+            if new_connection is not None:
+                self.stats["connections_new" if new_connection else "connections_reused"] += 1
+
+            if reusable:
+                self._idle.setdefault(key, []).append((session, time.monotonic()))
+                self._idle.move_to_end(key)
+                self._idle_count += 1
+                # 超出上限时淘汰最久未使用的空闲会话
+                while self._idle_count > config_manager.get("POOL.MAX_IDLE_SESSIONS", 256):
+                    oldest_key = next(iter(self._idle))
+                    oldest = self._idle[oldest_key]
+                    evicted.append(oldest.pop(0)[0])
+                    if not oldest:
+                        del self._idle[oldest_key]
+                    self._idle_count -= 1
+            else:
+                evicted.append(session)
+            self.stats["sessions_evicted"] += len(evicted)
+
+        for stale in evicted:
+            stale.close()
+
+    def _reserve_worker(self):
+        with self._lock:
+            if self.busy_workers >= self.max_workers:
+                self.stats["rejected_workers_busy"] += 1
+                return False
+            self.busy_workers += 1
+            return True
+
+    def _release_worker(self):
+        with self._lock:
+            self.busy_workers -= 1
+
+    def _sweep_locked(self):
+        """关闭空闲超时的会话，最多每秒执行一次"""
+        now = time.monotonic()
+        if now - self._last_sweep < 1:
+            return
+        self._last_sweep = now
+
+        idle_timeout = config_manager.get("POOL.IDLE_TIMEOUT", 90)
+        for key in list(self._idle):
+            fresh = []
+            for session, last_used in self._idle[key]:
+                if now - last_used < idle_timeout:
+                    fresh.append((session, last_used))
+                else:
+                    session.close()
+                    self._idle_count -= 1
+                    self.stats["sessions_evicted"] += 1
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    def request(self, token, proxy, header_timeout=None, **options):
+        """
+        借出会话并发起请求，响应读取结束后会话自动归还。
+        header_timeout 为等待响应的时限（秒），默认为 curl 自身超时之上再留余量
+        """
+        key = (token, proxy or '')
+        timeout = options.pop("timeout", 10)
+        options.pop("stream", None)
+
+        if not self._reserve_worker():
+            raise Overloaded('服务繁忙，上游传输线程已全部占用', 503, WORKERS_BUSY, 1)
+        try:
+            session = self._acquire(key)
+        except Exception:
+            self._release_worker()
+            raise
+        # 与 stream=True 一致：只限制连接超时和读空闲时间，不限制总时长
+        session.curl_options = {
+            CurlOpt.TIMEOUT_MS: 0,
+            CurlOpt.CONNECTTIMEOUT_MS: int(timeout * 1000),
+            CurlOpt.LOW_SPEED_LIMIT: 1,
+            CurlOpt.LOW_SPEED_TIME: max(1, math.ceil(timeout))
+        }
+        try:
+            # curl 最迟在连接超时加一个低速超时周期后自行失败，响应头的等待时限在此之上再留余量
+            if header_timeout is None:
+                header_timeout = 2 * timeout + HEADER_WAIT_MARGIN
+            return PooledStreamResponse(self, key, session, _apply_http_version(options), header_timeout)
+        except Exception:
+            logger.warning("上游请求失败，丢弃会话: {}...", "SessionPool", token[:20])
+            raise
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.stats,
+                "idle_sessions": self._idle_count,
+                "idle_keys": len(self._idle),
+                "busy_workers": self.busy_workers,
+                "max_workers": self.max_workers
+            }
+
+
+class _AsyncPoolEntry:
+    __slots__ = ("session", "in_flight", "last_used")
+
+    def __init__(self, session):
+        self.session = session
+        self.in_flight = 0
+        self.last_used = time.monotonic()
+
+
+class AsyncPooledResponse:
+    """异步池化响应，关闭时归还会话引用计数"""
+
+    def __init__(self, pool, entry, response, started_at, connect_time=None):
+        self.pool = pool
+        self.entry = entry
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.started_at = started_at
+        self.first_line_at = None
+        self.connect_time = connect_time
+        self._released = False
+        self._lines = None
+        self._prefetched = []
+        self._exhausted = False
+
+    def _line_iterator(self):
+        # 预读与后续读取必须共用同一个迭代器，否则预读时缓冲的半行数据会丢失
+        if self._lines is None:
+            self._lines = self.response.aiter_lines()
+        return self._lines
+
+    async def prefetch_line(self):
+        """读取并缓存第一行，返回时上游已开始输出（用于对冲请求判断首行延迟）"""
+        try:
+            self._prefetched.append(await self._line_iterator().__anext__())
+            self.first_line_at = time.monotonic()
+        except StopAsyncIteration:
+            self._exhausted = True
+
+    async def aiter_lines(self, idle_timeout=None):
+        """按行读取响应；指定 idle_timeout 时，超过该时间没有数据则产出一个空行"""
+        while self._prefetched:
+            yield self._prefetched.pop(0)
+        if self._exhausted:
+            return
+        lines = self._line_iterator()
+        if idle_timeout is None:
+            async for line in lines:
+                if self.first_line_at is None:
+                    self.first_line_at = time.monotonic()
+                yield line
+            return
+
+        # 不能直接对 __anext__ 使用 wait_for，超时取消会中断底层的生成器
+        next_line = None
+        try:
+            while True:
+                if next_line is None:
+                    next_line = asyncio.ensure_future(lines.__anext__())
+                done, _ = await asyncio.wait((next_line,), timeout=idle_timeout)
+                if not done:
+                    yield b''
+                    continue
+                task, next_line = next_line, None
+                try:
+                    line = task.result()
+                except StopAsyncIteration:
+                    return
+                if self.first_line_at is None:
+                    self.first_line_at = time.monotonic()
+                yield line
+        finally:
+            if next_line is not None:
+                next_line.cancel()
+
+    async def aclose(self):
+        if self._released:
+            return
+        self._released = True
+        try:
+            await self.response.aclose()
+        finally:
+            self.pool._release(self.entry)
+
+    async def abort(self):
+        """立即中断传输，不等待剩余数据（用于对冲请求中落败的一方）"""
+        # aclose 会等待上游传输结束，设置 quit_now 后下一次写回调即中断传输
+        if getattr(self.response, "quit_now", None) is not None:
+            self.response.quit_now.set()
+        await self.aclose()
+
+
+class AsyncSessionPool:
+    def __init__(self):
+        self._sessions = OrderedDict()  # key -> _AsyncPoolEntry
+        self._last_sweep = time.monotonic()
+        self.stats = _new_stats()
+
+    def _acquire(self, key):
+        self._sweep()
+        entry = self._sessions.get(key)
+        if entry is None:
+            entry = _AsyncPoolEntry(curl_requests.AsyncSession(
+                max_clients=config_manager.get("POOL.MAX_STREAMS_PER_SESSION", 100)
+            ))
+            self._sessions[key] = entry
+            self.stats["sessions_created"] += 1
+            self._evict_overflow()
+        else:
+            self._sessions.move_to_end(key)
+            self.stats["sessions_reused"] += 1
+        entry.in_flight += 1
+        return entry
+
+    def _release(self, entry):
+        entry.in_flight -= 1
+        entry.last_used = time.monotonic()
+
+    def _close_entry(self, key):
+        entry = self._sessions.pop(key)
+        self.stats["sessions_evicted"] += 1
+        # 在当前事件循环中异步关闭，不阻塞请求路径
+        asyncio.ensure_future(entry.session.close())
+
+    def _evict_overflow(self):
+        max_sessions = config_manager.get("POOL.MAX_IDLE_SESSIONS", 256)
+        for key in list(self._sessions):
+            if len(self._sessions) <= max_sessions:
+                break
+            if self._sessions[key].in_flight == 0:
+                self._close_entry(key)
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < 1:
+            return
+        self._last_sweep = now
+
+        idle_timeout = config_manager.get("POOL.IDLE_TIMEOUT", 90)
+        for key in list(self._sessions):
+            entry = self._sessions[key]
+            if entry.in_flight == 0 and now - entry.last_used >= idle_timeout:
+                self._close_entry(key)
+
+    async def request(self, token, proxy, **options):
+        key = (token, proxy or '')
+        entry = self._acquire(key)
+        started_at = time.monotonic()
+        try:
+            response = await entry.session.request("POST", **_apply_http_version(options))
+        except BaseException:
+            self._release(entry)
+            raise
+
+        connect_time = None
+        try:
+            connect_time = _connect_time(response.curl)
+            self.stats["connections_reused" if connect_time is None else "connections_new"] += 1
+        except Exception:
+            # 响应极短时句柄可能已被会话回收，此时无法统计
+            pass
+        return AsyncPooledResponse(self, entry, response, started_at, connect_time)
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "sessions": len(self._sessions),
+            "in_flight": sum(entry.in_flight for entry in self._sessions.values())
+        }
@@ -0,0 +1,397 @@
+"""
+相同请求的合并（single-flight）
+
+同一时刻的多个相同请求（模型和规范化后的上游请求体一致）只向上游发起一次：
+- 非流式：第一个请求（leader）请求上游，其余请求（follower）等待并共享它的结果或异常
+- 流式（可选）：一个上游流由后台泵送，SSE帧按顺序广播给所有订阅者，晚加入的订阅者从头回放；
+  所有订阅者断开后停止泵送并关闭上游
+
+每个请求的 follower 数量有上限，超过上限的请求单独请求上游。
+同步版本供 threaded 模式的请求线程使用，Async 版本供 asgi 模式的事件循环使用。
+"""
+import asyncio
+import threading
+from logger import logger
+
+
+def _new_stats():
+    return {"leaders": 0, "followers": 0, "overflow": 0, "abandoned": 0}
+
+
+class _Flight:
+    __slots__ = ("ready", "result", "error", "followers")
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """同步版本的非流式请求合并"""
+
+    def __init__(self, max_followers, timeout):
+        self.max_followers = max_followers
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = _new_stats()
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.stats["leaders"] += 1
+                leader = True
+            elif flight.followers < self.max_followers:
+                flight.followers += 1
+                self.stats["followers"] += 1
+                leader = False
+            else:
+                self.stats["overflow"] += 1
+                flight = None
+
+        if flight is None:
+            return func()
+
+        if leader:
+            try:
+                flight.result = func()
+                return flight.result
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.ready.set()
+
+        if not flight.ready.wait(self.timeout):
+            raise ValueError('等待相同请求的上游响应超时')
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, "in_flight": len(self._flights)}
+
+
+class _AsyncFlight:
+    __slots__ = ("task", "waiters", "followers")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 1
+        self.followers = 0
+
+
+class AsyncSingleFlight:
+    """异步版本的非流式请求合并；上游请求在独立任务中执行，所有等待者都断开后才取消"""
+
+    def __init__(self, max_followers, timeout):
+        self.max_followers = max_followers
+        self.timeout = timeout
+        self._flights = {}
+        self.stats = _new_stats()
+
+    async def do(self, key, coro_func):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _AsyncFlight(asyncio.ensure_future(coro_func()))
+            flight.task.add_done_callback(lambda _: self._flights.pop(key, None) if self._flights.get(key) is flight else None)
+            self.stats["leaders"] += 1
+        elif flight.followers < self.max_followers:
+            flight.followers += 1
+            flight.waiters += 1
+            self.stats["followers"] += 1
+        else:
+            self.stats["overflow"] += 1
+            return await coro_func()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), self.timeout)
+        except asyncio.TimeoutError:
+            raise ValueError('等待相同请求的上游响应超时')
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self.stats["abandoned"] += 1
+                flight.task.cancel()
+
+    def get_stats(self):
+        return {**self.stats, "in_flight": len(self._flights)}
+
+
+class _Broadcast:
+    """一个上游流的广播状态：已产出的全部帧、是否结束、订阅者数量"""
+    __slots__ = ("cond", "frames", "done", "closed", "subscribers", "ready", "error")
+
+    def __init__(self, cond, ready):
+        self.cond = cond
+        self.ready = ready
+        self.frames = []
+        self.done = False
+        # 所有订阅者都已断开，不再接受新的订阅
+        self.closed = False
+        self.subscribers = 1
+        self.error = None
+
+
+class _Subscriber:
+    """
+    订阅者的帧迭代器，按顺序产出广播中的帧，结束或被关闭时减少订阅者计数（所有订阅者断开后泵送停止）。
+    与 admission.AdmittedStream 相同，不用生成器实现：未开始迭代就被关闭或回收的生成器不会执行 finally
+    """
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.index = 0
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            if self.position >= len(self.buffer):
+                self._fetch()
+            if self.position >= len(self.buffer):
+                raise StopIteration
+        except BaseException:
+            self.close()
+            raise
+        frame = self.buffer[self.position]
+        self.position += 1
+        return frame
+
+    def _fetch(self):
+        """取出广播中尚未产出的帧，没有新帧时等待，广播结束后取到的为空"""
+        flight = self.flight
+        self.buffer, self.position = [], 0
+        if self.closed:
+            return
+        with flight.cond:
+            while self.index >= len(flight.frames) and not flight.done:
+                flight.cond.wait()
+            self.buffer = flight.frames[self.index:]
+            self.index += len(self.buffer)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        with self.flight.cond:
+            self._leave()
+
+    def _leave(self):
+        self.flight.subscribers -= 1
+        if self.flight.subscribers == 0:
+            self.flight.closed = True
+
+    def __del__(self):
+        # 兜底：调用方丢弃了未关闭的订阅者时也减少计数
+        self.close()
+
+
+class _AsyncSubscriber(_Subscriber):
+    """异步版本的订阅者，只在事件循环线程中使用，计数的修改不需要加锁"""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            if self.position >= len(self.buffer):
+                await self._fetch_async()
+            if self.position >= len(self.buffer):
+                raise StopAsyncIteration
+        except BaseException:
+            self.close()
+            raise
+        frame = self.buffer[self.position]
+        self.position += 1
+        return frame
+
+    async def _fetch_async(self):
+        flight = self.flight
+        self.buffer, self.position = [], 0
+        if self.closed:
+            return
+        async with flight.cond:
+            await flight.cond.wait_for(lambda: self.index < len(flight.frames) or flight.done)
+            self.buffer = flight.frames[self.index:]
+            self.index += len(self.buffer)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._leave()
+
+    async def aclose(self):
+        self.close()
+
+
+class StreamFanout:
+    """同步版本的流式请求合并，上游流由后台线程泵送"""
+
+    def __init__(self, max_followers, timeout):
+        self.max_followers = max_followers
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = _new_stats()
+
+    def subscribe(self, key, open_stream):
+        """返回该请求的SSE帧生成器；open_stream 打开上游并返回帧生成器，只由 leader 调用"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Broadcast(threading.Condition(), threading.Event())
+                self.stats["leaders"] += 1
+            else:
+                with flight.cond:
+                    joined = not flight.closed and flight.subscribers <= self.max_followers
+                    if joined:
+                        flight.subscribers += 1
+                if not joined:
+                    self.stats["overflow"] += 1
+                    flight = None
+                else:
+                    self.stats["followers"] += 1
+
+        if flight is None:
+            return open_stream()
+
+        if leader:
+            try:
+                generator = open_stream()
+                if generator is None:
+                    raise ValueError('请求失败，请检查网络连接或稍后重试')
+            except Exception as e:
+                flight.error = e
+                self._finish(key, flight)
+                raise
+            threading.Thread(target=self._pump, args=(key, flight, generator), daemon=True, name="StreamFanout").start()
+            flight.ready.set()
+        else:
+            try:
+                if not flight.ready.wait(self.timeout):
+                    raise ValueError('等待相同请求的上游响应超时')
+                if flight.error is not None:
+                    raise flight.error
+            except BaseException:
+                # 未能订阅时归还已计入的订阅者名额
+                with flight.cond:
+                    flight.subscribers -= 1
+                raise
+
+        return _Subscriber(flight)
+
+    def _pump(self, key, flight, generator):
+        try:
+            for frame in generator:
+                with flight.cond:
+                    if flight.subscribers == 0:
+                        self.stats["abandoned"] += 1
+                        break
+                    flight.frames.append(frame)
+                    flight.cond.notify_all()
+        except Exception as e:
+            logger.error("合并的流式响应泵送异常: {}", "SingleFlight", e)
+        finally:
+            generator.close()
+            self._finish(key, flight)
+
+    def _finish(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.cond:
+            flight.done = True
+            flight.closed = True
+            flight.cond.notify_all()
+        flight.ready.set()
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, "in_flight": len(self._flights)}
+
+
+class AsyncStreamFanout:
+    """异步版本的流式请求合并，上游流由独立任务泵送"""
+
+    def __init__(self, max_followers, timeout):
+        self.max_followers = max_followers
+        self.timeout = timeout
+        self._flights = {}
+        self.stats = _new_stats()
+
+    async def subscribe(self, key, open_stream):
+        """返回该请求的SSE帧异步生成器；open_stream 为打开上游并返回帧异步生成器的协程函数"""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Broadcast(asyncio.Condition(), asyncio.Event())
+            self.stats["leaders"] += 1
+            try:
+                generator = await open_stream()
+                if generator is None:
+                    raise ValueError('请求失败，请检查网络连接或稍后重试')
+            except BaseException as e:
+                # leader 被取消时，等待中的订阅者收到普通异常而不是取消
+                flight.error = ValueError('相同请求的上游响应已取消') if isinstance(e, asyncio.CancelledError) else e
+                await self._finish(key, flight)
+                raise
+            asyncio.ensure_future(self._pump(key, flight, generator))
+            flight.ready.set()
+        elif not flight.closed and flight.subscribers <= self.max_followers:
+            flight.subscribers += 1
+            self.stats["followers"] += 1
+            try:
+                try:
+                    await asyncio.wait_for(flight.ready.wait(), self.timeout)
+                except asyncio.TimeoutError:
+                    raise ValueError('等待相同请求的上游响应超时') from None
+                if flight.error is not None:
+                    raise flight.error
+            except BaseException:
+                # 超时、上游失败或客户端在等待时断开（取消），都要归还已计入的订阅者名额
+                flight.subscribers -= 1
+                raise
+        else:
+            self.stats["overflow"] += 1
+            return await open_stream()
+
+        return _AsyncSubscriber(flight)
+
+    async def _pump(self, key, flight, generator):
+        try:
+            async for frame in generator:
+                async with flight.cond:
+                    if flight.subscribers == 0:
+                        self.stats["abandoned"] += 1
+                        break
+                    flight.frames.append(frame)
+                    flight.cond.notify_all()
+        except Exception as e:
+            logger.error("合并的流式响应泵送异常: {}", "SingleFlight", e)
+        finally:
+            await generator.aclose()
+            await self._finish(key, flight)
+
+    async def _finish(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        async with flight.cond:
+            flight.done = True
+            flight.closed = True
+            flight.cond.notify_all()
+        flight.ready.set()
+
+    def get_stats(self):
+        return {**self.stats, "in_flight": len(self._flights)}
@@ -0,0 +1,46 @@
+"""
+测试在仓库根目录下运行：python -m pytest -q tests
+各模块在导入时读取环境变量生成配置，这里先关闭令牌持久化并降低日志级别，再把仓库根目录加入导入路径；
+需要上游的测试使用 fake_grok 夹具，在本进程中运行 benchmarks/fake_grok.py 的上游替身，不访问外网。
+"""
+import os
+import sys
+import asyncio
+import threading
+
+import pytest
+
+os.environ.setdefault("TOKEN_DATA_DIR", "")
+os.environ.setdefault("LOG_LEVEL", "ERROR")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+
+@pytest.fixture
+def fake_grok(monkeypatch):
+    """在后台线程的事件循环中运行上游替身（benchmarks/fake_grok.py），BASE_URL 指向它，返回 FakeGrok 实例"""
+    from fake_grok import FakeGrok
+    from config import config_manager
+
+    fake = FakeGrok(tokens=5, interval=0, seed=1)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(fake.handle, "127.0.0.1", 0))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setitem(config_manager.config["API"], "BASE_URL",
+                        f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+    yield fake
+
+    async def shutdown():
+        # 连接池中的长连接仍挂着 handle 协程，取消后再停止事件循环
+        server.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(2)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(2)
+    loop.close()
@@ -0,0 +1,283 @@
+"""准入控制：全局排队与交接、等待队列上限、等待令牌名额时以 Ticket.deadline 为总时限，以及对冲请求的令牌名额"""
+import time
+import asyncio
+import threading
+
+import pytest
+
+from config import config_manager
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+from admission import AdmissionController, AsyncAdmissionController, Overloaded, QUEUE_FULL, TOKEN_BUSY
+
+
+def acquire(controller, ticket, token):
+    """与 RequestHandler._acquire_token 相同的循环：令牌已满时等待释放后重试"""
+    while not ticket.try_hold(token):
+        controller.wait_token(ticket)
+
+
+async def acquire_async(controller, ticket, token):
+    while not ticket.try_hold(token):
+        await controller.wait_token(ticket)
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_global_queue_hands_over_and_rejects_when_full():
+    controller = AdmissionController(max_in_flight=1, queue_size=1, queue_timeout=2)
+    first = controller.admit()
+    results = []
+    waiter = start(lambda: results.append(controller.admit()))
+    while controller.get_stats()["waiting"] == 0:
+        time.sleep(0.001)
+
+    with pytest.raises(Overloaded) as error:
+        controller.admit()
+    assert (error.value.status, error.value.reason) == (503, QUEUE_FULL)
+    assert error.value.retry_after >= 1
+
+    first.release()
+    waiter.join(1)
+    assert len(results) == 1
+    assert controller.get_stats()["in_flight"] == 1
+    results[0].release()
+    assert controller.get_stats()["in_flight"] == 0
+
+
+def test_token_wait_is_bounded_by_deadline_when_losing_the_race():
+    controller = AdmissionController(per_token=1, queue_timeout=0.3)
+    holder = controller.admit()
+    assert holder.try_hold("a")
+    churner = controller.admit()
+    assert churner.try_hold("b")
+    stop = threading.Event()
+
+    def churn():
+        # 其他令牌的名额不断释放，等待者被反复唤醒，但令牌 a 始终是满的
+        tokens = ("b", "c")
+        i = 0
+        while not stop.is_set():
+            i += 1
+            churner.move(tokens[i % 2])
+            time.sleep(0.005)
+
+    thread = start(churn)
+    ticket = controller.admit()
+    started = time.monotonic()
+    try:
+        with pytest.raises(Overloaded) as error:
+            acquire(controller, ticket, "a")
+    finally:
+        stop.set()
+        thread.join()
+    assert time.monotonic() - started < 0.6
+    assert (error.value.status, error.value.reason) == (429, TOKEN_BUSY)
+    assert controller.get_stats()["token_waiting"] == 0
+
+
+def test_deadline_includes_global_queue_wait():
+    controller = AdmissionController(max_in_flight=1, per_token=1, queue_timeout=0.4)
+    first = controller.admit()
+    assert first.try_hold("a")
+    results = []
+    waiter = start(lambda: results.append(controller.admit()))
+    time.sleep(0.3)
+    # 交给等待者的名额来自 first，但 first 仍持有令牌 a 的名额：转到 b 上
+    first.move("b")
+    first.release()
+    waiter.join(1)
+    ticket = results[0]
+    assert ticket.waited >= 0.25
+    assert ticket.deadline - time.monotonic() < 0.15
+
+
+def test_token_waiters_count_against_queue_size():
+    controller = AdmissionController(per_token=1, queue_size=2, queue_timeout=2)
+    holder = controller.admit()
+    assert holder.try_hold("a")
+    errors = []
+
+    def wait_for_a():
+        ticket = controller.admit()
+        try:
+            acquire(controller, ticket, "a")
+            time.sleep(0.01)
+        except Overloaded as e:
+            errors.append(e)
+        finally:
+            ticket.release()
+
+    waiters = [start(wait_for_a) for _ in range(2)]
+    while controller.get_stats()["token_waiting"] < 2:
+        time.sleep(0.001)
+
+    # 队列已被等待令牌的请求占满：新的等待令牌请求和排队请求都立即被拒绝
+    ticket = controller.admit()
+    with pytest.raises(Overloaded) as error:
+        acquire(controller, ticket, "a")
+    assert (error.value.status, error.value.reason) == (503, QUEUE_FULL)
+    ticket.release()
+
+    holder.release()
+    for waiter in waiters:
+        waiter.join(3)
+    assert errors == []
+    assert controller.get_stats()["token_waiting"] == 0
+
+
+def test_async_token_wait_is_bounded_by_deadline():
+    async def main():
+        controller = AsyncAdmissionController(per_token=1, queue_timeout=0.3)
+        holder = await controller.admit()
+        assert holder.try_hold("a")
+        churner = await controller.admit()
+        assert churner.try_hold("b")
+
+        async def churn():
+            i = 0
+            while True:
+                i += 1
+                churner.move(("b", "c")[i % 2])
+                await asyncio.sleep(0.005)
+
+        task = asyncio.ensure_future(churn())
+        ticket = await controller.admit()
+        started = time.monotonic()
+        try:
+            with pytest.raises(Overloaded) as error:
+                await acquire_async(controller, ticket, "a")
+        finally:
+            task.cancel()
+        assert time.monotonic() - started < 0.6
+        assert error.value.reason == TOKEN_BUSY
+        assert controller.token_waiting == 0
+
+    asyncio.run(main())
+
+
+def test_async_token_waiters_count_against_queue_size():
+    async def main():
+        controller = AsyncAdmissionController(per_token=1, queue_size=2, queue_timeout=2)
+        holder = await controller.admit()
+        assert holder.try_hold("a")
+        tickets = [await controller.admit() for _ in range(3)]
+        waiters = [asyncio.ensure_future(acquire_async(controller, ticket, "a")) for ticket in tickets[:2]]
+        await asyncio.sleep(0.01)
+        assert controller.token_waiting == 2
+
+        with pytest.raises(Overloaded) as error:
+            await acquire_async(controller, tickets[2], "a")
+        assert error.value.reason == QUEUE_FULL
+
+        # 一个名额释放后，等待者依次拿到令牌 a
+        holder.release()
+        await asyncio.wait_for(waiters[0], 1)
+        tickets[0].release()
+        await asyncio.wait_for(waiters[1], 1)
+        assert controller.token_waiting == 0
+
+    asyncio.run(main())
+
+
+def test_hedge_ticket_respects_per_token_limit_and_is_adopted():
+    controller = AdmissionController(per_token=1)
+    other = controller.admit()
+    assert other.try_hold("b")
+    ticket = controller.admit()
+    assert ticket.try_hold("a")
+
+    hedge = ticket.hedge()
+    assert not hedge.try_hold("b")
+    assert hedge.try_hold("c")
+    assert controller.token_in_flight == {"a": 1, "b": 1, "c": 1}
+    # 对冲胜出：ticket 改用对冲请求的名额，原令牌的名额释放
+    ticket.adopt(hedge)
+    assert ticket.token == "c"
+    assert controller.token_in_flight == {"b": 1, "c": 1}
+    hedge.release()
+    ticket.release()
+    other.release()
+    assert controller.token_in_flight == {}
+
+
+@pytest.fixture
+def hedging(monkeypatch, fake_grok):
+    monkeypatch.setitem(config_manager.config["HEDGE"], "ENABLED", True)
+    monkeypatch.setitem(config_manager.config["HEDGE"], "DELAY_MS", 20)
+    monkeypatch.setitem(config_manager.config["ADMISSION"], "PER_TOKEN", 1)
+    fake_grok.first_byte_delay = 0.2
+    return fake_grok
+
+
+def make_handler(tokens):
+    manager = AuthTokenManager()
+    manager.add_tokens_batch(tokens)
+    handler = RequestHandler(manager)
+    # 记录每次上游请求所用的令牌，以及发出时各令牌的名额占用
+    sent = []
+    request_upstream = handler._request_upstream
+
+    def record(token, proxy, request_body):
+        sent.append((token, dict(handler.admission.token_in_flight)))
+        return request_upstream(token, proxy, request_body)
+
+    handler._request_upstream = record
+    return handler, manager.get_all_tokens(), sent
+
+
+REQUEST = {"model": "grok-3", "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_hedge_skips_tokens_at_per_token_limit(hedging):
+    handler, (t0, t1, t2), sent = make_handler(["t0", "t1", "t2"])
+    # 另一个请求正在使用 t1
+    other = handler.admission.admit()
+    assert other.try_hold(t1)
+
+    assert handler.make_grok_request(REQUEST, "grok-3")["choices"][0]["message"]["content"]
+    assert [token for token, _ in sent] == [t0, t2]
+    assert all(max(in_flight.values()) <= 1 for _, in_flight in sent)
+    assert handler.admission.token_in_flight == {t1: 1}
+    other.release()
+    assert handler.admission.token_in_flight == {}
+
+
+def test_hedge_is_skipped_when_other_tokens_are_full(hedging):
+    handler, (t0, t1), sent = make_handler(["t0", "t1"])
+    other = handler.admission.admit()
+    assert other.try_hold(t1)
+
+    assert handler.make_grok_request(REQUEST, "grok-3")["choices"][0]["message"]["content"]
+    assert [token for token, _ in sent] == [t0]
+    assert handler.hedge_policy.get_stats()["skipped"] == 1
+    other.release()
+    assert handler.admission.token_in_flight == {}
+
+
+def test_async_hedge_skips_tokens_at_per_token_limit(hedging):
+    handler, (t0, t1, t2), _ = make_handler(["t0", "t1", "t2"])
+    sent = []
+    request_upstream = handler._request_upstream_async
+
+    async def record(token, proxy, request_body, prefetch=False):
+        sent.append(token)
+        return await request_upstream(token, proxy, request_body, prefetch)
+
+    handler._request_upstream_async = record
+
+    async def main():
+        other = await handler.async_admission.admit()
+        assert other.try_hold(t1)
+        response = await handler.make_grok_request_async(REQUEST, "grok-3")
+        assert response["choices"][0]["message"]["content"]
+        assert handler.async_admission.token_in_flight == {t1: 1}
+        other.release()
+
+    asyncio.run(main())
+    assert sent == [t0, t2]
+    assert handler.async_admission.token_in_flight == {}
@@ -0,0 +1,71 @@
+"""多API Key与配额：认证、模型白名单、每分钟请求数、并发流数，以及被拒绝的请求不额外消耗配额"""
+import json
+
+import pytest
+
+from api_keys import ApiKey, ApiKeyRegistry, QuotaExceeded, parse_api_keys, RATE_LIMITED, STREAMS, MODEL
+
+
+def test_registry_authenticates_and_keeps_default_key():
+    registry = ApiKeyRegistry([ApiKey("sk-a", "a")], "sk-default")
+    assert registry.authenticate("Bearer sk-a")[0].name == "a"
+    assert registry.authenticate("Bearer sk-default")[0].name == "default"
+    assert registry.authenticate("Bearer sk-x") == (None, "Unauthorized")
+    assert registry.authenticate(None)[0] is None
+
+
+def test_model_whitelist():
+    api_key = ApiKey("sk-a", models=["grok-3"])
+    api_key.acquire("grok-3", False)
+    with pytest.raises(QuotaExceeded) as error:
+        api_key.acquire("grok-4", False)
+    assert (error.value.status, error.value.reason) == (403, MODEL)
+
+
+def test_rpm_bucket_rejects_with_retry_after():
+    api_key = ApiKey("sk-a", rpm=60, burst=2)
+    api_key.acquire("grok-3", False)
+    api_key.acquire("grok-3", False)
+    with pytest.raises(QuotaExceeded) as error:
+        api_key.acquire("grok-3", False)
+    assert (error.value.status, error.value.reason) == (429, RATE_LIMITED)
+    assert error.value.retry_after >= 1
+
+
+def test_stream_limit_and_release():
+    api_key = ApiKey("sk-a", streams=1)
+    api_key.acquire("grok-3", True)
+    with pytest.raises(QuotaExceeded) as error:
+        api_key.acquire("grok-3", True)
+    assert (error.value.status, error.value.reason) == (429, STREAMS)
+    # 非流式请求不受流数限制
+    api_key.acquire("grok-3", False)
+    api_key.release_stream()
+    api_key.acquire("grok-3", True)
+    assert api_key.get_stats()["active_streams"] == 1
+
+
+def test_stream_rejection_does_not_consume_rpm():
+    api_key = ApiKey("sk-a", rpm=60, burst=2, streams=1)
+    api_key.acquire("grok-3", True)
+    # 客户端在流数上限的429后不断重试，不应因此耗尽每分钟请求数
+    for _ in range(5):
+        with pytest.raises(QuotaExceeded) as error:
+            api_key.acquire("grok-3", True)
+        assert error.value.reason == STREAMS
+    api_key.release_stream()
+    api_key.acquire("grok-3", True)
+    assert api_key.get_stats()["rejected_rate_limited"] == 0
+
+
+def test_parse_api_keys(tmp_path):
+    entries = [{"key": "sk-a", "name": "a", "rpm": 60, "streams": 2, "models": ["grok-3"]}]
+    keys = parse_api_keys(json.dumps(entries))
+    assert (keys[0].name, keys[0].rpm, keys[0].streams) == ("a", 60, 2)
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps(entries), encoding="utf-8")
+    assert parse_api_keys(str(path))[0].key == "sk-a"
+    with pytest.raises(ValueError):
+        parse_api_keys('[{"name": "missing key"}]')
+    with pytest.raises(ValueError):
+        ApiKeyRegistry([ApiKey("sk-a"), ApiKey("sk-a")])
@@ -0,0 +1,195 @@
+"""
+重试策略：失败分类、重试预算、熔断器的打开/半开/探测归还，
+以及 RequestHandler 对注入故障的上游替身（fake_grok）实际发出的请求次数
+"""
+import time
+import asyncio
+
+import pytest
+
+from config import config_manager
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+from admission import AdmissionController
+from retry import (
+    RetryPolicy, RetryBudget, BreakerRegistry, classify_status, ROTATE, BACKOFF, FATAL, OPEN, HALF_OPEN, CLOSED
+)
+
+MODEL = "grok-3"
+REQUEST = {"model": MODEL, "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_classify_status():
+    assert classify_status(429) == ROTATE
+    assert classify_status(401) == ROTATE
+    assert classify_status(503) == BACKOFF
+    assert classify_status(408) == BACKOFF
+    assert classify_status(403) == FATAL
+    assert classify_status(400) == FATAL
+
+
+def test_policy_gives_up_after_max_attempts_and_on_fatal():
+    policy = RetryPolicy(max_attempts=2, base_delay_ms=100, max_delay_ms=1000)
+    delay, reason = policy.next_delay(BACKOFF, 1)
+    assert reason is None and 0 <= delay <= 0.1
+    assert policy.next_delay(ROTATE, 1) == (0.0, None)
+    assert policy.next_delay(BACKOFF, 2) == (None, "attempts")
+    assert policy.next_delay(FATAL, 1) == (None, FATAL)
+
+
+def test_budget_limits_retries_to_ratio_of_requests():
+    budget = RetryBudget(ratio=0.2, min_per_second=0)
+    for _ in range(50):
+        budget.record_request()
+    granted = sum(budget.try_acquire() for _ in range(50))
+    assert granted == 10
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breakers = BreakerRegistry(failure_threshold=2, open_seconds=0.05)
+    breakers.record_failure("t")
+    assert breakers.allow("t")
+    breakers.record_failure("t")
+    assert breakers.state("t") == OPEN
+    assert not breakers.allow("t")
+    time.sleep(0.06)
+    # 冷却结束后只放行一个探测
+    assert breakers.allow("t")
+    assert breakers.state("t") == HALF_OPEN
+    assert not breakers.allow("t")
+    breakers.record_success("t")
+    assert breakers.state("t") == CLOSED
+
+
+def test_unsent_probe_is_released():
+    breakers = BreakerRegistry(failure_threshold=1, open_seconds=0.05)
+    breakers.record_failure("t")
+    time.sleep(0.06)
+    assert breakers.allow("t")
+    breakers.release_probe("t")
+    assert breakers.allow("t")
+    assert breakers.get_stats()["probes"] == 1
+
+
+def test_probe_released_when_token_slot_is_full():
+    """半开令牌的单令牌名额已满时不应占用探测机会，否则熔断器要再等一个冷却周期"""
+    handler = RequestHandler(AuthTokenManager())
+    handler.token_breakers = BreakerRegistry(failure_threshold=1, open_seconds=0.05)
+    admission = AdmissionController(per_token=1)
+    holder = admission.admit()
+    assert holder.try_hold("t")
+    handler.token_breakers.record_failure("t")
+    time.sleep(0.06)
+
+    ticket = admission.admit()
+    assert not handler._token_usable("t", True, ticket)
+    holder.release()
+    assert handler._token_usable("t", True, ticket)
+    assert handler.token_breakers.state("t") == HALF_OPEN
+
+
+@pytest.fixture
+def retry_config(monkeypatch):
+    """缩短退避和熔断冷却，测试中不必真的等待"""
+    retry = config_manager.config["RETRY"]
+    for key, value in (("MAX_ATTEMPTS", 3), ("BASE_DELAY_MS", 1), ("MAX_DELAY_MS", 5),
+                       ("BUDGET_MIN_PER_SECOND", 100), ("BREAKER_OPEN_SECONDS", 1)):
+        monkeypatch.setitem(retry, key, value)
+
+
+def make_handler(tokens=("t0", "t1", "t2", "t3")):
+    manager = AuthTokenManager()
+    manager.add_tokens_batch(list(tokens))
+    return RequestHandler(manager)
+
+
+def test_success_on_first_attempt(fake_grok, retry_config):
+    response = make_handler().make_grok_request(REQUEST, MODEL)
+    assert response["choices"][0]["message"]["content"]
+    assert fake_grok.requests == 1
+
+
+def test_backoff_retries_up_to_max_attempts(fake_grok, retry_config):
+    fake_grok.fail_ratio, fake_grok.fault = 1.0, "503"
+    handler = make_handler()
+    with pytest.raises(ValueError):
+        handler.make_grok_request(REQUEST, MODEL)
+    assert fake_grok.requests == 3
+    assert handler.retry_policy.get_stats()["gave_up"]["attempts"] == 1
+
+
+def test_network_reset_is_retried(fake_grok, retry_config):
+    fake_grok.fail_ratio, fake_grok.fault = 1.0, "reset"
+    with pytest.raises(ValueError):
+        make_handler().make_grok_request(REQUEST, MODEL)
+    assert fake_grok.requests == 3
+
+
+def test_fatal_status_is_not_retried(fake_grok, retry_config):
+    fake_grok.fail_ratio, fake_grok.fault = 1.0, "403"
+    with pytest.raises(ValueError):
+        make_handler().make_grok_request(REQUEST, MODEL)
+    assert fake_grok.requests == 1
+
+
+def test_bad_token_rotates_to_another_token(fake_grok, retry_config):
+    fake_grok.bad_sso = {"t0"}
+    handler = make_handler()
+    response = handler.make_grok_request(REQUEST, MODEL)
+    assert response["choices"][0]["message"]["content"]
+    assert fake_grok.bad_token_requests == 1
+    assert fake_grok.requests == 2
+
+
+def test_budget_caps_amplification_during_outage(fake_grok, retry_config, monkeypatch):
+    monkeypatch.setitem(config_manager.config["RETRY"], "BUDGET_MIN_PER_SECOND", 0)
+    monkeypatch.setitem(config_manager.config["RETRY"], "BREAKER", False)
+    fake_grok.fail_ratio, fake_grok.fault = 1.0, "503"
+    handler = make_handler()
+    for _ in range(20):
+        with pytest.raises(ValueError):
+            handler.make_grok_request(REQUEST, MODEL)
+    # 不限预算时为 60 次；预算为请求数的 20%
+    assert fake_grok.requests <= 20 * 1.2 + 1
+
+
+def test_line_breaker_fails_fast_and_recovers(fake_grok, retry_config):
+    fake_grok.fail_ratio, fake_grok.fault = 1.0, "503"
+    handler = make_handler()
+    for _ in range(5):
+        with pytest.raises(ValueError):
+            handler.make_grok_request(REQUEST, MODEL)
+    assert handler.proxy_breakers.count_states()[OPEN] == 1
+    sent = fake_grok.requests
+    with pytest.raises(ValueError):
+        handler.make_grok_request(REQUEST, MODEL)
+    assert fake_grok.requests == sent
+
+    # 上游恢复，冷却后半开探测成功，熔断器关闭
+    fake_grok.fail_ratio = 0.0
+    time.sleep(1.05)
+    assert handler.make_grok_request(REQUEST, MODEL)["choices"][0]["message"]["content"]
+    assert handler.proxy_breakers.count_states() == {OPEN: 0, HALF_OPEN: 0}
+
+
+def test_async_backoff_retries_up_to_max_attempts(fake_grok, retry_config):
+    fake_grok.fail_ratio, fake_grok.fault = 1.0, "503"
+    handler = make_handler()
+
+    async def main():
+        with pytest.raises(ValueError):
+            await handler.make_grok_request_async(REQUEST, MODEL)
+
+    asyncio.run(main())
+    assert fake_grok.requests == 3
+
+
+def test_async_bad_token_rotates(fake_grok, retry_config):
+    fake_grok.bad_sso = {"t0"}
+    handler = make_handler()
+
+    async def main():
+        return await handler.make_grok_request_async(REQUEST, MODEL)
+
+    assert asyncio.run(main())["choices"][0]["message"]["content"]
+    assert fake_grok.requests == 2
@@ -0,0 +1,161 @@
+"""同步会话池：传输复用工作线程和连接，线程全部占用时立即拒绝，等待响应头有时限，工作线程无法启动时会话被丢弃"""
+import json
+import time
+import socket
+import threading
+
+import pytest
+from curl_cffi.requests.exceptions import Timeout
+
+import session_pool
+from session_pool import SessionPool
+from admission import Overloaded, WORKERS_BUSY
+from config import config_manager
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+
+BODY = json.dumps({"message": "hi"})
+
+
+@pytest.fixture
+def stalled_server():
+    """接受连接但从不响应的上游，返回 (地址, 已接受的连接列表)"""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(listener.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield f"http://127.0.0.1:{listener.getsockname()[1]}", connections
+    listener.close()
+    disconnect(connections)
+
+
+def disconnect(connections):
+    for connection in connections:
+        connection.close()
+
+
+def request(pool, url, timeout=2):
+    return pool.request("t0", None, url=url, data=BODY, headers={"Cookie": "sso=t0"}, timeout=timeout)
+
+
+def read(response):
+    lines = list(response.iter_lines())
+    response.close()
+    return lines
+
+
+def wait_until(predicate, timeout=3):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_sequential_requests_reuse_worker_and_connection(fake_grok):
+    url = config_manager.get("API.BASE_URL") + "/rest/app-chat/conversations/new"
+    pool = SessionPool()
+    for _ in range(5):
+        response = request(pool, url)
+        assert response.status_code == 200
+        assert read(response)
+        wait_until(lambda: pool.get_stats()["idle_sessions"] == 1)
+    stats = pool.get_stats()
+    assert (stats["sessions_created"], stats["connections_new"], stats["connections_reused"]) == (1, 1, 4)
+    assert len(pool._workers._threads) == 1
+
+
+def test_header_wait_is_bounded(stalled_server, monkeypatch):
+    url, connections = stalled_server
+    # 让等待时限短于 curl 自身的低速超时（1秒），模拟 curl 未能按时返回
+    monkeypatch.setattr(session_pool, "HEADER_WAIT_MARGIN", -1.7)
+    pool = SessionPool()
+    started = time.monotonic()
+    with pytest.raises(Timeout):
+        request(pool, url, timeout=1)
+    assert time.monotonic() - started < 0.8
+    # curl 自身的超时并不精确，这里由上游断开连接；被放弃的传输结束后会话照常归还
+    disconnect(connections)
+    wait_until(lambda: pool.get_stats()["idle_sessions"] == 1)
+
+
+def test_request_waiting_for_a_worker_times_out_without_being_sent(stalled_server, monkeypatch):
+    url, connections = stalled_server
+    monkeypatch.setattr(session_pool, "HEADER_WAIT_MARGIN", -1.7)
+    pool = SessionPool()
+    pool._workers = session_pool.ThreadPoolExecutor(max_workers=1)
+    blocker = threading.Thread(target=lambda: pytest.raises(Timeout, request, pool, url, 1), daemon=True)
+    blocker.start()
+    wait_until(lambda: len(connections) == 1)
+
+    # 唯一的工作线程被占用，第二个请求在排队中超时；之后轮到它时不再发出
+    with pytest.raises(Timeout):
+        pool.request("t1", None, url=url, data=BODY, timeout=1)
+    blocker.join(2)
+    disconnect(connections)
+    wait_until(lambda: pool.get_stats()["idle_sessions"] >= 2)
+    assert len(connections) == 1
+
+
+def test_session_discarded_when_worker_cannot_start(monkeypatch):
+    pool = SessionPool()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("can't start new thread")
+
+    monkeypatch.setattr(pool._workers, "submit", fail)
+    with pytest.raises(RuntimeError):
+        request(pool, "http://127.0.0.1:9")
+    stats = pool.get_stats()
+    assert (stats["sessions_created"], stats["sessions_evicted"], stats["idle_sessions"]) == (1, 1, 0)
+
+
+def test_request_rejected_immediately_when_all_workers_busy(stalled_server, monkeypatch):
+    url, connections = stalled_server
+    monkeypatch.setitem(config_manager.config["POOL"], "MAX_WORKERS", 1)
+    pool = SessionPool()
+
+    def block():
+        # 占住唯一的工作线程，直到上游断开连接
+        with pytest.raises(Exception):
+            request(pool, url)
+
+    blocker = threading.Thread(target=block, daemon=True)
+    blocker.start()
+    wait_until(lambda: len(connections) == 1)
+
+    started = time.monotonic()
+    with pytest.raises(Overloaded) as error:
+        request(pool, url)
+    assert time.monotonic() - started < 0.1
+    assert (error.value.status, error.value.reason) == (503, WORKERS_BUSY)
+    stats = pool.get_stats()
+    assert (stats["rejected_workers_busy"], stats["busy_workers"], stats["sessions_created"]) == (1, 1, 1)
+
+    disconnect(connections)
+    blocker.join(3)
+    wait_until(lambda: pool.get_stats()["busy_workers"] == 0)
+
+
+def test_handler_returns_overloaded_instead_of_retrying(fake_grok, monkeypatch):
+    monkeypatch.setitem(config_manager.config["POOL"], "MAX_WORKERS", 1)
+    fake_grok.interval = 0.2
+    manager = AuthTokenManager()
+    manager.add_tokens_batch(["t0", "t1"])
+    handler = RequestHandler(manager)
+    data = {"model": "grok-3", "messages": [{"role": "user", "content": "hi"}]}
+
+    frames = handler.make_grok_request(data, "grok-3", stream=True, raw_stream=True)
+    with pytest.raises(Overloaded) as error:
+        handler.make_grok_request(data, "grok-3")
+    assert error.value.reason == WORKERS_BUSY
+    assert fake_grok.requests == 1
+    frames.close()
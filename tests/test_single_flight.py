@@ -0,0 +1,175 @@
+"""相同请求合并：结果共享，以及流式广播的订阅者计数（提前关闭、被回收、等待超时或被取消都要归还）"""
+import gc
+import time
+import asyncio
+import threading
+
+import pytest
+
+from single_flight import SingleFlight, StreamFanout, AsyncStreamFanout
+
+
+class Upstream:
+    """可控的上游帧生成器：每帧间隔 interval 秒，记录是否被关闭"""
+
+    def __init__(self, count=50, interval=0.01):
+        self.count = count
+        self.interval = interval
+        self.closed = threading.Event()
+
+    def frames(self):
+        try:
+            for i in range(self.count):
+                time.sleep(self.interval)
+                yield f"data: {i}\n\n"
+        finally:
+            self.closed.set()
+
+    async def aframes(self):
+        try:
+            for i in range(self.count):
+                await asyncio.sleep(self.interval)
+                yield f"data: {i}\n\n"
+        finally:
+            self.closed.set()
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.005)
+
+
+def test_single_flight_shares_result():
+    flight = SingleFlight(max_followers=8, timeout=2)
+    calls = []
+    release = threading.Event()
+
+    def work():
+        calls.append(1)
+        release.wait(1)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", work))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ["result"] * 4
+    assert len(calls) == 1
+
+
+def test_stream_fanout_broadcasts_to_all_subscribers():
+    fanout = StreamFanout(max_followers=8, timeout=2)
+    upstream = Upstream(count=5, interval=0.005)
+    leader = fanout.subscribe("k", upstream.frames)
+    follower = fanout.subscribe("k", upstream.frames)
+    assert list(leader) == list(follower) == [f"data: {i}\n\n" for i in range(5)]
+    assert fanout.get_stats()["followers"] == 1
+    wait_until(lambda: fanout.get_stats()["in_flight"] == 0)
+
+
+def test_subscribers_closed_before_iterating_stop_the_pump():
+    fanout = StreamFanout(max_followers=8, timeout=2)
+    upstream = Upstream()
+    leader = fanout.subscribe("k", upstream.frames)
+    follower = fanout.subscribe("k", upstream.frames)
+    flight = leader.flight
+    assert flight.subscribers == 2
+
+    # 客户端在首帧前断开：从未迭代的订阅者被关闭
+    follower.close()
+    follower.close()
+    assert flight.subscribers == 1
+    # 另一个订阅者直接被丢弃、回收
+    del leader
+    gc.collect()
+    assert flight.subscribers == 0
+    assert upstream.closed.wait(1)
+    wait_until(lambda: fanout.get_stats()["in_flight"] == 0)
+    assert fanout.get_stats()["abandoned"] == 1
+
+
+def test_follower_timeout_returns_its_slot():
+    fanout = StreamFanout(max_followers=8, timeout=0.1)
+    opened = threading.Event()
+    release = threading.Event()
+    upstream = Upstream(count=1, interval=0)
+
+    def slow_open():
+        opened.set()
+        release.wait(2)
+        return upstream.frames()
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(fanout.subscribe("k", slow_open)))
+    leader.start()
+    opened.wait(1)
+    with pytest.raises(ValueError):
+        fanout.subscribe("k", slow_open)
+    release.set()
+    leader.join()
+    assert results[0].flight.subscribers == 1
+    assert list(results[0]) == ["data: 0\n\n"]
+
+
+def test_async_subscribers_closed_before_iterating_stop_the_pump():
+    async def main():
+        fanout = AsyncStreamFanout(max_followers=8, timeout=2)
+        upstream = Upstream()
+
+        async def open_stream():
+            return upstream.aframes()
+
+        leader = await fanout.subscribe("k", open_stream)
+        follower = await fanout.subscribe("k", open_stream)
+        flight = leader.flight
+        assert flight.subscribers == 2
+        await follower.aclose()
+        assert flight.subscribers == 1
+        del leader
+        gc.collect()
+        assert flight.subscribers == 0
+        for _ in range(100):
+            if upstream.closed.is_set() and fanout.get_stats()["in_flight"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert upstream.closed.is_set()
+        assert fanout.get_stats()["abandoned"] == 1
+
+    asyncio.run(main())
+
+
+def test_async_cancelled_follower_returns_its_slot():
+    async def main():
+        fanout = AsyncStreamFanout(max_followers=8, timeout=2)
+        release = asyncio.Event()
+        upstream = Upstream(count=2, interval=0)
+
+        async def slow_open():
+            await release.wait()
+            return upstream.aframes()
+
+        leader = asyncio.ensure_future(fanout.subscribe("k", slow_open))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(fanout.subscribe("k", slow_open))
+        await asyncio.sleep(0.01)
+        flight = fanout._flights["k"]
+        assert flight.subscribers == 2
+
+        # 客户端在等待上游时断开
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        assert flight.subscribers == 1
+
+        release.set()
+        frames = [frame async for frame in await leader]
+        assert frames == ["data: 0\n\n", "data: 1\n\n"]
+        assert flight.subscribers == 0
+
+    asyncio.run(main())
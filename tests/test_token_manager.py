@@ -0,0 +1,110 @@
+"""令牌调度：轮询、并发取用、429冷却、连续失败退避以及冷却提前解除后重新进入轮询"""
+import time
+import threading
+from collections import Counter
+
+from config import config_manager
+from token_manager import AuthTokenManager
+
+MODEL = "grok-3"
+
+
+def make_manager(count=3):
+    manager = AuthTokenManager()
+    manager.add_tokens_batch([f"sso-{i}" for i in range(count)])
+    return manager
+
+
+def take(manager, n, model=MODEL):
+    return [manager.get_next_token_for_model(model) for _ in range(n)]
+
+
+def schedule_size(manager, model=MODEL):
+    schedule = manager.schedules[model]
+    return len(schedule.ready), len(schedule.cooling)
+
+
+def test_round_robin():
+    manager = make_manager(3)
+    tokens = take(manager, 6)
+    assert tokens[:3] == tokens[3:]
+    assert len(set(tokens)) == 3
+
+
+def test_concurrent_rotation_is_even():
+    manager = make_manager(4)
+    counts = Counter()
+    lock = threading.Lock()
+
+    def worker():
+        local = Counter(take(manager, 1000))
+        with lock:
+            counts.update(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(counts.values()) == [2000] * 4
+
+
+def test_rate_limited_token_skipped_until_cooldown_expires():
+    manager = make_manager(3)
+    limited = take(manager, 1)[0]
+    manager.mark_rate_limited(limited, MODEL, retry_after=0.2)
+    assert limited not in take(manager, 6)
+    # 其他模型不受影响
+    assert limited in take(manager, 3, "grok-4")
+    time.sleep(0.25)
+    assert limited in take(manager, 3)
+    assert schedule_size(manager) == (3, 0)
+
+
+def test_all_tokens_cooling_returns_none():
+    manager = make_manager(2)
+    for token in take(manager, 2):
+        manager.mark_rate_limited(token, MODEL, retry_after=60)
+    assert manager.get_next_token_for_model(MODEL) is None
+
+
+def test_failures_back_off_after_threshold():
+    manager = make_manager(2)
+    token = take(manager, 1)[0]
+    threshold = config_manager.get("TOKEN.FAILURE_THRESHOLD", 3)
+    for _ in range(threshold - 1):
+        manager.mark_failure(token, MODEL)
+    assert token in take(manager, 2)
+    manager.mark_failure(token, MODEL)
+    assert token not in take(manager, 4)
+
+
+def test_success_clears_cooldown_and_revives_token():
+    manager = make_manager(3)
+    token = take(manager, 1)[0]
+    manager.mark_rate_limited(token, MODEL, retry_after=3600)
+    assert token not in take(manager, 4)
+    assert schedule_size(manager) == (2, 1)
+
+    # 例如重新检测通过：冷却解除后立即回到轮询中，而不是等到原来的截止时间
+    manager.mark_success(token, MODEL)
+    assert schedule_size(manager) == (3, 0)
+    counts = Counter(take(manager, 9))
+    assert counts[token] == 3
+    assert sorted(counts.values()) == [3, 3, 3]
+
+
+def test_success_without_cooldown_does_not_duplicate():
+    manager = make_manager(3)
+    token = take(manager, 1)[0]
+    manager.mark_failure(token, MODEL)
+    manager.mark_success(token, MODEL)
+    assert schedule_size(manager) == (3, 0)
+    assert len(set(take(manager, 3))) == 3
+
+
+def test_deleted_token_not_scheduled():
+    manager = make_manager(3)
+    token = take(manager, 1)[0]
+    assert manager.delete_token(token)
+    assert token not in take(manager, 6)
@@ -0,0 +1,76 @@
+"""批量令牌检测接口 /manager/api/validate：参数在返回NDJSON之前检查，检测结果分类、删除无效令牌和单个令牌的时限"""
+import json
+import time
+
+import pytest
+
+import app as server
+
+HEADERS = {"X-Admin-Key": "admin123"}
+
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+
+def validate(client, **body):
+    response = client.post("/manager/api/validate", json=body, headers=HEADERS)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines[-1]["done"]
+    return {result["sso"]: result for result in lines[:-1]}, lines[-1]
+
+
+@pytest.mark.parametrize("body", [
+    {"tokens": "abc"},
+    {"tokens": ["a", 1]},
+    {"tokens": ["a"], "concurrency": "many"},
+    {"tokens": ["a"], "concurrency": 0},
+    {"tokens": ["a"], "timeout": "soon"},
+    {"tokens": ["a"], "timeout": -1},
+    {"tokens": ["a"], "timeout": float("inf")},
+])
+def test_invalid_parameters_are_rejected_before_streaming(client, fake_grok, body):
+    response = client.post("/manager/api/validate", data=json.dumps(body), content_type="application/json",
+                           headers=HEADERS)
+    assert response.status_code == 400
+    assert fake_grok.requests == 0
+
+
+def test_results_are_classified(client, fake_grok):
+    fake_grok.bad_sso = {"v-bad"}
+    fake_grok.limited_sso = {"v-limited"}
+    results, summary = validate(client, tokens=["v-ok", "v-bad", "v-limited", "v-ok"], concurrency="2", timeout="5")
+    assert {sso: result["status"] for sso, result in results.items()} == {
+        "v-ok": "valid", "v-bad": "invalid", "v-limited": "rate_limited"
+    }
+    assert (results["v-bad"]["code"], results["v-limited"]["code"]) == (401, 429)
+    assert (summary["total"], summary["valid"], summary["invalid"], summary["rate_limited"]) == (3, 1, 1, 1)
+    assert fake_grok.requests == 3
+
+
+def test_drop_invalid_removes_only_invalid_tokens(client, fake_grok):
+    tokens = ["d-ok", "d-bad", "d-limited"]
+    server.token_manager.add_tokens_batch(tokens)
+    fake_grok.bad_sso = {"d-bad"}
+    fake_grok.limited_sso = {"d-limited"}
+    try:
+        results, summary = validate(client, tokens=tokens, drop_invalid=True)
+        assert results["d-bad"]["dropped"]
+        assert summary["dropped"] == 1
+        remaining = {cookie.rpartition("sso=")[2] for cookie in server.token_manager.get_all_tokens()}
+        assert {"d-ok", "d-limited"} <= remaining
+        assert "d-bad" not in remaining
+    finally:
+        for token in tokens:
+            server.token_manager.delete_token(f"sso-rw={token};sso={token}")
+
+
+def test_timeout_bounds_each_probe(client, fake_grok):
+    fake_grok.first_byte_delay = 1.0
+    started = time.monotonic()
+    results, summary = validate(client, tokens=["t-slow"], timeout=0.3)
+    assert results["t-slow"]["status"] == "error"
+    assert summary["error"] == 1
+    assert time.monotonic() - started < 0.9
@@ -0,0 +1,57 @@
+"""上游NDJSON行解码：事件类型、空白与无法解析的行，以及非流式响应按 is_reasoning_model 包装思考内容"""
+import json
+
+from config import config_manager
+from token_manager import AuthTokenManager
+from request_handler import RequestHandler
+from upstream_decoder import decode_line, TokenEvent, WebResultsEvent, ModelResponseEvent, ErrorEvent
+
+
+def line(response):
+    return json.dumps({"result": {"response": response}}).encode()
+
+
+def test_decodes_event_types():
+    event = decode_line(line({"token": "hi", "isThinking": True, "messageTag": "final"}))
+    assert type(event) is TokenEvent
+    assert (event.text, event.thinking, event.tag) == ("hi", True, "final")
+
+    event = decode_line(line({"token": "", "webSearchResults": {"results": [{"url": "u"}]}}))
+    assert type(event) is WebResultsEvent and event.results == [{"url": "u"}]
+
+    event = decode_line(line({"modelResponse": {"message": "done", "thinkingTrace": "trace"}}))
+    assert type(event) is ModelResponseEvent
+    assert (event.message, event.thinking_trace) == ("done", "trace")
+
+    assert type(decode_line(b'{"error": {"code": 7}}')) is ErrorEvent
+
+
+def test_surrounding_whitespace_is_accepted():
+    assert decode_line(b"  " + line({"token": "a"}) + b"\r\n").text == "a"
+    assert decode_line(line({"token": "a"}) + b" \n").text == "a"
+
+
+def test_trailing_garbage_is_rejected():
+    valid = line({"token": "a"})
+    assert decode_line(valid + b"x") is None
+    assert decode_line(valid + valid) is None
+    assert decode_line(valid + b" }") is None
+
+
+def test_unparseable_lines_are_skipped():
+    for data in (b"", b"   ", b"{", b"not json", b"[1, 2]", b'{"result": 1}', b"\xff{}", line({})):
+        assert decode_line(data) is None
+
+
+def test_non_stream_response_uses_is_reasoning_model(monkeypatch):
+    handler = RequestHandler(AuthTokenManager())
+    state = {"content_parts": ["answer"], "thinking_parts": ["trace"], "model_response": None}
+    assert handler._build_non_stream_response("grok-3", state)["choices"][0]["message"]["content"] == "answer"
+
+    monkeypatch.setattr(config_manager, "is_reasoning_model", lambda model: model == "grok-3")
+    content = handler._build_non_stream_response("grok-3", state)["choices"][0]["message"]["content"]
+    assert content == "<think>trace</think>answer"
+
+    state["model_response"] = ModelResponseEvent("done", "final trace")
+    content = handler._build_non_stream_response("grok-3", state)["choices"][0]["message"]["content"]
+    assert content == "<think>final trace</think>done"
@@ -1,164 +1,692 @@
+import gc
 import os
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
 from logger import logger
+from config import config_manager
+from token_persistence import TokenJournal
+from token_shared import SharedTokenStore
+
+
+def extract_sso(token_str):
+    """从cookie字符串中提取sso值；不含sso字段时原样返回（即本身就是sso值）"""
+    if "sso=" in token_str:
+        return token_str.split("sso=")[1].split(";")[0]
+    return token_str
+
+
+class TokenHealth:
+    """单个令牌在单个模型上的健康状态"""
+    __slots__ = ("cooldown_until", "failures")
+
+    def __init__(self):
+        self.cooldown_until = 0.0
+        self.failures = 0
+
+
+class TokenRecord:
+    """
+    单个令牌的紧凑记录。标准格式 "sso-rw=X;sso=X" 的令牌只保存sso值，cookie在使用时再拼接；
+    其他格式才保存完整cookie。健康状态按需创建。
+    """
+    __slots__ = ("sso", "cookie", "health")
+
+    def __init__(self, sso, cookie=None):
+        self.sso = sso
+        self.cookie = cookie
+        self.health = None  # {model_id: TokenHealth}
+
+    def get_cookie(self):
+        return self.cookie or f"sso-rw={self.sso};sso={self.sso}"
+
+
+class TokenStore:
+    """按sso值索引的令牌存储；dict 保持插入顺序，增删查均为 O(1)"""
+
+    def __init__(self):
+        self.records = {}  # sso -> TokenRecord
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def get(self, sso):
+        return self.records.get(sso)
+
+    def add(self, sso, cookie=None):
+        """添加令牌，重复时返回None"""
+        if sso in self.records:
+            return None
+        record = self.records[sso] = TokenRecord(sso, cookie)
+        return record
+
+    def remove(self, sso):
+        return self.records.pop(sso, None)
+
+    def clear(self):
+        self.records = {}
+
+
+class ModelSchedule:
+    """
+    单个模型的调度队列：就绪令牌按轮询顺序放在双端队列中，冷却中的令牌放在按到期时间排序的小顶堆中。
+    令牌的删除和冷却都是惰性处理的，出队时才检查，因此每次取令牌的代价为 O(log n)。
+    每个模型持有独立的锁，不同模型的请求互不阻塞。
+    """
+    __slots__ = ("ready", "cooling", "lock")
+
+    def __init__(self, records):
+        self.lock = threading.Lock()
+        self.ready = deque(records)
+        self.cooling = []  # [(cooldown_until, seq, record), ...]
+
+
+class TokenLease:
+    """共享模式下本进程从共享游标租到的一段令牌（sso），按顺序取用，用完再租下一段"""
+    __slots__ = ("queue", "lock")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = deque()
 
 
 class AuthTokenManager:
     def __init__(self):
-        self.tokens = []
-        self.current_index = 0
-        self.last_round_index = -1
-        
+        self.store = TokenStore()
+        self.schedules = {}  # model_id -> ModelSchedule
+        # 管理接口读取的状态视图，首次读取时生成，之后只在令牌或健康状态变化时更新
+        self._status_cache = None
+        self._heap_seq = itertools.count()
+        # 持久化日志，未配置数据目录时为None
+        self.journal = None
+        # 多进程共享存储（见 token_shared.py），启用后令牌的修改都经由它提交，按其操作日志重放到内存
+        self.shared = None
+        self._shared_op_id = 0
+        self._next_sync = 0.0
+        self._sync_interval = 0.05
+        self._leases = {}  # model_id -> TokenLease
+        # 保护令牌存储、健康状态和调度表本身；各模型队列由 ModelSchedule.lock 保护
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_token(token_str):
+        """解析为 (sso值, 非标准格式时的完整cookie)"""
+        # 如果输入的是完整的cookie字符串，直接使用；如果只是cookie值，使用标准cookie格式
+        if 'sso=' in token_str and 'sso-rw=' in token_str:
+            sso = extract_sso(token_str)
+            return sso, None if token_str == f"sso-rw={sso};sso={sso}" else token_str
+        return token_str, None
+
     def add_token(self, token_str):
         if isinstance(token_str, dict):
             token_str = token_str.get("token", "")
-        
-        if token_str and token_str not in self.tokens:
-            self.tokens.append(token_str)
-            self.current_index = 0
-            self.last_round_index = -1
-            logger.info(f"令牌添加成功: {token_str[:20]}...", "TokenManager")
-            return True
-        return False
-    
+        if not token_str:
+            return False
+
+        sso, cookie = self._parse_token(token_str)
+        if self.shared is not None:
+            if not self._shared_apply([{"op": "add", "tokens": [[sso, cookie]]}]):
+                return False
+        else:
+            with self._lock:
+                record = self.store.add(sso, cookie)
+                if record is None:
+                    return False
+                self._on_records_added([record])
+        logger.info("令牌添加成功: {}...", "TokenManager", token_str[:20])
+        return True
+
     def add_tokens_batch(self, token_strs):
         """批量添加tokens，优化性能"""
         if not token_strs:
             return {"success": 0, "failed": 0, "duplicates": 0}
-        
+
         # 转换为列表如果是其他类型
         if isinstance(token_strs, str):
             token_strs = [token_strs]
-        
-        # 使用set进行快速去重检查
-        existing_tokens_set = set(self.tokens)
-        new_tokens = []
-        duplicates = 0
+
+        parsed_tokens = []
         failed = 0
-        
+
         for token_str in token_strs:
             if isinstance(token_str, dict):
                 token_str = token_str.get("token", "")
-            
+
             if not token_str:
                 failed += 1
                 continue
-                
-            # 如果输入的是完整的cookie字符串，直接使用
-            if 'sso=' in token_str and 'sso-rw=' in token_str:
-                formatted_token = token_str
-            else:
-                # 如果只是cookie值，构造完整的cookie字符串
-                formatted_token = f"sso-rw={token_str};sso={token_str}"
-            
-            if formatted_token in existing_tokens_set:
-                duplicates += 1
-            else:
-                new_tokens.append(formatted_token)
-                existing_tokens_set.add(formatted_token)
-        
-        # 批量添加新tokens
-        if new_tokens:
-            self.tokens.extend(new_tokens)
-            # 只在最后重置索引一次
-            self.current_index = 0
-            self.last_round_index = -1
-            logger.info(f"批量添加令牌完成: 成功 {len(new_tokens)} 个，重复 {duplicates} 个，失败 {failed} 个", "TokenManager")
-        
+
+            parsed_tokens.append(self._parse_token(token_str))
+
+        if self.shared is not None:
+            added = self._shared_apply([{"op": "add", "tokens": [list(token) for token in parsed_tokens]}])
+            return self._batch_result(added, len(parsed_tokens) - added, failed)
+
+        new_records = []
+        add = self.store.add
+        # 大批量创建记录时暂停循环垃圾回收，避免反复扫描刚创建的大量对象
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with self._lock:
+                for sso, cookie in parsed_tokens:
+                    record = add(sso, cookie)
+                    if record is not None:
+                        new_records.append(record)
+
+                # 批量添加新tokens
+                if new_records:
+                    self._on_records_added(new_records)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        return self._batch_result(len(new_records), len(parsed_tokens) - len(new_records), failed)
+
+    @staticmethod
+    def _batch_result(added, duplicates, failed):
+        if added:
+            logger.info("批量添加令牌完成: 成功 {} 个，重复 {} 个，失败 {} 个", "TokenManager", added, duplicates, failed)
+
         return {
-            "success": len(new_tokens), 
-            "failed": failed, 
+            "success": added,
+            "failed": failed,
             "duplicates": duplicates
         }
-        
+
     def set_token(self, token_str):
         if isinstance(token_str, dict):
             token_str = token_str.get("token", "")
-            
-        self.tokens = [token_str]
-        self.current_index = 0
-        self.last_round_index = -1
-        logger.info(f"设置单个令牌: {token_str[:20]}...", "TokenManager")
+
+        self.set_tokens([token_str])
+        logger.info("设置单个令牌: {}...", "TokenManager", token_str[:20])
+
+    def set_tokens(self, token_strs):
+        """整体替换令牌列表"""
+        if self.shared is not None:
+            tokens = [list(self._parse_token(token_str)) for token_str in token_strs]
+            self._shared_apply([{"op": "clear"}, {"op": "add", "tokens": tokens}])
+            return
+        with self._lock:
+            self.store.clear()
+            self.schedules = {}
+            self._status_cache = None
+            self._journal({"op": "clear"})
+            records = []
+            for token_str in token_strs:
+                record = self.store.add(*self._parse_token(token_str))
+                if record is not None:
+                    records.append(record)
+            self._on_records_added(records)
 
     def delete_token(self, token):
         try:
             if isinstance(token, dict):
                 token = token.get("token", "")
-            
-            # 首先尝试直接匹配
-            if token in self.tokens:
-                self.tokens.remove(token)
-                # 重置轮询状态以避免索引越界
-                self.current_index = 0
-                self.last_round_index = -1
-                logger.info(f"令牌已成功移除: {token[:20]}...", "TokenManager")
-                return True
-            
-            # 如果直接匹配失败，尝试通过SSO值匹配完整token
-            for stored_token in self.tokens[:]:  # 创建副本以避免在迭代时修改列表
-                if "sso=" in stored_token:
-                    sso_value = stored_token.split("sso=")[1].split(";")[0]
-                    if sso_value == token:
-                        self.tokens.remove(stored_token)
-                        # 重置轮询状态以避免索引越界
-                        self.current_index = 0
-                        self.last_round_index = -1
-                        logger.info(f"令牌已成功移除: {stored_token[:20]}...", "TokenManager")
-                        return True
-            
-            logger.warning(f"未找到要删除的令牌: {token[:20]}...", "TokenManager")
+
+            # 支持完整cookie字符串或单独的SSO值
+            if self.shared is not None:
+                if self._shared_apply([{"op": "del", "sso": extract_sso(token)}]):
+                    logger.info("令牌已成功移除: {}...", "TokenManager", token[:20])
+                    return True
+                logger.warning("未找到要删除的令牌: {}...", "TokenManager", token[:20])
+                return False
+
+            with self._lock:
+                removed = self.store.remove(extract_sso(token))
+                if removed is not None:
+                    # 调度队列中的残留条目会在出队时惰性清理；删除会改变后续令牌的序号，状态视图需重建
+                    self._status_cache = None
+                    self._journal({"op": "del", "sso": removed.sso})
+                    logger.info("令牌已成功移除: {}...", "TokenManager", token[:20])
+                    return True
+
+            logger.warning("未找到要删除的令牌: {}...", "TokenManager", token[:20])
             return False
         except Exception as error:
-            logger.error(f"令牌删除失败: {str(error)}", "TokenManager")
+            logger.error("令牌删除失败: {}", "TokenManager", error)
             return False
-    
+
+    def _journal(self, entry):
+        # 在 _lock 内调用，保证日志顺序与内存中的修改顺序一致
+        if self.journal is not None:
+            self.journal.append(entry)
+
+    def _on_records_added(self, records):
+        if records:
+            self._journal({"op": "add", "tokens": [[record.sso, record.cookie] for record in records]})
+        self._index_records(records)
+
+    def _index_records(self, records):
+        if self._status_cache is not None:
+            index = len(self._status_cache)
+            for record in records:
+                self._status_cache[record.sso] = self._build_status(record, index)
+                index += 1
+        for schedule in self.schedules.values():
+            with schedule.lock:
+                schedule.ready.extend(records)
+
+    def _is_live(self, record):
+        return self.store.records.get(record.sso) is record
+
+    def _get_schedule(self, model_id):
+        schedule = self.schedules.get(model_id)
+        if schedule is None:
+            with self._lock:
+                schedule = self.schedules.get(model_id)
+                if schedule is None:
+                    schedule = self.schedules[model_id] = ModelSchedule(self.store)
+        return schedule
+
+    @staticmethod
+    def _get_health(record, model_id):
+        if record.health is None:
+            record.health = {}
+        health = record.health.get(model_id)
+        if health is None:
+            health = record.health[model_id] = TokenHealth()
+        return health
+
+    @staticmethod
+    def _cooldown_until(record, model_id):
+        health = record.health.get(model_id) if record.health else None
+        return health.cooldown_until if health else 0.0
+
     def get_next_token_for_model(self, model_id):
-        if not self.tokens:
+        """按轮询顺序返回该模型下一个可用令牌，冷却中的令牌直接跳过；全部不可用时返回None"""
+        if self.shared is not None:
+            return self._next_shared_token(model_id)
+        if not self.store:
             return None
-            
-        # 检查是否开始新的一轮轮询
-        if self.current_index == 0 and self.last_round_index != -1:
-            # 开始新一轮轮询，重置索引
-            self.current_index = 0
-        else:
-            # 记录上一轮的最后索引
-            if self.current_index == len(self.tokens) - 1:
-                self.last_round_index = self.current_index
-        
-        # 按序号依次轮询
-        token = self.tokens[self.current_index]
-        
-        # 移动到下一个索引
-        self.current_index = (self.current_index + 1) % len(self.tokens)
-        
-        return token
 
+        schedule = self._get_schedule(model_id)
+        now = time.time()
+
+        # 这里只持有该模型的锁；令牌索引和健康状态的读取在GIL下是原子的
+        with schedule.lock:
+            # 冷却到期的令牌重新进入就绪队列
+            while schedule.cooling and schedule.cooling[0][0] <= now:
+                _, _, record = heapq.heappop(schedule.cooling)
+                if not self._is_live(record):
+                    continue
+                cooldown_until = self._cooldown_until(record, model_id)
+                if cooldown_until > now:
+                    # 冷却期在入堆后又被延长
+                    heapq.heappush(schedule.cooling, (cooldown_until, next(self._heap_seq), record))
+                else:
+                    schedule.ready.append(record)
+
+            while schedule.ready:
+                record = schedule.ready.popleft()
+                if not self._is_live(record):
+                    continue
+
+                cooldown_until = self._cooldown_until(record, model_id)
+                if cooldown_until > now:
+                    heapq.heappush(schedule.cooling, (cooldown_until, next(self._heap_seq), record))
+                    continue
+
+                schedule.ready.append(record)
+                return record.get_cookie()
+
+        return None
+
+    def _next_shared_token(self, model_id):
+        """共享模式：依次取用本进程租到的令牌段，用完（或段内令牌都已冷却）后从共享游标处再租一段"""
+        self._sync_shared()
+        lease = self._leases.get(model_id)
+        if lease is None:
+            lease = self._leases.setdefault(model_id, TokenLease())
+        now = time.time()
+
+        with lease.lock:
+            for _ in range(2):
+                while lease.queue:
+                    record = self.store.get(lease.queue.popleft())
+                    if record is not None and self._cooldown_until(record, model_id) <= now:
+                        return record.get_cookie()
+
+                ssos = self.shared.lease(model_id, len(self.store), now)
+                if not ssos:
+                    return None
+                if any(self.store.get(sso) is None for sso in ssos):
+                    # 段内有其他进程刚添加、本进程尚未重放的令牌
+                    self._sync_shared(force=True)
+                lease.queue.extend(ssos)
+
+        return None
+
+    def _update_health(self, token, model_id, update):
+        """
+        按 update(cooldown_until, failures) 返回的新值更新令牌在该模型上的健康状态，返回新值；令牌不存在时返回None。
+        共享模式下在数据库写事务内完成读取和更新，多个进程同时记录失败时计数不会丢失。
+        """
+        sso = extract_sso(token)
+        if self.shared is not None:
+            result = self.shared.update_health(sso, model_id, update)
+            self._sync_shared(force=True)
+            return result
+
+        with self._lock:
+            record = self.store.get(sso)
+            if record is None:
+                return None
+            health = self._get_health(record, model_id)
+            previous_until = health.cooldown_until
+            health.cooldown_until, health.failures = update(health.cooldown_until, health.failures)
+            now = time.time()
+            if previous_until > now >= health.cooldown_until:
+                self._revive(record, model_id)
+            self._on_health_changed(record, model_id, health)
+            return health.cooldown_until, health.failures
+
+    def _revive(self, record, model_id):
+        """
+        冷却被提前解除（请求成功或重新检测通过）：从冷却堆中取出该令牌，重新进入就绪队列。
+        堆中的条目仍以原来的冷却截止时间排序，不取出的话要等到原截止时间才会再被调度。
+        """
+        schedule = self.schedules.get(model_id)
+        if schedule is None:
+            return
+        with schedule.lock:
+            entries = [entry for entry in schedule.cooling if entry[2] is not record]
+            # 不在堆中时说明令牌还在就绪队列里（尚未被取到），不能重复加入
+            if len(entries) == len(schedule.cooling):
+                return
+            heapq.heapify(entries)
+            schedule.cooling = entries
+            schedule.ready.append(record)
+
+    def mark_success(self, token, model_id):
+        record = self.store.get(extract_sso(token))
+        if record is None or not record.health:
+            return
+        health = record.health.get(model_id)
+        if health and (health.failures or health.cooldown_until):
+            self._update_health(token, model_id, lambda cooldown_until, failures: (0.0, 0))
+
+    def mark_rate_limited(self, token, model_id, retry_after=None):
+        """令牌在该模型上配额用尽（429），冷却期内不再被调度"""
+        cooldown = retry_after or config_manager.get("TOKEN.RATE_LIMIT_COOLDOWN", 3600)
+        until = time.time() + cooldown
+        if self._update_health(token, model_id, lambda cooldown_until, failures: (max(cooldown_until, until), failures)) is None:
+            return
+        logger.info("令牌进入冷却 {}s ({}): {}...", "TokenManager", cooldown, model_id, token[:20])
+
+    @staticmethod
+    def _failure_cooldown(failures, threshold):
+        return min(
+            config_manager.get("TOKEN.FAILURE_COOLDOWN", 60) * 2 ** (failures - threshold),
+            config_manager.get("TOKEN.MAX_FAILURE_COOLDOWN", 1800)
+        )
+
+    def mark_failure(self, token, model_id):
+        """记录连续失败，超过阈值后按指数退避进入短暂冷却"""
+        threshold = config_manager.get("TOKEN.FAILURE_THRESHOLD", 3)
+
+        def update(cooldown_until, failures):
+            failures += 1
+            if failures >= threshold:
+                cooldown_until = max(cooldown_until, time.time() + self._failure_cooldown(failures, threshold))
+            return cooldown_until, failures
+
+        result = self._update_health(token, model_id, update)
+        if result is not None and result[1] >= threshold:
+            logger.info("令牌连续失败 {} 次，冷却 {}s ({}): {}...", "TokenManager", result[1],
+                        self._failure_cooldown(result[1], threshold), model_id, token[:20])
+
+    def get_pool_stats(self):
+        """令牌池大小：总数，以及各模型下可用和冷却中的令牌数（供 /metrics 抓取时读取）"""
+        self._sync_shared()
+        now = time.time()
+        with self._lock:
+            # 只在锁内复制记录列表，统计在锁外进行，不阻塞请求路径上的状态更新
+            records = list(self.store.records.values())
+        cooling = dict.fromkeys(config_manager.get_models(), 0)
+        for record in records:
+            if not record.health:
+                continue
+            for model_id, health in record.health.items():
+                if health.cooldown_until > now:
+                    cooling[model_id] = cooling.get(model_id, 0) + 1
+        return {
+            "total": len(records),
+            "models": {
+                model_id: {"available": len(records) - count, "cooling": count}
+                for model_id, count in cooling.items()
+            }
+        }
 
     def get_all_tokens(self):
-        return self.tokens.copy()
-        
-    def get_token_status_map(self):
-        status_map = {}
-        for i, token in enumerate(self.tokens):
-            if "sso=" in token:
-                sso = token.split("sso=")[1].split(";")[0]
-            else:
-                sso = f"token_{i}"
-                
-            status_map[sso] = {
-                "isValid": True,
-                "index": i
+        self._sync_shared(force=True)
+        with self._lock:
+            return [record.get_cookie() for record in self.store]
+
+    @staticmethod
+    def _build_status(record, index):
+        status = {
+            "isValid": True,
+            "index": index
+        }
+        if record.health:
+            status["models"] = {
+                model_id: {
+                    "cooldownUntil": int(health.cooldown_until),
+                    "failures": health.failures
+                }
+                for model_id, health in record.health.items()
             }
-        return status_map
-    
+        return status
+
+    def _on_health_changed(self, record, model_id, health):
+        self._refresh_status(record)
+        # 冷却截止时间使用墙上时钟，重启后仍然有效
+        self._journal({
+            "op": "health",
+            "sso": record.sso,
+            "model": model_id,
+            "until": health.cooldown_until,
+            "failures": health.failures
+        })
+
+    def _refresh_status(self, record):
+        # 替换为新的字典而不是原地修改，已返回给调用方的视图不会在序列化过程中被改动
+        if self._status_cache is not None and record.sso in self._status_cache:
+            index = self._status_cache[record.sso]["index"]
+            self._status_cache[record.sso] = self._build_status(record, index)
+
+    def _get_status_view(self):
+        if self._status_cache is None:
+            self._status_cache = {
+                record.sso: self._build_status(record, index)
+                for index, record in enumerate(self.store)
+            }
+        return self._status_cache
+
+    def get_token_status_map(self):
+        self._sync_shared(force=True)
+        with self._lock:
+            return dict(self._get_status_view())
+
+    def get_token_status(self, sso):
+        self._sync_shared(force=True)
+        with self._lock:
+            return self._get_status_view().get(sso)
+
+    def export_state(self):
+        """导出完整状态用于生成快照，格式见 TokenJournal.load"""
+        now = time.time()
+        tokens, cookies, health = [], {}, {}
+        with self._lock:
+            for record in self.store:
+                tokens.append(record.sso)
+                if record.cookie:
+                    cookies[record.sso] = record.cookie
+                if record.health:
+                    models = {
+                        model_id: [h.cooldown_until, h.failures]
+                        for model_id, h in record.health.items()
+                        if h.failures or h.cooldown_until > now
+                    }
+                    if models:
+                        health[record.sso] = models
+        return {"tokens": tokens, "cookies": cookies, "health": health}
+
+    def _restore(self, tokens, health):
+        with self._lock:
+            return self._restore_locked(tokens, health)
+
+    def _restore_locked(self, tokens, health):
+        records = []
+        for sso, cookie in tokens.items():
+            record = self.store.add(sso, cookie)
+            if record is not None:
+                records.append(record)
+        for sso, models in health.items():
+            record = self.store.get(sso)
+            if record is None:
+                continue
+            record.health = {}
+            for model_id, (cooldown_until, failures) in models.items():
+                token_health = record.health[model_id] = TokenHealth()
+                token_health.cooldown_until = cooldown_until
+                token_health.failures = failures
+        self._status_cache = None
+        for schedule in self.schedules.values():
+            with schedule.lock:
+                schedule.ready.extend(records)
+        return len(records)
+
+    def _shared_apply(self, entries):
+        """共享模式下提交 add / del / clear 操作，并立即重放到内存，返回实际新增或删除的令牌数"""
+        changed = self.shared.apply(entries)
+        self._sync_shared(force=True)
+        return changed
+
+    def _sync_shared(self, force=False):
+        """重放共享存储中尚未应用的操作（包括本进程提交的）；未启用共享存储时直接返回，force 为 False 时按间隔节流"""
+        if self.shared is None:
+            return
+        now = time.monotonic()
+        if not force and now < self._next_sync:
+            return
+        self._next_sync = now + self._sync_interval
+        self.shared.heartbeat()
+        with self._lock:
+            ops = self.shared.read_ops(self._shared_op_id)
+            if ops is None:
+                # 落后太多，所需的日志已被清理
+                self._reload_shared_locked()
+                return
+            for op_id, entry in ops:
+                self._apply(entry)
+                self._shared_op_id = op_id
+
+    def _reload_shared_locked(self):
+        tokens, health, op_id = self.shared.load()
+        self.store.clear()
+        self._leases = {}
+        self._restore_locked(tokens, health)
+        self._shared_op_id = op_id
+
+    def _apply(self, entry):
+        """把共享存储操作日志中的一条操作应用到内存，语义与 TokenJournal._apply 相同"""
+        kind = entry["op"]
+        if kind == "add":
+            records = []
+            for sso, cookie in entry["tokens"]:
+                record = self.store.add(sso, cookie)
+                if record is not None:
+                    records.append(record)
+            self._index_records(records)
+        elif kind == "del":
+            if self.store.remove(entry["sso"]) is not None:
+                self._status_cache = None
+        elif kind == "clear":
+            self.store.clear()
+            self._leases = {}
+            self._status_cache = None
+        elif kind == "health":
+            record = self.store.get(entry["sso"])
+            if record is None:
+                return
+            health = self._get_health(record, entry["model"])
+            health.cooldown_until = entry["until"]
+            health.failures = entry["failures"]
+            self._refresh_status(record)
+
+    def attach_shared_store(self, path):
+        """
+        连接多进程共享存储并加载其中的令牌。数据库首次使用时导入数据目录中单进程模式的持久化数据；
+        此后由数据库本身持久化，不再写 TokenJournal。
+        """
+        start = time.perf_counter()
+        data_dir = config_manager.get("TOKEN.DATA_DIR")
+        shared = SharedTokenStore(path, config_manager.get("TOKEN.SHARED_LEASE_SIZE", 64))
+        imported = shared.initialize(lambda: TokenJournal(data_dir).load() if data_dir else ({}, {}))
+        if imported:
+            logger.info("已将持久化目录中的 {} 个令牌导入共享存储", "TokenManager", imported)
+
+        shared.heartbeat()
+        self._sync_interval = config_manager.get("TOKEN.SHARED_SYNC_MS", 50) / 1000
+        self.shared = shared
+        with self._lock:
+            self._reload_shared_locked()
+        logger.info("已连接共享令牌存储 {}: {}个令牌，耗时 {:.2f}s", "TokenManager", path, len(self.store), time.perf_counter() - start)
+
+    def get_shared_stats(self):
+        if self.shared is None:
+            return None
+        self._sync_shared(force=True)
+        stats = self.shared.get_stats()
+        stats["applied_op"] = self._shared_op_id
+        return stats
+
+    def load_from_disk(self):
+        """
+        从数据目录恢复令牌和健康状态，并开始记录后续修改；未配置 TOKEN.DATA_DIR 时不启用持久化。
+        配置了 TOKEN.SHARED_DB（多进程模式）时改为连接共享存储。
+        """
+        shared_db = config_manager.get("TOKEN.SHARED_DB")
+        if shared_db:
+            if self.shared is None:
+                self.attach_shared_store(shared_db)
+            return
+
+        data_dir = config_manager.get("TOKEN.DATA_DIR")
+        if not data_dir or self.journal is not None:
+            return
+
+        start = time.perf_counter()
+        journal = TokenJournal(data_dir, config_manager.get("TOKEN.SNAPSHOT_THRESHOLD", 10000))
+        # 恢复过程中会创建大量对象，暂停循环垃圾回收
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            count = self._restore(*journal.load())
+        except Exception as e:
+            logger.error("令牌持久化数据读取失败，本次不启用持久化: {}", "TokenManager", e)
+            return
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        self.journal = journal
+        journal.start(self.export_state)
+        logger.info("从磁盘恢复令牌: {}个，耗时 {:.2f}s", "TokenManager", count, time.perf_counter() - start)
+
     def load_from_env(self):
         sso_array = os.environ.get("SSO", "").split(',')
-        if sso_array and sso_array[0]:
-            for value in sso_array:
-                if value.strip():
-                    token_str = f"sso-rw={value.strip()};sso={value.strip()}"
-                    self.add_token(token_str)
-        
-        logger.info(f"令牌加载完成，共加载: {len(self.get_all_tokens())}个令牌", "TokenManager")
-    
+        self.add_tokens_batch([value.strip() for value in sso_array if value.strip()])
+
+        logger.info("令牌加载完成，共加载: {}个令牌", "TokenManager", len(self.store))
+
     def is_empty(self):
-        return len(self.tokens) == 0
\ No newline at end of file
+        self._sync_shared()
+        return len(self.store) == 0
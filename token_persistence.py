@@ -0,0 +1,178 @@
+"""
+令牌持久化
+
+令牌及其冷却/健康状态保存在数据目录下的两个文件中：
+- tokens.snapshot.json: 压缩后的完整快照，按列存储（sso列表 + 稀疏的cookie和健康状态）
+- tokens.log: 快照之后的追加日志，每行一个JSON操作
+
+所有写入都由后台线程完成，请求路径只把操作放入队列。日志条数超过阈值后在后台线程中重新生成快照并清空日志。
+日志中的操作都是幂等的（添加已存在的令牌会被忽略，健康状态记录的是绝对值），
+因此快照生成后、日志清空前崩溃，重放时也能得到相同的结果。
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import threading
+from logger import logger
+
+
+_STOP = object()
+_SNAPSHOT = object()
+
+
+def _dumps(entry):
+    return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+class TokenJournal:
+    SNAPSHOT_FILE = "tokens.snapshot.json"
+    LOG_FILE = "tokens.log"
+
+    def __init__(self, data_dir, snapshot_threshold=10000):
+        self.data_dir = data_dir
+        self.snapshot_path = os.path.join(data_dir, self.SNAPSHOT_FILE)
+        self.log_path = os.path.join(data_dir, self.LOG_FILE)
+        self.snapshot_threshold = snapshot_threshold
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._export_state = None
+        self._log_entries = 0
+
+    def load(self):
+        """
+        读取快照并重放日志，返回 (tokens, health)：
+        tokens 为按添加顺序排列的 {sso: 非标准格式时的完整cookie或None}，health 为 {sso: {model_id: [cooldown_until, failures]}}
+        """
+        tokens, health = {}, {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            # 快照按列存储，绝大多数令牌只是一个字符串，解析代价最低
+            tokens = dict.fromkeys(snapshot.get("tokens", []))
+            tokens.update(snapshot.get("cookies", {}))
+            health = snapshot.get("health", {})
+
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        op = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 进程在写入过程中退出时最后一行可能不完整
+                        logger.warning("跳过损坏的令牌日志第 {} 行", "TokenJournal", line_number)
+                        continue
+                    self._apply(tokens, health, op)
+                    self._log_entries += 1
+
+        return tokens, health
+
+    @staticmethod
+    def _apply(tokens, health, op):
+        kind = op.get("op")
+        if kind == "add":
+            for sso, cookie in op["tokens"]:
+                if sso not in tokens:
+                    tokens[sso] = cookie
+        elif kind == "del":
+            tokens.pop(op["sso"], None)
+            health.pop(op["sso"], None)
+        elif kind == "clear":
+            tokens.clear()
+            health.clear()
+        elif kind == "health":
+            sso = op["sso"]
+            if sso not in tokens:
+                return
+            models = health.setdefault(sso, {})
+            if op["failures"] or op["until"] > time.time():
+                models[op["model"]] = [op["until"], op["failures"]]
+            else:
+                models.pop(op["model"], None)
+                if not models:
+                    del health[sso]
+
+    def start(self, export_state):
+        """启动后台写入线程，export_state 返回当前完整状态，用于生成快照"""
+        os.makedirs(self.data_dir, exist_ok=True)
+        self._export_state = export_state
+        self._thread = threading.Thread(target=self._run, name="TokenJournal", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        # 上次运行遗留的日志较多时，先压缩一次，加快下次启动
+        if self._log_entries >= self.snapshot_threshold:
+            self.request_snapshot()
+
+    def append(self, entry):
+        """记录一条操作，不阻塞调用方"""
+        self._queue.put(entry)
+
+    def request_snapshot(self):
+        self._queue.put(_SNAPSHOT)
+
+    def flush(self, timeout=10):
+        """等待此前记录的操作全部写入磁盘"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout=10):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _run(self):
+        log_file = open(self.log_path, "a", encoding="utf-8")
+        try:
+            while True:
+                batch = [self._queue.get()]
+                # 一次取出队列中积压的全部操作，合并成一次写入
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = _STOP in batch
+                lines = [_dumps(entry) for entry in batch if isinstance(entry, dict)]
+                try:
+                    if lines:
+                        log_file.write("\n".join(lines) + "\n")
+                        log_file.flush()
+                        self._log_entries += len(lines)
+
+                    if self._log_entries and (
+                        self._log_entries >= self.snapshot_threshold or stop or _SNAPSHOT in batch
+                    ):
+                        self._write_snapshot()
+                        log_file.seek(0)
+                        log_file.truncate()
+                        self._log_entries = 0
+                except Exception as e:
+                    logger.error("令牌持久化写入失败: {}", "TokenJournal", e)
+
+                for entry in batch:
+                    if isinstance(entry, threading.Event):
+                        entry.set()
+
+                if stop:
+                    break
+        finally:
+            log_file.close()
+
+    def _write_snapshot(self):
+        start = time.perf_counter()
+        state = self._export_state()
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(_dumps({"version": 1, "savedAt": int(time.time()), **state}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        logger.info("令牌快照已保存: {} 个令牌，耗时 {:.2f}s", "TokenJournal", len(state['tokens']), time.perf_counter() - start)
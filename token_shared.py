@@ -0,0 +1,283 @@
+"""
+多进程共享的令牌状态
+
+多个工作进程（WORKERS>1 或 gunicorn 多 worker）各自持有一个 AuthTokenManager，
+令牌列表、各模型的轮询游标和冷却/健康状态统一保存在同一个 SQLite 文件中（WAL 模式，读不阻塞写）：
+- tokens: 按添加顺序编号的令牌
+- health: 令牌在各模型上的冷却截止时间和连续失败次数（只保存非默认值）
+- cursors: 各模型的轮询游标（令牌编号）
+- ops: 全部修改按提交顺序记录的操作日志，格式与 TokenJournal 的日志相同
+
+进程内的修改先在写事务中提交到数据库，再和其他进程的修改一起按日志顺序重放到内存中，
+因此所有进程内存中的令牌顺序和状态一致。请求路径只读内存，每隔 SHARED_SYNC_MS 毫秒才检查一次新的日志。
+
+轮询游标按段租用：一次写事务取走游标之后的一段未冷却令牌（约为 令牌数 / 活跃进程数，不超过 SHARED_LEASE_SIZE），
+之后在本进程内依次使用。各进程拿到的是互不重叠的令牌段，不会同时打在相同的令牌上，数据库写入也只在一段用完时发生。
+"""
+import os
+import json
+import time
+import uuid
+import atexit
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from config import config_manager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (seq INTEGER PRIMARY KEY AUTOINCREMENT, sso TEXT NOT NULL UNIQUE, cookie TEXT);
+CREATE TABLE IF NOT EXISTS health (
+    sso TEXT NOT NULL, model TEXT NOT NULL, until REAL NOT NULL, failures INTEGER NOT NULL,
+    PRIMARY KEY (sso, model)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cursors (model TEXT PRIMARY KEY, seq INTEGER NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS ops (id INTEGER PRIMARY KEY AUTOINCREMENT, entry TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, seen_at REAL NOT NULL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+"""
+
+# 游标之后编号在 (下限, 上限] 内、在该模型上未冷却的令牌
+LEASE_SQL = """
+SELECT t.seq, t.sso FROM tokens t
+LEFT JOIN health h ON h.sso = t.sso AND h.model = ?
+WHERE t.seq > ? AND t.seq <= ? AND (h.until IS NULL OR h.until <= ?)
+ORDER BY t.seq LIMIT ?
+"""
+
+# 操作日志保留的条数，落后更多的进程从表中完整重新加载
+OPS_RETAIN = 10000
+# 进程登记心跳的间隔，超过 WORKER_TTL 秒未登记的进程不再计入活跃进程数
+HEARTBEAT_INTERVAL = 1
+WORKER_TTL = 5
+
+
+def _dumps(entry):
+    return json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+
+
+def prepare_shared_db(workers):
+    """
+    多进程启动前确定共享数据库路径，写入环境变量供子进程读取。
+    未配置 TOKEN_SHARED_DB 时放在数据目录下；未配置数据目录（不持久化）时使用临时文件，并清除上次运行遗留的内容。
+    """
+    path = config_manager.get("TOKEN.SHARED_DB")
+    if workers <= 1 or path:
+        return path
+    data_dir = config_manager.get("TOKEN.DATA_DIR")
+    if data_dir:
+        path = os.path.join(data_dir, "tokens.db")
+    else:
+        path = os.path.join(tempfile.gettempdir(), f"grok2api-tokens-{config_manager.get('SERVER.PORT')}.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.environ["TOKEN_SHARED_DB"] = path
+    config_manager.set("TOKEN.SHARED_DB", path)
+    return path
+
+
+class SharedTokenStore:
+    def __init__(self, path, lease_size=64):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lease_size = max(1, lease_size)
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # 同一连接由本进程的所有线程共用，由 _lock 串行化
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 只在检查点时 fsync，提交不落盘；进程崩溃不会丢数据，只有断电可能丢失最后几次提交
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._workers = 1
+        self._heartbeat_at = 0.0
+        self._next_trim = 0
+        self.stats = {"writes": 0, "leases": 0, "leased": 0, "reloads": 0}
+        atexit.register(self.close)
+
+    @contextmanager
+    def _write(self):
+        # BEGIN IMMEDIATE 在事务开始时就取得写锁，避免读后再升级写锁时与其他进程互相等待
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            self.stats["writes"] += 1
+
+    @contextmanager
+    def _read(self):
+        # 同一个读事务内的多条查询看到的是同一个版本
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            finally:
+                self._conn.execute("COMMIT")
+
+    def initialize(self, import_state):
+        """
+        数据库首次使用时导入 import_state() 返回的 (tokens, health)（单进程模式下的持久化数据），返回导入的令牌数。
+        只有第一个进程会执行导入，其余进程等待导入提交后直接返回0。
+        """
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'initialized'").fetchone():
+                return 0
+            tokens, health = import_state()
+            conn.executemany("INSERT OR IGNORE INTO tokens (sso, cookie) VALUES (?, ?)", tokens.items())
+            conn.executemany(
+                "INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?)",
+                [(sso, model_id, until, failures)
+                 for sso, models in health.items() for model_id, (until, failures) in models.items()]
+            )
+            conn.execute("INSERT INTO meta VALUES ('initialized', ?)", (int(time.time()),))
+            return len(tokens)
+
+    def load(self):
+        """读取完整状态，返回 (tokens, health, 已包含的最后一条日志编号)，tokens 和 health 的格式同 TokenJournal.load"""
+        with self._read() as conn:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ops'").fetchone()
+            tokens = dict(conn.execute("SELECT sso, cookie FROM tokens ORDER BY seq"))
+            health = {}
+            for sso, model_id, until, failures in conn.execute("SELECT sso, model, until, failures FROM health"):
+                health.setdefault(sso, {})[model_id] = [until, failures]
+        self.stats["reloads"] += 1
+        return tokens, health, row[0] if row else 0
+
+    def read_ops(self, after_id):
+        """返回 after_id 之后的操作 [(编号, 操作)]；其中一部分已被清理时返回None，调用方需要完整重新加载"""
+        with self._read() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'trimmed'").fetchone()
+            if row and row[0] > after_id:
+                return None
+            rows = conn.execute("SELECT id, entry FROM ops WHERE id > ? ORDER BY id", (after_id,)).fetchall()
+        return [(op_id, json.loads(entry)) for op_id, entry in rows]
+
+    def apply(self, entries):
+        """
+        在一个事务中执行一组 add / del / clear 操作并写入操作日志，返回实际新增或删除的令牌数。
+        add 操作只记录实际新增的令牌，重复添加不产生日志。
+        """
+        changed = 0
+        with self._write() as conn:
+            for entry in entries:
+                kind = entry["op"]
+                if kind == "add":
+                    added = [
+                        [sso, cookie] for sso, cookie in entry["tokens"]
+                        if conn.execute("INSERT OR IGNORE INTO tokens (sso, cookie) VALUES (?, ?)", (sso, cookie)).rowcount
+                    ]
+                    if not added:
+                        continue
+                    changed += len(added)
+                    entry = {"op": "add", "tokens": added}
+                elif kind == "del":
+                    if not conn.execute("DELETE FROM tokens WHERE sso = ?", (entry["sso"],)).rowcount:
+                        continue
+                    conn.execute("DELETE FROM health WHERE sso = ?", (entry["sso"],))
+                    changed += 1
+                elif kind == "clear":
+                    changed += conn.execute("DELETE FROM tokens").rowcount
+                    conn.execute("DELETE FROM health")
+                    conn.execute("DELETE FROM cursors")
+                self._log(conn, entry)
+        return changed
+
+    def update_health(self, sso, model_id, update):
+        """
+        在写事务内读取令牌在该模型上的 (cooldown_until, failures)，交给 update 计算新值后写回，
+        多个进程同时记录失败时计数不会丢失。返回新值，令牌不存在时返回None。
+        """
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM tokens WHERE sso = ?", (sso,)).fetchone() is None:
+                return None
+            current = conn.execute(
+                "SELECT until, failures FROM health WHERE sso = ? AND model = ?", (sso, model_id)
+            ).fetchone() or (0.0, 0)
+            until, failures = update(*current)
+            if (until, failures) == tuple(current):
+                return until, failures
+            if failures or until > time.time():
+                conn.execute("INSERT OR REPLACE INTO health VALUES (?, ?, ?, ?)", (sso, model_id, until, failures))
+            else:
+                conn.execute("DELETE FROM health WHERE sso = ? AND model = ?", (sso, model_id))
+            self._log(conn, {"op": "health", "sso": sso, "model": model_id, "until": until, "failures": failures})
+            return until, failures
+
+    def _log(self, conn, entry):
+        op_id = conn.execute("INSERT INTO ops (entry) VALUES (?)", (_dumps(entry),)).lastrowid
+        if op_id >= self._next_trim:
+            # 每写入约一千条清理一次过旧的日志，并记录清理位置
+            trimmed = op_id - OPS_RETAIN
+            if trimmed > 0:
+                conn.execute("DELETE FROM ops WHERE id <= ?", (trimmed,))
+                conn.execute(
+                    "INSERT INTO meta VALUES ('trimmed', ?) ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (trimmed,)
+                )
+            self._next_trim = op_id + 1000
+
+    def lease(self, model_id, token_count, now):
+        """
+        从该模型的游标处租用一段未冷却的令牌（到末尾后从头继续），推进游标并返回sso列表。
+        段长为 令牌数 / 活跃进程数，不超过 lease_size，令牌在各进程间平分。
+        """
+        with self._write() as conn:
+            self._workers = max(1, conn.execute(
+                "SELECT COUNT(*) FROM workers WHERE seen_at >= ?", (time.time() - WORKER_TTL,)
+            ).fetchone()[0])
+            size = max(1, min(self.lease_size, token_count // self._workers))
+            row = conn.execute("SELECT seq FROM cursors WHERE model = ?", (model_id,)).fetchone()
+            cursor = row[0] if row else 0
+            rows = conn.execute(LEASE_SQL, (model_id, cursor, 2 ** 63 - 1, now, size)).fetchall()
+            if len(rows) < size and cursor:
+                rows += conn.execute(LEASE_SQL, (model_id, 0, cursor, now, size - len(rows))).fetchall()
+            if rows:
+                conn.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?)", (model_id, rows[-1][0]))
+            self.stats["leases"] += 1
+            self.stats["leased"] += len(rows)
+        return [sso for _, sso in rows]
+
+    def heartbeat(self):
+        """定期登记本进程并统计最近活跃的进程数"""
+        now = time.time()
+        if now - self._heartbeat_at < HEARTBEAT_INTERVAL:
+            return
+        self._heartbeat_at = now
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.worker_id, now))
+            conn.execute("DELETE FROM workers WHERE seen_at < ?", (now - WORKER_TTL,))
+            self._workers = max(1, conn.execute("SELECT COUNT(*) FROM workers").fetchone()[0])
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute("DELETE FROM workers WHERE id = ?", (self.worker_id,))
+            except sqlite3.Error:
+                pass
+            self._conn.close()
+            self._conn = None
+
+    def get_stats(self):
+        with self._read() as conn:
+            tokens = conn.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+            cursors = dict(conn.execute("SELECT model, seq FROM cursors"))
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'ops'").fetchone()
+        return {
+            "path": self.path,
+            "worker": self.worker_id,
+            "workers": self._workers,
+            "tokens": tokens,
+            "last_op": row[0] if row else 0,
+            "lease_size": self.lease_size,
+            "cursors": cursors,
+            **self.stats
+        }
@@ -0,0 +1,84 @@
+"""
+批量令牌检测
+
+用指定令牌直接请求上游，不经过轮询，也不修改线上令牌列表。检测使用独立的会话池，
+大批量检测不会挤掉线上请求正在复用的会话。检测结果通过 RequestHandler 反馈到令牌健康状态。
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from config import config_manager
+from logger import logger
+from token_manager import extract_sso
+from session_pool import SessionPool
+
+
+# 单次检测允许的最大并发数
+MAX_CONCURRENCY = 200
+
+
+def classify_status(status_code):
+    if status_code == 200:
+        return "valid"
+    if status_code == 429:
+        return "rate_limited"
+    if status_code == 403:
+        # IP被封禁，与令牌本身无关
+        return "blocked"
+    if 400 <= status_code < 500:
+        return "invalid"
+    return "error"
+
+
+class TokenValidator:
+    def __init__(self, request_handler, token_manager):
+        self.request_handler = request_handler
+        self.token_manager = token_manager
+        self.session_pool = SessionPool()
+
+    def _check(self, token, model, timeout):
+        start = time.perf_counter()
+        result = {"sso": extract_sso(token)}
+        try:
+            status_code = self.request_handler.probe_token(token, model, timeout, self.session_pool)
+            result["status"] = classify_status(status_code)
+            result["code"] = status_code
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)[:200]
+        result["elapsed"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def validate(self, tokens, model="grok-3", concurrency=None, timeout=None, drop_invalid=False):
+        """
+        并发检测令牌，每完成一个产出一条结果，最后产出汇总。
+        timeout 为单个令牌从发出请求到收到响应的时限（秒），超时的令牌结果为 error。
+        drop_invalid 为True时，从令牌池中删除检测为无效的令牌。
+        """
+        concurrency = max(1, min(concurrency or config_manager.get("TOKEN.VALIDATE_CONCURRENCY", 20), MAX_CONCURRENCY))
+        timeout = timeout or config_manager.get("TOKEN.VALIDATE_TIMEOUT", 15)
+        cookies = [
+            token if 'sso=' in token and 'sso-rw=' in token else f"sso-rw={token};sso={token}"
+            for token in dict.fromkeys(tokens) if token
+        ]
+
+        summary = {"total": len(cookies), "valid": 0, "rate_limited": 0, "blocked": 0, "invalid": 0, "error": 0, "dropped": 0}
+        start = time.perf_counter()
+        logger.info("开始批量检测令牌: {} 个，并发 {}", "TokenValidator", len(cookies), concurrency)
+
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="TokenValidator")
+        try:
+            futures = {executor.submit(self._check, cookie, model, timeout): cookie for cookie in cookies}
+            for future in as_completed(futures):
+                result = future.result()
+                summary[result["status"]] += 1
+                if drop_invalid and result["status"] == "invalid" and self.token_manager.delete_token(futures[future]):
+                    result["dropped"] = True
+                    summary["dropped"] += 1
+                yield result
+        finally:
+            # 调用方中途断开时取消尚未开始的检测
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        summary["elapsed"] = round(time.perf_counter() - start, 3)
+        logger.info("批量检测完成: {}", "TokenValidator", summary)
+        yield {"done": True, **summary}
@@ -0,0 +1,87 @@
+"""
+上游 NDJSON 响应解码
+
+grok 的流式响应每行一个JSON对象，这里把每行直接从原始字节解码为事件对象，
+流式与非流式处理共用，避免各自重复地解码、strip 和逐层 .get()。
+
+- TokenEvent: 普通文本分片，thinking 区分思考内容与最终回复
+- WebResultsEvent: 带网页搜索结果的分片
+- ModelResponseEvent: 最终的完整响应（modelResponse）
+- ErrorEvent: 上游返回的错误
+"""
+import json
+import json.scanner
+
+# 直接使用 json 的C扫描器，省去 json.loads 的类型检查和编码探测；
+# 扫描器只解析到第一个完整的值为止，尾部是否还有其他内容由 decode_line 检查
+_scan_once = json.scanner.make_scanner(json.JSONDecoder())
+
+
+class TokenEvent:
+    __slots__ = ("text", "thinking", "tag")
+
+    def __init__(self, text, thinking, tag):
+        self.text = text
+        self.thinking = thinking
+        self.tag = tag
+
+
+class WebResultsEvent(TokenEvent):
+    __slots__ = ("results",)
+
+    def __init__(self, text, thinking, tag, results):
+        super().__init__(text, thinking, tag)
+        self.results = results
+
+
+class ModelResponseEvent:
+    __slots__ = ("message", "thinking_trace")
+
+    def __init__(self, message, thinking_trace):
+        self.message = message
+        self.thinking_trace = thinking_trace
+
+
+class ErrorEvent:
+    __slots__ = ("payload",)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def decode_line(line):
+    """把一行上游数据（bytes）解码为事件；空行、无法解析的行和不含响应内容的行返回None"""
+    if not line:
+        return None
+    if line[0] != 0x7B:  # "{"
+        line = line.strip()
+    try:
+        text = line.decode("utf-8")
+        data, end = _scan_once(text, 0)
+    except (StopIteration, ValueError):
+        return None
+    # 与 json.loads 一致，完整的值之后只允许空白；行尾带有其他内容（如两个对象粘连、截断后拼接）视为无法解析
+    if end != len(text) and not text[end:].isspace():
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    if data.get("error"):
+        return ErrorEvent(data)
+
+    result = data.get("result")
+    response = result.get("response") if isinstance(result, dict) else None
+    if not response:
+        return None
+
+    model_response = response.get("modelResponse")
+    if model_response:
+        return ModelResponseEvent(model_response.get("message", ""), model_response.get("thinkingTrace"))
+
+    text = response.get("token") or ""
+    thinking = bool(response.get("isThinking"))
+    tag = response.get("messageTag")
+    web_results = response.get("webSearchResults")
+    if web_results:
+        return WebResultsEvent(text, thinking, tag, web_results.get("results", []))
+    return TokenEvent(text, thinking, tag)
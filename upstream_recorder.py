@@ -0,0 +1,334 @@
+"""
+上游响应流的录制与回放
+
+上游输出格式（isThinking、messageTag、xai:tool_usage_card、CDATA 工具调用等）经常变化，合成数据与真实流量不符。
+开启 UPSTREAM_RECORD 后，RequestHandler 把成功的上游响应按原始NDJSON行连同每行的到达时间录制下来，
+供离线回放，在真实数据上对解析和过滤的改动做基准测试与回归比对（见 benchmarks/bench_replay.py）。
+
+- 每条录制为一行JSON：模型、是否流式、状态码、响应头，以及 [相对请求发出的毫秒数, 原始行] 列表；
+  行按 surrogateescape 解码，非UTF-8字节也能原样还原
+- 令牌的Cookie值在行和响应头中替换为 [redacted]，Set-Cookie 响应头整体替换；请求体（用户消息）不录制
+- 每条录制单独压缩为一个gzip成员追加到 DIR/upstream-<时间>-<pid>.ndjson.gz，多个成员拼接仍是合法的gzip文件，
+  进程中途退出时最多丢失最后一条；压缩和写入在后台线程中进行，不占用请求线程和事件循环，队列满时丢弃
+- 只录制调用方实际读取的行：非流式请求在收到 modelResponse 后即停止读取，客户端提前断开的流只有断开前的部分
+- 同步模式下行的时间为调用方取出该行的时间，客户端读取很慢时会比上游的实际时间稍晚
+"""
+import os
+import gzip
+import json
+import time
+import queue
+import random
+import asyncio
+import threading
+from logger import logger
+
+REDACTED = "[redacted]"
+# 等待写入的录制数上限，超过后丢弃新的录制
+QUEUE_SIZE = 1024
+
+
+def _cookie_values(token):
+    """令牌Cookie串中需要脱敏的值，如 "sso-rw=X;sso=X" 中的 X"""
+    values = {token.strip()} if token else set()
+    for part in (token or "").split(";"):
+        _, _, value = part.partition("=")
+        if len(value.strip()) >= 8:
+            values.add(value.strip())
+    # 先替换较长的值，避免其中包含的较短值被替换后长值无法匹配
+    return sorted((value for value in values if value), key=len, reverse=True)
+
+
+def _redact(text, secrets):
+    for secret in secrets:
+        if secret in text:
+            text = text.replace(secret, REDACTED)
+    return text
+
+
+def _redact_headers(headers, secrets):
+    redacted = {}
+    for name, value in (headers or {}).items():
+        if name.lower() in ("set-cookie", "cookie"):
+            redacted[name] = REDACTED
+        else:
+            redacted[name] = _redact(str(value), secrets)
+    return redacted
+
+
+class RecordingResponse:
+    """包装同步上游响应，调用方读取行时顺带记录，关闭时提交录制；其余属性（状态码、首行时间等）透传"""
+
+    def __init__(self, recorder, response, model, stream, token):
+        self._recorder = recorder
+        self._response = response
+        self._model = model
+        self._stream = stream
+        self._token = token
+        self._lines = []
+        self._saved = False
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _record(self, line):
+        if line:
+            started = getattr(self._response, "started_at", None) or self._recorder.started
+            self._lines.append((time.monotonic() - started, line))
+
+    def _save(self):
+        if not self._saved:
+            self._saved = True
+            self._recorder.submit(self._response, self._model, self._stream, self._token, self._lines)
+
+    def iter_lines(self, idle_timeout=None):
+        for line in self._response.iter_lines(idle_timeout):
+            # idle_timeout 产生的空行不是上游数据
+            self._record(line)
+            yield line
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._save()
+
+    def abort(self):
+        try:
+            self._response.abort()
+        finally:
+            self._save()
+
+
+class AsyncRecordingResponse(RecordingResponse):
+    """异步版本的 RecordingResponse"""
+
+    async def aiter_lines(self, idle_timeout=None):
+        async for line in self._response.aiter_lines(idle_timeout):
+            self._record(line)
+            yield line
+
+    async def aclose(self):
+        try:
+            await self._response.aclose()
+        finally:
+            self._save()
+
+    async def abort(self):
+        try:
+            await self._response.abort()
+        finally:
+            self._save()
+
+
+class UpstreamRecorder:
+    def __init__(self, enabled, directory, sample_rate, max_bytes):
+        self.enabled = enabled and bool(directory) and sample_rate > 0 and max_bytes > 0
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.path = None
+        self.started = time.monotonic()
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._writer = None
+        self._lock = threading.Lock()
+        self.stats = {"recorded": 0, "sampled_out": 0, "dropped": 0, "failed": 0, "lines": 0, "bytes": 0}
+
+    def _should_record(self):
+        if not self.enabled:
+            return False
+        if self.stats["bytes"] >= self.max_bytes:
+            return False
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.stats["sampled_out"] += 1
+            return False
+        return True
+
+    def wrap(self, response, model, stream, token):
+        """按采样率决定是否录制该响应，录制时返回包装后的响应，否则原样返回"""
+        if not self._should_record():
+            return response
+        return RecordingResponse(self, response, model, stream, token)
+
+    def wrap_async(self, response, model, stream, token):
+        if not self._should_record():
+            return response
+        return AsyncRecordingResponse(self, response, model, stream, token)
+
+    def _ensure_writer(self):
+        # 写入线程和文件名在首次录制时才确定，多进程部署时各工作进程（fork之后）写各自的文件
+        if self._writer is not None:
+            return
+        with self._lock:
+            if self._writer is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.path = os.path.join(
+                    self.directory, f"upstream-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.ndjson.gz"
+                )
+                self._writer = threading.Thread(target=self._write_loop, name="UpstreamRecorder", daemon=True)
+                self._writer.start()
+                logger.info("开始录制上游响应: {}", "Server", self.path)
+
+    def submit(self, response, model, stream, token, lines):
+        """提交一条录制，由后台线程脱敏、压缩并写入"""
+        if not lines:
+            return
+        self._ensure_writer()
+        try:
+            # 同步响应的响应头在传输结束后才齐全，由写入线程再读取
+            self._queue.put_nowait((response, model, stream, token, lines, time.time()))
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _encode(self, response, model, stream, token, lines, recorded_at):
+        secrets = _cookie_values(token)
+        record = {
+            "model": model,
+            "stream": stream,
+            "status": getattr(response, "status_code", None),
+            "recorded_at": round(recorded_at, 3),
+            "headers": _redact_headers(getattr(response, "headers", None), secrets),
+            "lines": [
+                [round(offset * 1000, 1), _redact(line.decode("utf-8", "surrogateescape"), secrets)]
+                for offset, line in lines
+            ]
+        }
+        return gzip.compress((json.dumps(record) + "\n").encode("ascii"))
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                data = self._encode(*item)
+                with open(self.path, "ab") as f:
+                    f.write(data)
+                self.stats["recorded"] += 1
+                self.stats["lines"] += len(item[4])
+                self.stats["bytes"] += len(data)
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error("写入上游录制失败: {}", "Server", e)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """等待已提交的录制全部写入"""
+        if self._writer is not None:
+            self._queue.join()
+
+    def get_stats(self):
+        return {
+            "enabled": self.enabled,
+            "path": self.path,
+            "sample_rate": self.sample_rate,
+            "max_mb": self.max_bytes / 1024 / 1024,
+            "pending": self._queue.qsize(),
+            **self.stats
+        }
+
+
+class Recording:
+    """一条录制的上游响应；lines 为 [(相对请求发出的秒数, 原始行字节)]"""
+    __slots__ = ("model", "stream", "status", "headers", "recorded_at", "lines")
+
+    def __init__(self, record):
+        self.model = record["model"]
+        self.stream = record["stream"]
+        self.status = record["status"]
+        self.headers = record.get("headers") or {}
+        self.recorded_at = record.get("recorded_at")
+        self.lines = [(offset / 1000, line.encode("utf-8", "surrogateescape")) for offset, line in record["lines"]]
+
+    @property
+    def size(self):
+        return sum(len(line) for _, line in self.lines)
+
+
+def load_recordings(paths):
+    """读取录制文件（或目录下的所有 *.ndjson.gz），依次产出 Recording；文件末尾写入不完整的记录被忽略"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(".ndjson.gz"))
+        else:
+            files.append(path)
+    for path in files:
+        with gzip.open(path, "rt", encoding="ascii") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield Recording(json.loads(line))
+            except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+                logger.warning("录制文件 {} 末尾不完整: {}", "Server", path, e)
+
+
+class ReplayResponse:
+    """
+    按录制回放的上游响应，可直接传给 RequestHandler.handle_stream_response / handle_non_stream_response。
+    speed 为回放速度倍数，1 为按原始时间，0 为不等待、以最快速度回放；
+    按时间回放时与真实响应一样，超过 idle_timeout 没有数据则产出空行。
+    """
+
+    def __init__(self, recording, speed=0):
+        self.recording = recording
+        self.speed = speed
+        self.status_code = recording.status
+        self.headers = recording.headers
+        self.started_at = time.monotonic()
+        self.first_line_at = None
+        self.closed = False
+
+    def _delay(self, offset):
+        if not self.speed:
+            return 0
+        return self.started_at + offset / self.speed - time.monotonic()
+
+    def iter_lines(self, idle_timeout=None):
+        self.started_at = time.monotonic()
+        for offset, line in self.recording.lines:
+            delay = self._delay(offset)
+            while delay > 0:
+                if idle_timeout is not None and delay > idle_timeout:
+                    time.sleep(idle_timeout)
+                    yield b''
+                else:
+                    time.sleep(delay)
+                delay = self._delay(offset)
+            if self.closed:
+                return
+            if self.first_line_at is None:
+                self.first_line_at = time.monotonic()
+            yield line
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+
+class AsyncReplayResponse(ReplayResponse):
+    """异步版本的 ReplayResponse，可传给 handle_stream_response_async / handle_non_stream_response_async"""
+
+    async def aiter_lines(self, idle_timeout=None):
+        self.started_at = time.monotonic()
+        for offset, line in self.recording.lines:
+            delay = self._delay(offset)
+            while delay > 0:
+                if idle_timeout is not None and delay > idle_timeout:
+                    await asyncio.sleep(idle_timeout)
+                    yield b''
+                else:
+                    await asyncio.sleep(delay)
+                delay = self._delay(offset)
+            if self.closed:
+                return
+            if self.first_line_at is None:
+                self.first_line_at = time.monotonic()
+            yield line
+
+    async def aclose(self):
+        self.closed = True
+
+    async def abort(self):
+        self.closed = True